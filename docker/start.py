@@ -8,6 +8,7 @@ import re
 
 from ukbrest.config import logger, GENOTYPE_PATH_ENV, PHENOTYPE_PATH, PHENOTYPE_CSV_ENV, DB_URI_ENV, CODINGS_PATH, \
     SAMPLES_DATA_PATH, WITHDRAWALS_PATH
+from ukbrest.common.utils.compression import is_csv_file
 
 
 parser = argparse.ArgumentParser()
@@ -56,12 +57,12 @@ def _setup_phenotype_path():
 
         return float('-inf')
 
-    # by default, sort .csv files in reverse order taking the first number found in their names.
+    # by default, sort .csv files (also compressed ones, like .csv.gz) in reverse order taking the first number found in their names.
     # So for instance, these files: ukb00.csv, ukb01.csv and ukb50.csv would be loaded in
     # this order: ukb50.csv, ukb01.csv and ukb00.csv
     # the number in the file is interpreted as the dataset id, and greater means newer.
     phenotype_csv_file = sorted(
-        [f for f in listdir(phenotype_path) if f.lower().endswith('.csv')],
+        [f for f in listdir(phenotype_path) if is_csv_file(f)],
         key=sort_datasets,
         reverse=True
     )
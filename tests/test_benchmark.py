@@ -0,0 +1,48 @@
+import shutil
+import tempfile
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from tests.settings import POSTGRESQL_ENGINE, SQLITE_ENGINE
+from tests.utils import DBTest
+from ukbrest.benchmark import run_benchmark
+
+
+class BenchmarkTest(DBTest):
+    def test_benchmark_postgresql_and_sqlite(self):
+        # Prepare
+        data_dir = tempfile.mkdtemp(prefix='ukbrest_benchmark')
+
+        # Run
+        results = run_benchmark([POSTGRESQL_ENGINE, SQLITE_ENGINE], 100, 8, n_baskets=2, data_dir=data_dir, seed=1,
+                                n_columns_per_table=10, loading_n_jobs=1)
+
+        # Validate
+        assert results.columns.tolist() == ['db_type', 'stage', 'seconds', 'rows', 'bytes_written']
+        assert (results['seconds'] >= 0).all()
+        assert results.loc[results['stage'] == 'generate_data'].shape[0] == 1
+
+        ## stages are read from the load report
+        pg_results = results[results['db_type'] == 'postgresql'].set_index('stage')
+        for stage in ('schema', 'split', 'copy', 'verify', 'all_eids', 'constraints', 'total'):
+            assert stage in pg_results.index, stage
+
+        assert pg_results.loc['split', 'rows'] > 0
+        assert pg_results.loc['split', 'bytes_written'] > 0
+        assert (pg_results.drop('total')['seconds'] <= pg_results.loc['total', 'seconds']).all()
+
+        sqlite_results = results[results['db_type'] == 'sqlite'].set_index('stage')
+        for stage in ('schema', 'copy', 'verify', 'all_eids', 'total'):
+            assert stage in sqlite_results.index, stage
+
+        assert sqlite_results.loc['copy', 'rows'] > 0
+
+        ## data was loaded in both databases
+        all_eids = pd.read_sql('select count(*) as n from all_eids', create_engine(POSTGRESQL_ENGINE))
+        assert all_eids.loc[0, 'n'] > 100
+
+        all_eids = pd.read_sql('select count(*) as n from all_eids', create_engine(SQLITE_ENGINE))
+        assert all_eids.loc[0, 'n'] > 100
+
+        shutil.rmtree(data_dir)
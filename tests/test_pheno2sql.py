@@ -1,18 +1,28 @@
+import gzip
+import json
 import os
+import shutil
 import tempfile
 import unittest
+from subprocess import Popen
 
 import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine
+from sqlalchemy.types import INT, FLOAT
 
 from tests.settings import POSTGRESQL_ENGINE, SQLITE_ENGINE
 from tests.utils import get_repository_path, DBTest
 from ukbrest.common.pheno2sql import Pheno2SQL
+from ukbrest.common.postloader import Postloader
+from ukbrest.common.utils.datagen import write_random_pheno
+from ukbrest.common.utils.binary_copy import get_binary_copy_data
+from ukbrest.common.utils.memory import ChunkSizer, get_bytes_per_row
+from ukbrest.common.utils.constants import BGEN_SAMPLES_TABLE, ALL_EIDS_TABLE
+from ukbrest.resources.exceptions import UkbRestProgramExecutionError, UkbRestValidationError
 
 
 class Pheno2SQLTest(DBTest):
-    @unittest.skip('sqlite being removed')
     def test_sqlite_default_values(self):
         # Prepare
         csv_file = get_repository_path('pheno2sql/example01.csv')
@@ -130,7 +140,6 @@ class Pheno2SQLTest(DBTest):
         ## Check that temporary files were deleted
         assert len(os.listdir(temp_dir)) == 0
 
-    @unittest.skip('sqlite being removed')
     def test_sqlite_less_columns_per_table(self):
         # Prepare
         csv_file = get_repository_path('pheno2sql/example01.csv')
@@ -170,102 +179,1278 @@ class Pheno2SQLTest(DBTest):
         assert len(tmp.columns) == len(expected_columns)
         assert all(x in expected_columns for x in tmp.columns)
 
-        ## Check data is correct
-        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine), index_col='eid')
-        assert not tmp.empty
-        assert tmp.shape[0] == 2
-        assert tmp.loc[1, 'c21_0_0'] == 'Option number 1'
-        assert tmp.loc[1, 'c21_1_0'] == 'No response'
-        assert tmp.loc[1, 'c21_2_0'] == 'Yes'
-        assert tmp.loc[2, 'c21_0_0'] == 'Option number 2'
-        assert pd.isnull(tmp.loc[2, 'c21_1_0'])
-        assert tmp.loc[2, 'c21_2_0'] == 'No'
+        ## Check data is correct
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine), index_col='eid')
+        assert not tmp.empty
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c21_0_0'] == 'Option number 1'
+        assert tmp.loc[1, 'c21_1_0'] == 'No response'
+        assert tmp.loc[1, 'c21_2_0'] == 'Yes'
+        assert tmp.loc[2, 'c21_0_0'] == 'Option number 2'
+        assert pd.isnull(tmp.loc[2, 'c21_1_0'])
+        assert tmp.loc[2, 'c21_2_0'] == 'No'
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine), index_col='eid')
+        assert not tmp.empty
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c31_0_0'] == '2012-01-05'
+        assert int(tmp.loc[1, 'c34_0_0']) == 21
+        assert int(tmp.loc[1, 'c46_0_0']) == -9
+        assert tmp.loc[2, 'c31_0_0'] == '2015-12-30'
+        assert int(tmp.loc[2, 'c34_0_0']) == 12
+        assert int(tmp.loc[2, 'c46_0_0']) == -2
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_02', create_engine(db_engine), index_col='eid')
+        assert not tmp.empty
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c47_0_0'].round(5) == 45.55412
+        assert tmp.loc[1, 'c48_0_0'] == '2011-08-14'
+        assert tmp.loc[2, 'c47_0_0'].round(5) == -0.55461
+        assert tmp.loc[2, 'c48_0_0'] == '2010-03-29'
+
+    def test_postgresql_less_columns_per_table(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3)
+
+        # Run
+        p2sql.load_data()
+
+        # Validate
+        assert p2sql.db_type == 'postgresql'
+
+        ## Check tables exist
+        table = pd.read_sql("SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename = '{}');".format('ukb_pheno_0_00'), create_engine(db_engine))
+        assert table.iloc[0, 0]
+
+        table = pd.read_sql("SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename = '{}');".format('ukb_pheno_0_01'), create_engine(db_engine))
+        assert table.iloc[0, 0]
+
+        table = pd.read_sql("SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename = '{}');".format('ukb_pheno_0_02'), create_engine(db_engine))
+        assert table.iloc[0, 0]
+
+        ## Check columns are correct
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine))
+        expected_columns = ["eid","c21_0_0","c21_1_0","c21_2_0"]
+        assert len(tmp.columns) == len(expected_columns)
+        assert all(x in expected_columns for x in tmp.columns)
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine))
+        expected_columns = ["eid","c31_0_0","c34_0_0","c46_0_0"]
+        assert len(tmp.columns) == len(expected_columns)
+        assert all(x in expected_columns for x in tmp.columns)
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_02', create_engine(db_engine))
+        expected_columns = ["eid","c47_0_0","c48_0_0"]
+        assert len(tmp.columns) == len(expected_columns)
+        assert all(x in expected_columns for x in tmp.columns)
+
+        ## Check data is correct
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine), index_col='eid')
+        assert not tmp.empty
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c21_0_0'] == 'Option number 1'
+        assert tmp.loc[1, 'c21_1_0'] == 'No response'
+        assert tmp.loc[1, 'c21_2_0'] == 'Yes'
+        assert tmp.loc[2, 'c21_0_0'] == 'Option number 2'
+        assert pd.isnull(tmp.loc[2, 'c21_1_0'])
+        assert tmp.loc[2, 'c21_2_0'] == 'No'
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine), index_col='eid')
+        assert not tmp.empty
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c31_0_0'].strftime('%Y-%m-%d') == '2012-01-05'
+        assert int(tmp.loc[1, 'c34_0_0']) == 21
+        assert int(tmp.loc[1, 'c46_0_0']) == -9
+        assert tmp.loc[2, 'c31_0_0'].strftime('%Y-%m-%d') == '2015-12-30'
+        assert int(tmp.loc[2, 'c34_0_0']) == 12
+        assert int(tmp.loc[2, 'c46_0_0']) == -2
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_02', create_engine(db_engine), index_col='eid')
+        assert not tmp.empty
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c47_0_0'].round(5) == 45.55412
+        assert tmp.loc[1, 'c48_0_0'].strftime('%Y-%m-%d') == '2011-08-14'
+        assert tmp.loc[2, 'c47_0_0'].round(5) == -0.55461
+        assert tmp.loc[2, 'c48_0_0'].strftime('%Y-%m-%d') == '2010-03-29'
+
+    def test_postgresql_less_columns_per_table_single_pass(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_chunksize=1, loading_single_pass=True)
+
+        # Run
+        p2sql.load_data()
+
+        # Validate
+        assert p2sql.db_type == 'postgresql'
+
+        ## Check columns are correct
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine))
+        expected_columns = ["eid","c21_0_0","c21_1_0","c21_2_0"]
+        assert len(tmp.columns) == len(expected_columns)
+        assert all(x in expected_columns for x in tmp.columns)
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine))
+        expected_columns = ["eid","c31_0_0","c34_0_0","c46_0_0"]
+        assert len(tmp.columns) == len(expected_columns)
+        assert all(x in expected_columns for x in tmp.columns)
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_02', create_engine(db_engine))
+        expected_columns = ["eid","c47_0_0","c48_0_0"]
+        assert len(tmp.columns) == len(expected_columns)
+        assert all(x in expected_columns for x in tmp.columns)
+
+        ## Check data is correct
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine), index_col='eid')
+        assert not tmp.empty
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c21_0_0'] == 'Option number 1'
+        assert tmp.loc[1, 'c21_1_0'] == 'No response'
+        assert tmp.loc[1, 'c21_2_0'] == 'Yes'
+        assert tmp.loc[2, 'c21_0_0'] == 'Option number 2'
+        assert pd.isnull(tmp.loc[2, 'c21_1_0'])
+        assert tmp.loc[2, 'c21_2_0'] == 'No'
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine), index_col='eid')
+        assert not tmp.empty
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c31_0_0'].strftime('%Y-%m-%d') == '2012-01-05'
+        assert int(tmp.loc[1, 'c34_0_0']) == 21
+        assert int(tmp.loc[1, 'c46_0_0']) == -9
+        assert tmp.loc[2, 'c31_0_0'].strftime('%Y-%m-%d') == '2015-12-30'
+        assert int(tmp.loc[2, 'c34_0_0']) == 12
+        assert int(tmp.loc[2, 'c46_0_0']) == -2
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_02', create_engine(db_engine), index_col='eid')
+        assert not tmp.empty
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c47_0_0'].round(5) == 45.55412
+        assert tmp.loc[1, 'c48_0_0'].strftime('%Y-%m-%d') == '2011-08-14'
+        assert tmp.loc[2, 'c47_0_0'].round(5) == -0.55461
+        assert tmp.loc[2, 'c48_0_0'].strftime('%Y-%m-%d') == '2010-03-29'
+
+    def test_postgresql_stream_copy(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+        temp_dir = tempfile.mkdtemp()
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_chunksize=1, tmpdir=temp_dir,
+                          delete_temp_csv=False, loading_stream_copy=True)
+
+        # Run
+        p2sql.load_data()
+
+        # Validate
+        ## Check that no temporary files were written
+        assert len(os.listdir(temp_dir)) == 0
+
+        ## Check data is correct
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine), index_col='eid')
+        expected_columns = ["c21_0_0","c21_1_0","c21_2_0"]
+        assert len(tmp.columns) == len(expected_columns)
+        assert all(x in expected_columns for x in tmp.columns)
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c21_0_0'] == 'Option number 1'
+        assert tmp.loc[1, 'c21_1_0'] == 'No response'
+        assert tmp.loc[2, 'c21_0_0'] == 'Option number 2'
+        assert pd.isnull(tmp.loc[2, 'c21_1_0'])
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine), index_col='eid')
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c31_0_0'].strftime('%Y-%m-%d') == '2012-01-05'
+        assert int(tmp.loc[1, 'c34_0_0']) == 21
+        assert int(tmp.loc[2, 'c46_0_0']) == -2
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_02', create_engine(db_engine), index_col='eid')
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c47_0_0'].round(5) == 45.55412
+        assert tmp.loc[2, 'c48_0_0'].strftime('%Y-%m-%d') == '2010-03-29'
+
+    def test_postgresql_binary_copy_same_as_text_copy(self):
+        # Prepare
+        data_dir = tempfile.mkdtemp(prefix='ukbrest_random_pheno')
+        csv_file = os.path.join(data_dir, 'ukb_random.csv')
+
+        write_random_pheno(csv_file, 150, 15, max_instances=2, max_arrays=3, missing_rate=0.3, seed=2)
+
+        db_engine = POSTGRESQL_ENGINE
+
+        def _get_loaded_data():
+            tables = pd.read_sql('select distinct table_name from fields order by table_name',
+                                 create_engine(db_engine))['table_name'].tolist()
+            tables.append('events')
+
+            return {
+                table_name: pd.read_sql('select * from {} order by 1, 2'.format(table_name), create_engine(db_engine))
+                for table_name in tables
+            }
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=10, loading_chunksize=40, loading_n_jobs=2,
+                          loading_stream_copy=True)
+        p2sql.load_data()
+        text_copy_data = _get_loaded_data()
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=10, loading_chunksize=40, loading_n_jobs=2,
+                          loading_binary_copy=True)
+        assert p2sql.loading_stream_copy
+
+        p2sql.load_data()
+
+        # Validate
+        binary_copy_data = _get_loaded_data()
+
+        assert sorted(binary_copy_data.keys()) == sorted(text_copy_data.keys())
+        assert len(text_copy_data) > 2
+
+        for table_name, table_data in text_copy_data.items():
+            assert table_data.shape[0] > 0
+            pd.testing.assert_frame_equal(binary_copy_data[table_name], table_data)
+
+    def test_binary_copy_non_integral_values_rejected(self):
+        # Prepare
+        data = pd.DataFrame({'c34_0_0': ['12', np.nan, '-3']}, index=pd.Index([1, 2, 3], name='eid'))
+
+        # Run
+        binary_data = get_binary_copy_data(data, {'c34_0_0': INT})
+
+        # Validate
+        assert len(binary_data) > 0
+
+        ## like with a text COPY, values are not truncated
+        for invalid_value in ('1.7', '-0.5', 'nan'):
+            data.loc[2, 'c34_0_0'] = invalid_value
+
+            with self.assertRaises(ValueError):
+                get_binary_copy_data(data, {'c34_0_0': INT})
+
+        data.loc[2, 'c34_0_0'] = '1.7'
+        assert len(get_binary_copy_data(data, {'c34_0_0': FLOAT})) > 0
+
+    def test_postgresql_array_columns_query_same_as_scalar_columns(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example09_with_arrays.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        columns = ['c21_0_0', 'c84_0_0', 'c84_0_2', '(c84_1_1) as myfield', 'c48_0_0']
+        filterings = ['c84_0_1 > 0', 'c46_0_0 < 5']
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1)
+        p2sql.load_data()
+        scalar_result = pd.concat(p2sql.query(columns, ecolumns=['c84_1_.*'], filterings=filterings))
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1, loading_array_columns=True)
+        p2sql.load_data()
+
+        # Validate
+        fields = pd.read_sql('select column_name, table_name, array_column from fields order by column_name',
+                             create_engine(db_engine), index_col='column_name')
+        assert fields.loc['c84_0_0', 'array_column'] == 'c84_0'
+        assert fields.loc['c84_0_2', 'array_column'] == 'c84_0'
+        assert fields.loc['c84_1_1', 'array_column'] == 'c84_1'
+        assert pd.isnull(fields.loc['c21_0_0', 'array_column'])
+        assert fields.loc['c84_0_0', 'table_name'] == fields.loc['c84_0_2', 'table_name']
+
+        array_table = fields.loc['c84_0_0', 'table_name']
+        array_table_columns = pd.read_sql('select * from {} limit 0'.format(array_table), create_engine(db_engine))
+        assert 'c84_0' in array_table_columns.columns
+        assert 'c84_0_0' not in array_table_columns.columns
+
+        array_values = pd.read_sql('select eid, c84_0 from {} order by eid'.format(array_table),
+                                   create_engine(db_engine), index_col='eid')
+        assert array_values.loc[1, 'c84_0'] == [11, 1, 999]
+        assert array_values.loc[3, 'c84_0'] == [None, 98, -68]
+
+        array_result = pd.concat(p2sql.query(columns, ecolumns=['c84_1_.*'], filterings=filterings))
+
+        assert array_result.shape[0] > 0
+        pd.testing.assert_frame_equal(array_result.sort_index(), scalar_result.sort_index())
+
+        yaml_data = {
+            'samples_filters': ['c84_1_2 > 0'],
+            'data': {
+                'field_str': 'c84_0_1',
+                'field_sql': {
+                    'sql': {
+                        1: 'c84_1_0 > 0',
+                        0: 'c84_1_0 <= 0',
+                    },
+                },
+            },
+        }
+
+        yaml_result = pd.concat(p2sql.query_yaml(yaml_data, 'data')).sort_index()
+        assert yaml_result.index.tolist() == [4, 5]
+        assert yaml_result.loc[4, 'field_str'] == '-37'
+        assert yaml_result.loc[4, 'field_sql'] == '1'
+        assert yaml_result.loc[5, 'field_str'] == '36'
+        assert yaml_result.loc[5, 'field_sql'] == '0'
+
+    def test_postgresql_array_columns_random_data(self):
+        # Prepare
+        data_dir = tempfile.mkdtemp(prefix='ukbrest_random_pheno')
+        csv_file = os.path.join(data_dir, 'ukb_random.csv')
+
+        write_random_pheno(csv_file, 100, 15, max_instances=2, max_arrays=4, missing_rate=0.3, seed=5)
+
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=8, loading_chunksize=30, loading_n_jobs=2)
+        p2sql.load_data()
+
+        all_columns = pd.read_sql('select column_name from fields order by column_name',
+                                  create_engine(db_engine))['column_name'].tolist()
+        scalar_result = pd.concat(p2sql.query(all_columns))
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=8, loading_chunksize=30, loading_n_jobs=2,
+                          loading_stream_copy=True, loading_array_columns=True)
+        p2sql.load_data()
+
+        # Validate
+        fields = pd.read_sql('select column_name, table_name, array_column from fields', create_engine(db_engine))
+        assert fields['array_column'].notnull().any()
+        assert sorted(fields['column_name'].tolist()) == all_columns
+
+        array_result = pd.concat(p2sql.query(all_columns))
+        pd.testing.assert_frame_equal(array_result.sort_index(), scalar_result.sort_index())
+
+        # incremental loads are not supported
+        with self.assertRaises(UkbRestProgramExecutionError):
+            p2sql.load_data(incremental=True)
+
+    def test_postgresql_categorical_codes_query_same_as_text_columns(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example09_with_arrays.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        columns = ['c21_0_0', '(c21_1_0) as myfield', 'c21_2_0', 'c84_0_0']
+        filterings = ["c21_0_0 in ('Option number 1', 'Option number 3', 'Option number 5')", "c21_2_0 <> 'Maybe'"]
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1)
+        p2sql.load_data()
+        text_result = pd.concat(p2sql.query(columns, filterings=filterings))
+
+        codings = pd.DataFrame({
+            'data_coding': 100261,
+            'coding': ['Option number {}'.format(i) for i in range(1, 6)] +
+                      ['No response', 'Of course', "I don't know", 'Maybe', 'Yes', 'No', 'Probably'],
+        })
+        codings['meaning'] = codings['coding']
+        codings.to_sql('codings', create_engine(db_engine), index=False)
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1,
+                          loading_categorical_codes=True, loading_array_columns=True)
+        p2sql.load_data()
+
+        # Validate
+        fields = pd.read_sql('select column_name, table_name, encoded from fields', create_engine(db_engine),
+                             index_col='column_name')
+        assert fields.loc['c21_0_0', 'encoded']
+        assert fields.loc['c21_2_0', 'encoded']
+        assert not fields.loc['c84_0_0', 'encoded']
+        assert not fields.loc['c31_0_0', 'encoded']
+
+        column_type = pd.read_sql("""
+            select data_type from information_schema.columns
+            where table_name = '{}' and column_name = 'c21_0_0'
+        """.format(fields.loc['c21_0_0', 'table_name']), create_engine(db_engine)).iloc[0, 0]
+        assert column_type == 'smallint'
+
+        # comparisons with known values use codes
+        codes = pd.read_sql("select codings from categorical_codes where data_coding = 100261",
+                            create_engine(db_engine)).iloc[0, 0]
+        assert p2sql._rewrite_columns("c21_2_0 <> 'Maybe'") == 'c21_2_0 <> {}'.format(codes.index('Maybe'))
+        assert 'categorical_codes' in p2sql._rewrite_columns("c21_2_0 = 'Unknown value'")
+
+        codes_result = pd.concat(p2sql.query(columns, filterings=filterings))
+
+        assert codes_result.shape[0] == 2
+        pd.testing.assert_frame_equal(codes_result.sort_index(), text_result.sort_index())
+
+        # values not in the codings table are not loaded
+        codings.iloc[:-1].to_sql('codings', create_engine(db_engine), index=False, if_exists='replace')
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1,
+                          loading_categorical_codes=True)
+
+        with self.assertRaises(UkbRestProgramExecutionError):
+            p2sql.load_data()
+
+    def test_postgresql_field_stats_all_modes(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example09_with_arrays.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        for loading_parameters in ({}, {'loading_single_pass': True}, {'loading_stream_copy': True}):
+            p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=2, loading_chunksize=2,
+                              loading_field_stats=True, **loading_parameters)
+
+            # Run
+            p2sql.load_data()
+
+            # Validate
+            field_stats = p2sql.get_field_stats()
+            assert field_stats.shape[0] == 14, loading_parameters
+            assert (field_stats['n_rows'] == 5).all()
+
+            # categorical
+            assert field_stats.loc['c21_1_0', 'n_nulls'] == 1
+            assert field_stats.loc['c21_1_0', 'n_distinct'] == 4
+            assert field_stats.loc['c21_1_0', 'min_value'] == "I don't know"
+            assert field_stats.loc['c21_1_0', 'max_value'] == 'Of course'
+            assert field_stats.loc['c21_1_0', 'histogram'] == {
+                'values': ["I don't know", 'Maybe', 'No response', 'Of course'],
+                'counts': [1, 1, 1, 1],
+            }
+
+            # continuous
+            assert field_stats.loc['c47_0_0', 'n_nulls'] == 1
+            assert field_stats.loc['c47_0_0', 'min_value'] == '-35.31471'
+            assert field_stats.loc['c47_0_0', 'max_value'] == '41.55312'
+            histogram = field_stats.loc['c47_0_0', 'histogram']
+            assert histogram['bins'][0] == -35.31471
+            assert histogram['bins'][-1] == 41.55312
+            assert sum(histogram['counts']) == 4
+            assert histogram['counts'][0] == 1
+            assert histogram['counts'][-1] == 1
+
+            # integer
+            assert field_stats.loc['c84_0_2', 'min_value'] == '-445'
+            assert field_stats.loc['c84_0_2', 'max_value'] == '999'
+            assert field_stats.loc['c84_0_2', 'n_distinct'] == 4
+
+            # date
+            assert field_stats.loc['c31_0_0', 'min_value'] == '1997-04-15'
+            assert field_stats.loc['c31_0_0', 'max_value'] == '2011-03-07'
+
+            assert field_stats.loc['c84_1_0', 'n_nulls'] == 2
+
+        field_stats = p2sql.get_field_stats(columns=['c21_0_0'], ecolumns=['c84_0_.*'])
+        assert field_stats.index.tolist() == ['c21_0_0', 'c84_0_0', 'c84_0_1', 'c84_0_2']
+        assert field_stats.loc['c21_0_0', 'n_distinct'] == 5
+
+    def test_postgresql_query_files_columns_queried_together_in_same_table(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example09_with_arrays.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        query_dir = tempfile.mkdtemp(prefix='ukbrest_query_files')
+
+        yaml_file = os.path.join(query_dir, 'queries.yaml')
+        with open(yaml_file, 'w') as f:
+            f.write(
+                'samples_filters:\n'
+                '  - c47_0_0 > 0\n'
+                'data:\n'
+                '  myfield: c84_1_2\n'
+                '  othfield:\n'
+                '    sql:\n'
+                '      1: c21_0_0 = \'Option number 1\'\n'
+            )
+
+        log_file = os.path.join(query_dir, 'queries.log')
+        with open(log_file, 'w') as f:
+            f.write('select c34_0_0, c84_0_1 from t\n' * 3)
+            f.write('columns=c48_0_0&columns=c21_2_0\n')
+
+        columns = ['c21_0_0', 'c84_1_2', 'c47_0_0', 'c34_0_0', 'c84_0_1']
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1)
+        p2sql.load_data()
+        csv_order_tables = p2sql._get_needed_tables(columns)
+        csv_order_result = pd.concat(p2sql.query(columns))
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1,
+                          loading_query_files=[yaml_file, log_file])
+        p2sql.load_data()
+
+        # Validate
+        fields = pd.read_sql('select column_name, table_name from fields', create_engine(db_engine),
+                             index_col='column_name')['table_name']
+        assert fields.shape[0] == 14
+        assert fields.value_counts().max() == 3
+
+        assert fields.loc['c21_0_0'] == fields.loc['c84_1_2'] == fields.loc['c47_0_0']
+        assert fields.loc['c34_0_0'] == fields.loc['c84_0_1']
+        assert fields.loc['c48_0_0'] == fields.loc['c21_2_0']
+
+        assert len(csv_order_tables) == 5
+        assert len(p2sql._get_needed_tables(columns)) == 2
+
+        pd.testing.assert_frame_equal(pd.concat(p2sql.query(columns)).sort_index(), csv_order_result.sort_index())
+
+    def test_postgresql_query_files_changed_on_resume_keep_tables(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example09_with_arrays.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        query_dir = tempfile.mkdtemp(prefix='ukbrest_query_files')
+
+        log_file = os.path.join(query_dir, 'queries.log')
+        with open(log_file, 'w') as f:
+            f.write('select c21_0_0, c84_1_2, c47_0_0 from t\n')
+
+        columns = ['c21_0_0', 'c84_1_2', 'c47_0_0', 'c34_0_0', 'c84_0_1']
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1,
+                          loading_query_files=[log_file])
+        p2sql.load_data()
+        expected_result = pd.concat(p2sql.query(columns))
+
+        fields = pd.read_sql('select column_name, table_name from fields', create_engine(db_engine),
+                             index_col='column_name')['table_name']
+        table_name = fields.loc['c21_0_0']
+
+        # simulate a failure while loading the table with c21_0_0
+        with create_engine(db_engine).connect() as conn:
+            conn.execute("delete from {} where eid = 2".format(table_name))
+            conn.execute("delete from load_manifest where table_name = '{}' and step in ('copy', 'verified')"
+                         .format(table_name))
+            conn.execute("delete from load_manifest where csv_file = ''")
+
+        ## queries of the workload changed before resuming
+        with open(log_file, 'w') as f:
+            f.write('select c21_0_0, c34_0_0, c84_0_1 from t\n')
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1, loading_query_files=[log_file])
+        p2sql.load_data(resume=True)
+
+        # Validate
+        ## tables keep the columns of the first run
+        resumed_fields = pd.read_sql('select column_name, table_name from fields', create_engine(db_engine),
+                                     index_col='column_name')['table_name']
+        pd.testing.assert_series_equal(resumed_fields.sort_index(), fields.sort_index())
+        assert fields.loc['c21_0_0'] == fields.loc['c84_1_2'] == fields.loc['c47_0_0']
+
+        tmp = pd.read_sql('select * from {}'.format(table_name), create_engine(db_engine), index_col='eid')
+        assert sorted(tmp.columns.tolist()) == ['c21_0_0', 'c47_0_0', 'c84_1_2']
+
+        pd.testing.assert_frame_equal(pd.concat(p2sql.query(columns)).sort_index(), expected_result.sort_index())
+
+    def test_postgresql_resume_with_files_in_other_order(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example14')
+
+        csv_file1 = get_repository_path(os.path.join(directory, 'example14_00.csv'))
+        csv_file2 = get_repository_path(os.path.join(directory, 'example14_01.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=2, loading_n_jobs=1)
+        p2sql.load_data()
+
+        # Run
+        p2sql = Pheno2SQL((csv_file2, csv_file1), db_engine, n_columns_per_table=2, loading_n_jobs=1)
+
+        # Validate
+        with self.assertRaisesRegex(ValueError, 'load manifest does not match the input files: .*example14_01.csv'):
+            p2sql.load_data(resume=True)
+
+        ## the same files in the same order are resumed
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=2, loading_n_jobs=1)
+        p2sql.load_data(resume=True)
+
+        query_result = next(p2sql.query(['c102_0_0', 'c103_0_0']))
+        assert not query_result.empty
+
+    def test_postgresql_loading_report_file(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example02.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        report_dir = tempfile.mkdtemp(prefix='ukbrest_load_report')
+
+        for loading_stream_copy in (False, True):
+            report_file = os.path.join(report_dir, 'report_{}.json'.format(loading_stream_copy))
+
+            p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=2, loading_n_jobs=2,
+                              loading_stream_copy=loading_stream_copy, loading_report_file=report_file)
+
+            # Run
+            p2sql.load_data(vacuum=True)
+
+            # Validate
+            with open(report_file, 'r') as f:
+                report = json.load(f)
+
+            assert report['status'] == 'finished'
+            assert report['seconds'] > 0
+            assert report['csv_files'] == [csv_file]
+
+            stages = report['stages']
+            assert {'html_parse', 'schema', 'copy', 'verify', 'all_eids', 'constraints', 'vacuum'} <= set(stages)
+            assert ('split' in stages) != loading_stream_copy
+
+            assert stages['schema']['count'] == 1
+            assert stages['copy']['count'] == 4
+            assert stages['copy']['bytes_read'] > 0
+
+            # each record of the stage reads all rows of the CSV file
+            read_stage = stages['copy' if loading_stream_copy else 'split']
+            assert read_stage['rows'] == 4 * read_stage['count']
+            assert read_stage['bytes_written'] > 0
+            assert read_stage['rows_per_second'] > 0
+
+            copy_records = [r for r in report['records'] if r['stage'] == 'copy']
+            assert all(r['seconds'] >= 0 for r in copy_records)
+
+            assert len(report['workers']) >= 2
+            assert all(w['peak_rss_mb'] > 0 for w in report['workers'].values())
+
+    def test_postgresql_loading_memory_limit(self):
+        # Prepare
+        data_dir = tempfile.mkdtemp(prefix='ukbrest_random_pheno')
+        csv_file = os.path.join(data_dir, 'ukb_random.csv')
+
+        write_random_pheno(csv_file, 450, 15, max_instances=2, max_arrays=3, missing_rate=0.3, seed=3)
+
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=8, loading_n_jobs=1)
+        p2sql.load_data()
+
+        all_columns = pd.read_sql('select column_name from fields order by column_name',
+                                  create_engine(db_engine))['column_name'].tolist()
+        expected_result = pd.concat(p2sql.query(all_columns)).sort_index()
+        expected_events = pd.read_sql('select * from events order by 1, 2, 3, 4', create_engine(db_engine))
+
+        # Run
+        for loading_stream_copy in (False, True):
+            # the budget is lower than the memory of the process, so the smallest chunks are read
+            p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=8, loading_n_jobs=2, loading_chunksize=1000,
+                              loading_memory_limit='1MB', loading_stream_copy=loading_stream_copy)
+            p2sql.load_data()
+
+            # Validate
+            assert p2sql.loading_memory_limit == 1024 ** 2
+
+            pd.testing.assert_frame_equal(pd.concat(p2sql.query(all_columns)).sort_index(), expected_result)
+            pd.testing.assert_frame_equal(
+                pd.read_sql('select * from events order by 1, 2, 3, 4', create_engine(db_engine)), expected_events)
+
+        # number of workers
+        jobs_column_names = [(csv_file, [(x, x) for x in all_columns])]
+
+        p2sql = Pheno2SQL(csv_file, db_engine, loading_n_jobs=4, loading_memory_limit='1MB')
+        assert p2sql._get_loading_n_jobs(jobs_column_names) == 1
+        assert p2sql._loading_tmp['worker_memory_limit'] == 1024 ** 2
+
+        p2sql = Pheno2SQL(csv_file, db_engine, loading_n_jobs=4, loading_memory_limit='1TB')
+        assert p2sql._get_loading_n_jobs(jobs_column_names) == 4
+        assert p2sql._loading_tmp['worker_memory_limit'] == 1024 ** 4 // 4
+
+        p2sql = Pheno2SQL(csv_file, db_engine, loading_n_jobs=4, loading_memory_limit='2.5GB',
+                          loading_worker_memory_limit='1GB')
+        assert p2sql._get_loading_n_jobs(jobs_column_names) == 2
+        assert p2sql._loading_tmp['worker_memory_limit'] == 1024 ** 3
+
+        # chunks are sized from the memory of rows already read
+        chunk_sizer = ChunkSizer(1024 ** 2, 5000, min_chunksize=10, max_chunksize=100000, overhead=4)
+        assert chunk_sizer.get_chunksize() == 5000
+
+        chunk = pd.read_csv(csv_file, index_col=0, dtype=str, nrows=100)
+        chunk_sizer.update(chunk)
+        assert chunk_sizer.get_chunksize() == int(1024 ** 2 / (get_bytes_per_row(chunk) * 4))
+        assert 10 < chunk_sizer.get_chunksize() < 5000
+
+    def test_postgresql_fields_catalog_refreshed_when_data_version_changes(self):
+        # Prepare
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(get_repository_path('pheno2sql/example02.csv'), db_engine, n_columns_per_table=2,
+                          loading_n_jobs=1, fields_catalog_check_interval=3600)
+        p2sql.load_data()
+
+        other_p2sql = Pheno2SQL(get_repository_path('pheno2sql/example03.csv'), db_engine, n_columns_per_table=2,
+                                loading_n_jobs=1, fields_catalog_check_interval=0)
+
+        # Run
+        fields_catalog = p2sql._get_fields_catalog()
+        data_version = p2sql._get_data_version()
+
+        # Validate
+        assert fields_catalog.data_version == data_version
+        assert p2sql._get_fields_catalog() is fields_catalog
+
+        fields = pd.read_sql('select * from fields', create_engine(db_engine), index_col='column_name')
+        assert len(fields_catalog.columns_tables) == fields.shape[0]
+
+        c21_0_0 = fields_catalog.get_field('c21_0_0')
+        assert c21_0_0['table_name'] == fields.loc['c21_0_0', 'table_name']
+        assert c21_0_0['type'] == 'Categorical (single)'
+        assert c21_0_0['field_id'] == '21'
+        assert c21_0_0['inst'] == 0
+        assert c21_0_0['arr'] == 0
+        assert fields_catalog.get_field('c9999_0_0') is None
+
+        assert p2sql.get_field_dtype('c48_0_0') == 'Time'
+        assert p2sql._get_needed_tables(['c21_0_0', 'c21_1_0', 'c9999_0_0']) == \
+            sorted(set(fields.loc[['c21_0_0', 'c21_1_0'], 'table_name']))
+
+        # another process loads data: the catalog is read again once the data version is checked
+        assert other_p2sql._get_fields_catalog().data_version == data_version
+        other_p2sql.load_data()
+
+        assert other_p2sql._get_data_version() == data_version + 1
+        assert p2sql._get_fields_catalog() is fields_catalog
+
+        p2sql.fields_catalog_check_interval = 0
+        assert p2sql._get_fields_catalog().data_version == data_version + 1
+        assert p2sql.get_field_dtype('c21_0_0') == other_p2sql.get_field_dtype('c21_0_0')
+
+    def test_postgresql_ecolumns_same_as_sql_reg_exp(self):
+        # Prepare
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(get_repository_path('pheno2sql/example09_with_arrays.csv'), db_engine,
+                          n_columns_per_table=3, loading_n_jobs=1)
+        p2sql.load_data()
+
+        reg_exps = [['c84_1_.*'], ['c84_0_.*', 'c21_[01]_0'], ['^c4[78]'], ['_2_'], ['c9999_.*'], ['c84_.*', 'c84_1_.*']]
+
+        for ecolumns in reg_exps:
+            # Run
+            columns = p2sql._get_fields_from_reg_exp(ecolumns)
+
+            # Validate
+            sql_columns = pd.read_sql(
+                'select distinct column_name from fields where {} order by column_name'.format(
+                    ' or '.join("column_name ~ '{}'".format(x) for x in ecolumns)),
+                create_engine(db_engine))['column_name'].tolist()
+
+            assert columns == sorted(sql_columns), ecolumns
+
+        # expansions are cached in the catalog
+        fields_catalog = p2sql._get_fields_catalog()
+        assert set(fields_catalog._reg_exp_columns) == {x for ecolumns in reg_exps for x in ecolumns}
+        assert fields_catalog._reg_exp_columns['c84_1_.*'] == frozenset(p2sql._get_fields_from_reg_exp(['c84_1_.*']))
+
+        ## only the last regular expressions used are kept
+        fields_catalog.REG_EXP_CACHE_SIZE = 3
+        p2sql._get_fields_from_reg_exp(['c84_0_.*', 'c21_[01]_0', 'c31_.*'])
+        assert list(fields_catalog._reg_exp_columns) == ['c84_0_.*', 'c21_[01]_0', 'c31_.*']
+
+        with self.assertRaises(UkbRestValidationError):
+            p2sql._get_fields_from_reg_exp(['c84_(1'])
+
+    def test_postgresql_stream_copy_single_pass_query(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example02.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=2, loading_chunksize=2,
+                          loading_single_pass=True, loading_stream_copy=True)
+
+        # Run
+        p2sql.load_data()
+
+        columns = ['c21_0_0', 'c21_2_0', 'c47_0_0', 'c48_0_0']
+        query_result = next(p2sql.query(columns))
+
+        # Validate
+        assert query_result.index.name == 'eid'
+        assert len(query_result.index) == 4
+        assert all(x in query_result.index for x in range(1, 4 + 1))
+
+        assert len(query_result.columns) == len(columns)
+        assert all(x in columns for x in query_result.columns)
+
+        assert query_result.loc[1, 'c21_0_0'] == 'Option number 1'
+        assert query_result.loc[2, 'c21_0_0'] == 'Option number 2'
+        assert query_result.loc[3, 'c21_0_0'] == 'Option number 3'
+        assert query_result.loc[4, 'c21_0_0'] == 'Option number 4'
+
+        assert query_result.loc[1, 'c21_2_0'] == 'Yes'
+        assert query_result.loc[2, 'c21_2_0'] == 'No'
+        assert query_result.loc[3, 'c21_2_0'] == 'Maybe'
+        assert pd.isnull(query_result.loc[4, 'c21_2_0'])
+
+        assert query_result.loc[1, 'c47_0_0'].round(5) == 45.55412
+        assert query_result.loc[2, 'c47_0_0'].round(5) == -0.55461
+        assert query_result.loc[3, 'c47_0_0'].round(5) == -5.32471
+        assert query_result.loc[4, 'c47_0_0'].round(5) == 55.19832
+
+        assert query_result.loc[1, 'c48_0_0'].strftime('%Y-%m-%d') == '2011-08-14'
+        assert query_result.loc[2, 'c48_0_0'].strftime('%Y-%m-%d') == '2016-11-30'
+        assert query_result.loc[3, 'c48_0_0'].strftime('%Y-%m-%d') == '2010-01-01'
+        assert query_result.loc[4, 'c48_0_0'].strftime('%Y-%m-%d') == '2011-02-15'
+
+    def test_postgresql_resume_load_skips_completed_tables(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1)
+        p2sql.load_data()
+
+        # simulate a failure while loading the second table
+        with create_engine(db_engine).connect() as conn:
+            conn.execute("update ukb_pheno_0_00 set c21_0_0 = 'Not reloaded' where eid = 1")
+            conn.execute("delete from ukb_pheno_0_01 where eid = 2")
+            conn.execute("delete from load_manifest where table_name = 'ukb_pheno_0_01' and step in ('copy', 'verified')")
+            conn.execute("delete from load_manifest where csv_file = ''")
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1)
+        p2sql.load_data(resume=True)
+
+        # Validate
+        ## first table was not loaded again
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine), index_col='eid')
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c21_0_0'] == 'Not reloaded'
+        assert tmp.loc[2, 'c21_0_0'] == 'Option number 2'
+
+        ## second table was reloaded
+        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine), index_col='eid')
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c31_0_0'].strftime('%Y-%m-%d') == '2012-01-05'
+        assert tmp.loc[2, 'c31_0_0'].strftime('%Y-%m-%d') == '2015-12-30'
+        assert int(tmp.loc[2, 'c46_0_0']) == -2
+
+        ## fields table was not duplicated
+        tmp = pd.read_sql('select * from fields', create_engine(db_engine))
+        assert tmp.shape[0] == 8
+
+        ## all tables are marked as verified
+        tmp = pd.read_sql("select * from load_manifest where step = 'verified'", create_engine(db_engine),
+                          index_col='table_name')
+        assert tmp.shape[0] == 3
+        assert all(tmp['csv_file'] == 'example01.csv')
+        assert all(tmp['n_rows'] == 2)
+
+        all_eids = pd.read_sql('select * from all_eids', create_engine(db_engine))
+        assert all_eids.shape[0] == 2
+
+    def test_postgresql_load_without_resume_reloads_everything(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1)
+        p2sql.load_data()
+
+        with create_engine(db_engine).connect() as conn:
+            conn.execute("update ukb_pheno_0_00 set c21_0_0 = 'Not reloaded' where eid = 1")
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1)
+        p2sql.load_data()
+
+        # Validate
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine), index_col='eid')
+        assert tmp.shape[0] == 2
+        assert tmp.loc[1, 'c21_0_0'] == 'Option number 1'
+
+    def test_postgresql_incremental_load(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example17')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(os.path.join(directory, 'v1', 'example17.csv'), db_engine,
+                          n_columns_per_table=10, loading_n_jobs=1)
+        p2sql.load_data()
+
+        # Run
+        p2sql = Pheno2SQL(os.path.join(directory, 'v2', 'example17.csv'), db_engine,
+                          n_columns_per_table=10, loading_n_jobs=1)
+        p2sql.load_data(incremental=True)
+
+        # Validate
+        ## new column was added to the table with space left, and registered in fields
+        fields = pd.read_sql("select * from fields", create_engine(db_engine), index_col='column_name')
+        assert fields.shape[0] == 18 + 1
+        assert fields.loc['c50_0_0', 'table_name'] == 'ukb_pheno_0_01'
+        assert fields.loc['c50_0_0', 'type'] == 'Continuous'
+
+        ## changed and new rows
+        columns = ['c21_0_0', 'c50_0_0', 'c84_0_0', 'c84_0_1']
+        query_result = next(p2sql.query(columns))
+
+        assert query_result.shape[0] == 6
+        assert query_result.loc[1000010, 'c21_0_0'] == 'Option number 11'
+        assert query_result.loc[1000020, 'c21_0_0'] == 'Option number 2'
+        assert query_result.loc[1000060, 'c21_0_0'] == 'Option number 6'
+        assert query_result.loc[1000010, 'c50_0_0'] == 1.01
+        assert pd.isnull(query_result.loc[1000030, 'c50_0_0'])
+        assert query_result.loc[1000060, 'c50_0_0'] == 1.45
+        assert query_result.loc[1000030, 'c84_0_0'] == 'J45'
+        assert query_result.loc[1000060, 'c84_0_1'] == 'E103'
+
+        ## all_eids
+        all_eids = pd.read_sql('select * from all_eids', create_engine(db_engine), index_col='eid')
+        assert all_eids.shape[0] == 6
+        assert 1000060 in all_eids.index
+
+        ## events
+        events = pd.read_sql('select * from events where field_id = 84 order by eid, event', create_engine(db_engine))
+        assert events.loc[events['eid'] == 1000030, 'event'].tolist() == ['J45']
+        assert events.loc[events['eid'] == 1000060, 'event'].tolist() == ['E103']
+        assert sorted(events.loc[events['eid'] == 1000020, 'event'].tolist()) == ['E103', 'N308', 'Q750']
+        assert events.shape[0] == 3 + 1 + 1 + 1 + 1
+
+    def test_postgresql_incremental_load_new_file(self):
+        # Prepare
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(get_repository_path('pheno2sql/example17/v1/example17.csv'), db_engine,
+                          n_columns_per_table=10, loading_n_jobs=1)
+        p2sql.load_data()
+
+        # Run
+        p2sql = Pheno2SQL(get_repository_path('pheno2sql/example16/example1601.csv'), db_engine,
+                          n_columns_per_table=10, loading_n_jobs=1)
+        p2sql.load_data(incremental=True)
+
+        # Validate
+        ## only the new column was loaded, in a new table
+        fields = pd.read_sql("select * from fields", create_engine(db_engine), index_col='column_name')
+        assert fields.shape[0] == 18 + 1
+        assert fields.loc['c50_0_0', 'table_name'] == 'ukb_pheno_1_00'
+        assert fields.loc['c21_0_0', 'table_name'] == 'ukb_pheno_0_00'
+
+        tmp = pd.read_sql('select * from ukb_pheno_1_00', create_engine(db_engine), index_col='eid')
+        assert tmp.shape[0] == 7
+        assert tmp.loc[1000070, 'c50_0_0'] == 1.5
+
+        ## data of existing columns was not modified
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine), index_col='eid')
+        assert tmp.shape[0] == 5
+
+        all_eids = pd.read_sql('select * from all_eids', create_engine(db_engine), index_col='eid')
+        assert all_eids.shape[0] == 7
+
+    def _get_events_loaded_with(self, csv_file, db_engine, **kwargs):
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=5, loading_n_jobs=2, **kwargs)
+        p2sql.load_data()
+
+        return pd.read_sql('select * from events order by eid, field_id, instance, event', create_engine(db_engine))
+
+    def test_postgresql_events_built_while_loading(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example12/example12_diseases.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        # Run
+        events_data = self._get_events_loaded_with(csv_file, db_engine)
+
+        # Validate
+        assert events_data.shape[0] == 25
+
+        ## same value in two columns of the same field instance (split in different tables) is written once
+        tmp = events_data[(events_data['eid'] == 1000010) & (events_data['field_id'] == 85) & (events_data['instance'] == 2)]
+        assert tmp['event'].tolist() == ['1701']
+
+        tmp = events_data[(events_data['eid'] == 1000020) & (events_data['field_id'] == 84)]
+        assert tmp['instance'].tolist() == [0, 0, 1]
+        assert tmp['event'].tolist() == ['E103', 'N308', 'J32']
+
+        tmp = events_data[(events_data['eid'] == 1000060)]
+        assert tmp['field_id'].tolist() == [85, 85]
+        assert tmp['instance'].tolist() == [2, 2]
+        assert tmp['event'].tolist() == ['1114', '1136']
+
+        ## temporary events file was loaded too
+        tmp = pd.read_sql("select * from load_manifest where table_name = 'events'", create_engine(db_engine))
+        assert sorted(tmp['step'].tolist()) == ['copy', 'split']
+
+    def test_postgresql_events_built_while_loading_all_modes(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example12/example12_diseases.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        expected_events = self._get_events_loaded_with(csv_file, db_engine)
+        assert expected_events.shape[0] == 25
+
+        # Run and validate
+        for loading_options in ({'loading_single_pass': True}, {'loading_stream_copy': True},
+                                {'loading_stream_copy': True, 'loading_single_pass': True}):
+            events_data = self._get_events_loaded_with(csv_file, db_engine, **loading_options)
+            pd.testing.assert_frame_equal(events_data, expected_events)
+
+    def test_postgresql_events_resume_does_not_duplicate(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example12/example12_diseases.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=5, loading_n_jobs=1)
+        p2sql.load_data()
+
+        # simulate a failure after the events were copied, but before it was recorded
+        with create_engine(db_engine).connect() as conn:
+            conn.execute("delete from events where eid = 1000020")
+            conn.execute("delete from load_manifest where table_name = 'events'")
+            conn.execute("delete from load_manifest where csv_file = ''")
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=5, loading_n_jobs=1)
+        p2sql.load_data(resume=True)
+
+        # Validate
+        events_data = pd.read_sql('select * from events order by eid, field_id, instance, event', create_engine(db_engine))
+        assert events_data.shape[0] == 25
+        assert events_data[events_data['eid'] == 1000020].shape[0] == 6
+
+    def test_postgresql_events_field_instance_in_several_files(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example18')
+
+        csv_file1 = get_repository_path(os.path.join(directory, 'example18_00.csv'))
+        csv_file2 = get_repository_path(os.path.join(directory, 'example18_01.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=5, loading_n_jobs=1)
+
+        # Run
+        p2sql.load_data()
+
+        # Validate
+        ## column 84-0.5 was loaded from the second file
+        fields = pd.read_sql("select * from fields where field_id = '84' and inst = 0 order by arr", create_engine(db_engine))
+        assert fields['column_name'].tolist() == ['c84_0_0', 'c84_0_1', 'c84_0_2', 'c84_0_3', 'c84_0_4', 'c84_0_5']
+        assert fields['table_name'].tolist()[-1].startswith('ukb_pheno_1_')
+
+        ## events are not duplicated
+        events_data = pd.read_sql('select * from events where field_id = 84 and instance = 0 order by eid, event',
+                                  create_engine(db_engine))
+        assert events_data.shape[0] == 7
+        assert events_data.loc[events_data['eid'] == 1000020, 'event'].tolist() == ['E103', 'N308', 'Q750']
+        assert events_data.loc[events_data['eid'] == 1000030, 'event'].tolist() == ['K20', 'N308']
+        assert events_data.loc[events_data['eid'] == 1000050, 'event'].tolist() == ['E103']
+
+        ## events of other instances are written while loading
+        events_data = pd.read_sql('select * from events where field_id = 84 and instance = 1', create_engine(db_engine))
+        assert events_data.empty
+
+    def test_postgresql_array_columns_field_instance_in_several_files(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example18')
+
+        csv_file1 = get_repository_path(os.path.join(directory, 'example18_00.csv'))
+        csv_file2 = get_repository_path(os.path.join(directory, 'example18_01.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        columns = ['c21_0_0', 'c84_0_0', 'c84_0_5', 'c84_1_1']
+
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=5, loading_n_jobs=2)
+        p2sql.load_data()
+        scalar_result = pd.concat(p2sql.query(columns, ecolumns=['c84_0_.*']))
+        scalar_events = pd.read_sql('select * from events order by eid, field_id, instance, event',
+                                    create_engine(db_engine))
+
+        # Run
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=5, loading_n_jobs=2,
+                          loading_array_columns=True)
+        p2sql.load_data()
+
+        # Validate
+        ## instance 0 of field 84 is loaded from both files, so it is not stored in an array column
+        fields = pd.read_sql('select column_name, array_column from fields', create_engine(db_engine),
+                             index_col='column_name')
+        assert pd.isnull(fields.loc['c84_0_0', 'array_column'])
+        assert pd.isnull(fields.loc['c84_0_5', 'array_column'])
+        assert fields.loc['c84_1_1', 'array_column'] == 'c84_1'
+
+        events = pd.read_sql('select * from events order by eid, field_id, instance, event', create_engine(db_engine))
+        assert events[events['instance'] == 0].shape[0] == 7
+        pd.testing.assert_frame_equal(events, scalar_events)
+
+        array_result = pd.concat(p2sql.query(columns, ecolumns=['c84_0_.*']))
+        pd.testing.assert_frame_equal(array_result.sort_index(), scalar_result.sort_index())
+
+    def test_postgresql_several_files_loaded_concurrently_all_modes(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example18')
+
+        csv_file1 = get_repository_path(os.path.join(directory, 'example18_00.csv'))
+        csv_file2 = get_repository_path(os.path.join(directory, 'example18_01.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        loading_modes = (
+            {'loading_stream_copy': False, 'loading_single_pass': False},
+            {'loading_stream_copy': False, 'loading_single_pass': True},
+            {'loading_stream_copy': True, 'loading_single_pass': False},
+            {'loading_stream_copy': True, 'loading_single_pass': True},
+        )
+
+        for loading_mode in loading_modes:
+            p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=5, loading_n_jobs=4,
+                              **loading_mode)
+
+            # Run
+            p2sql.load_data()
+
+            # Validate
+            ## tables of both files were loaded and verified
+            manifest = pd.read_sql("select csv_file, table_name from load_manifest where step = 'verified'",
+                                   create_engine(db_engine))
+            assert sorted(manifest['csv_file'].unique().tolist()) == ['example18_00.csv', 'example18_01.csv'], loading_mode
+            assert all(manifest.loc[manifest['csv_file'] == 'example18_01.csv', 'table_name'].str.startswith('ukb_pheno_1_'))
+
+            fields = pd.read_sql("select * from fields where field_id = '84' and inst = 0 order by arr", create_engine(db_engine))
+            assert fields.shape[0] == 6, loading_mode
+            assert fields['table_name'].tolist()[-1].startswith('ukb_pheno_1_'), loading_mode
+
+            events_data = pd.read_sql('select * from events where field_id = 84 and instance = 0',
+                                      create_engine(db_engine))
+            assert events_data.shape[0] == 7, loading_mode
+
+            all_eids = pd.read_sql('select * from all_eids', create_engine(db_engine), index_col='eid')
+            assert all_eids.index.is_unique
+            assert 1000020 in all_eids.index
+
+    def test_postgresql_random_pheno_data(self):
+        # Prepare
+        data_dir = tempfile.mkdtemp(prefix='ukbrest_random_pheno')
+        csv_file = os.path.join(data_dir, 'ukb_random.csv')
+
+        fields = write_random_pheno(csv_file, 200, 12, max_instances=2, max_arrays=4, missing_rate=0.3,
+                                    chunksize=70, seed=1)
+
+        db_engine = POSTGRESQL_ENGINE
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=7, loading_n_jobs=2)
+
+        # Run
+        p2sql.load_data()
+
+        # Validate
+        csv_data = pd.read_csv(csv_file, index_col='eid', dtype=str)
+        assert csv_data.shape[0] == 200
+        assert csv_data.index.is_unique
+        assert csv_data.isnull().values.any()
+
+        db_fields = pd.read_sql('select * from fields', create_engine(db_engine), index_col='column_name')
+        assert db_fields.shape[0] == csv_data.shape[1]
+
+        for field in fields:
+            field_columns = db_fields[db_fields['field_id'] == str(field['field_id'])]
+            assert field_columns.shape[0] == field['n_instances'] * field['n_arrays']
+            assert all(field_columns['type'] == field['type'])
+
+            if field['coding'] is not None:
+                assert all(field_columns['coding'] == field['coding'])
+                assert ' Uses data-coding {} '.format(field['coding']) in field['description']
+
+            assert all(field_columns['description'] == 'Random {} field {}'.format(field['type'].lower(),
+                                                                                  field['field_id']))
+
+        all_eids = pd.read_sql('select * from all_eids', create_engine(db_engine))
+        assert all_eids.shape[0] == 200
+
+        ## one event for each value of categorical (multiple) fields (they are distinct within an instance)
+        multiple_columns = [c for c in csv_data.columns if db_fields.loc[p2sql._rename_columns(c), 'type'] == 'Categorical (multiple)']
+        events = pd.read_sql('select count(*) as n from events', create_engine(db_engine))
+        assert events.loc[0, 'n'] == csv_data.loc[:, multiple_columns].notnull().values.sum()
 
-        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine), index_col='eid')
-        assert not tmp.empty
-        assert tmp.shape[0] == 2
-        assert tmp.loc[1, 'c31_0_0'] == '2012-01-05'
-        assert int(tmp.loc[1, 'c34_0_0']) == 21
-        assert int(tmp.loc[1, 'c46_0_0']) == -9
-        assert tmp.loc[2, 'c31_0_0'] == '2015-12-30'
-        assert int(tmp.loc[2, 'c34_0_0']) == 12
-        assert int(tmp.loc[2, 'c46_0_0']) == -2
+        ## arrays are filled from the left
+        for column in multiple_columns:
+            field_id, instance_array = column.split('-')
+            instance, array = instance_array.split('.')
 
-        tmp = pd.read_sql('select * from ukb_pheno_0_02', create_engine(db_engine), index_col='eid')
-        assert not tmp.empty
-        assert tmp.shape[0] == 2
-        assert tmp.loc[1, 'c47_0_0'].round(5) == 45.55412
-        assert tmp.loc[1, 'c48_0_0'] == '2011-08-14'
-        assert tmp.loc[2, 'c47_0_0'].round(5) == -0.55461
-        assert tmp.loc[2, 'c48_0_0'] == '2010-03-29'
+            if int(array) > 0:
+                previous_column = '{}-{}.{}'.format(field_id, instance, int(array) - 1)
+                assert not (csv_data[column].notnull() & csv_data[previous_column].isnull()).any()
 
-    def test_postgresql_less_columns_per_table(self):
+        shutil.rmtree(data_dir)
+
+    def test_data_dictionary_is_cached(self):
         # Prepare
-        csv_file = get_repository_path('pheno2sql/example01.csv')
+        data_dir = tempfile.mkdtemp(prefix='ukbrest_dictionary')
+        csv_file = os.path.join(data_dir, 'example01.csv')
+        html_file = os.path.join(data_dir, 'example01.html')
+        shutil.copyfile(get_repository_path('pheno2sql/example01.csv'), csv_file)
+        shutil.copyfile(get_repository_path('pheno2sql/example01.html'), html_file)
         db_engine = POSTGRESQL_ENGINE
 
-        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3)
+        p2sql = Pheno2SQL(csv_file, db_engine)
 
         # Run
         p2sql.load_data()
 
         # Validate
-        assert p2sql.db_type == 'postgresql'
+        cache_file = os.path.join(data_dir, 'example01.dictionary.json')
+        assert os.path.isfile(cache_file)
+
+        with open(cache_file, 'r') as f:
+            cache_data = json.load(f)
+
+        assert cache_data['sha256'] == p2sql._get_file_hash(html_file)
+        assert len(cache_data['columns']) == 11
+        assert cache_data['columns']['21-0.0']['type'] == 'Categorical (single)'
+        assert cache_data['columns']['21-0.0']['description'] == 'An string value'
+        assert cache_data['columns']['21-0.0']['coding'] == 100261
+        assert cache_data['columns']['46-0.0']['type'] == 'Integer'
+        assert cache_data['columns']['46-0.0']['coding'] is None
+
+        ## Check the cache is used when the HTML file has not changed
+        cache_data['columns']['46-0.0']['type'] = 'Text'
+        with open(cache_file, 'w') as f:
+            json.dump(cache_data, f)
+
+        db_types, fields_types, fields_descriptions, fields_codings = p2sql._get_db_columns_dtypes(csv_file)
+        assert fields_types['c46_0_0'] == 'Text'
+        assert fields_types['c47_0_0'] == 'Continuous'
+        assert fields_descriptions['c21_0_0'] == 'An string value'
+        assert fields_codings['c21_0_0'] == 100261
+        assert fields_codings['c34_0_0'] == 9
+        assert 'c46_0_0' not in fields_codings
+
+        ## Check the table fields is the same as without cache
+        fields = pd.read_sql("select * from fields where column_name = 'c21_0_0'", create_engine(db_engine))
+        assert fields.shape[0] == 1
+        assert fields.loc[0, 'type'] == 'Categorical (single)'
+        assert fields.loc[0, 'description'] == 'An string value'
+        assert fields.loc[0, 'coding'] == 100261
+
+        shutil.rmtree(data_dir)
+
+    def test_data_dictionary_cache_invalidated_when_html_changes(self):
+        # Prepare
+        data_dir = tempfile.mkdtemp(prefix='ukbrest_dictionary')
+        csv_file = os.path.join(data_dir, 'example01.csv')
+        html_file = os.path.join(data_dir, 'example01.html')
+        shutil.copyfile(get_repository_path('pheno2sql/example01.csv'), csv_file)
+        shutil.copyfile(get_repository_path('pheno2sql/example01.html'), html_file)
+        db_engine = POSTGRESQL_ENGINE
 
-        ## Check tables exist
-        table = pd.read_sql("SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename = '{}');".format('ukb_pheno_0_00'), create_engine(db_engine))
-        assert table.iloc[0, 0]
+        p2sql = Pheno2SQL(csv_file, db_engine)
+        db_types, fields_types, _, _ = p2sql._get_db_columns_dtypes(csv_file)
+        assert fields_types['c46_0_0'] == 'Integer'
 
-        table = pd.read_sql("SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename = '{}');".format('ukb_pheno_0_01'), create_engine(db_engine))
-        assert table.iloc[0, 0]
+        with open(html_file, 'r', encoding='latin1') as f:
+            html_content = f.read()
 
-        table = pd.read_sql("SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename = '{}');".format('ukb_pheno_0_02'), create_engine(db_engine))
-        assert table.iloc[0, 0]
+        html_content = html_content.replace(
+            '<span style="white-space: nowrap;">Integer</span></td><td rowspan="3">Some another integer',
+            '<span style="white-space: nowrap;">Continuous</span></td><td rowspan="3">Some another integer'
+        )
 
-        ## Check columns are correct
-        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine))
-        expected_columns = ["eid","c21_0_0","c21_1_0","c21_2_0"]
-        assert len(tmp.columns) == len(expected_columns)
-        assert all(x in expected_columns for x in tmp.columns)
+        with open(html_file, 'w', encoding='latin1') as f:
+            f.write(html_content)
 
-        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine))
-        expected_columns = ["eid","c31_0_0","c34_0_0","c46_0_0"]
-        assert len(tmp.columns) == len(expected_columns)
-        assert all(x in expected_columns for x in tmp.columns)
+        # Run
+        db_types, fields_types, _, _ = p2sql._get_db_columns_dtypes(csv_file)
 
-        tmp = pd.read_sql('select * from ukb_pheno_0_02', create_engine(db_engine))
-        expected_columns = ["eid","c47_0_0","c48_0_0"]
-        assert len(tmp.columns) == len(expected_columns)
-        assert all(x in expected_columns for x in tmp.columns)
+        # Validate
+        assert fields_types['c46_0_0'] == 'Continuous'
 
-        ## Check data is correct
-        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine), index_col='eid')
-        assert not tmp.empty
-        assert tmp.shape[0] == 2
-        assert tmp.loc[1, 'c21_0_0'] == 'Option number 1'
-        assert tmp.loc[1, 'c21_1_0'] == 'No response'
-        assert tmp.loc[1, 'c21_2_0'] == 'Yes'
-        assert tmp.loc[2, 'c21_0_0'] == 'Option number 2'
-        assert pd.isnull(tmp.loc[2, 'c21_1_0'])
-        assert tmp.loc[2, 'c21_2_0'] == 'No'
+        with open(os.path.join(data_dir, 'example01.dictionary.json'), 'r') as f:
+            cache_data = json.load(f)
 
-        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine), index_col='eid')
-        assert not tmp.empty
-        assert tmp.shape[0] == 2
-        assert tmp.loc[1, 'c31_0_0'].strftime('%Y-%m-%d') == '2012-01-05'
-        assert int(tmp.loc[1, 'c34_0_0']) == 21
-        assert int(tmp.loc[1, 'c46_0_0']) == -9
-        assert tmp.loc[2, 'c31_0_0'].strftime('%Y-%m-%d') == '2015-12-30'
-        assert int(tmp.loc[2, 'c34_0_0']) == 12
-        assert int(tmp.loc[2, 'c46_0_0']) == -2
+        assert cache_data['sha256'] == p2sql._get_file_hash(html_file)
+        assert cache_data['columns']['46-0.0']['type'] == 'Continuous'
 
-        tmp = pd.read_sql('select * from ukb_pheno_0_02', create_engine(db_engine), index_col='eid')
-        assert not tmp.empty
-        assert tmp.shape[0] == 2
-        assert tmp.loc[1, 'c47_0_0'].round(5) == 45.55412
-        assert tmp.loc[1, 'c48_0_0'].strftime('%Y-%m-%d') == '2011-08-14'
-        assert tmp.loc[2, 'c47_0_0'].round(5) == -0.55461
-        assert tmp.loc[2, 'c48_0_0'].strftime('%Y-%m-%d') == '2010-03-29'
+        shutil.rmtree(data_dir)
 
     def test_custom_tmpdir(self):
         # Prepare
@@ -298,7 +1483,6 @@ class Pheno2SQLTest(DBTest):
         ## Check that temporary is now clean
         assert len(os.listdir('/tmp/custom/directory/here')) == 0
 
-    @unittest.skip('sqlite being removed')
     def test_sqlite_auxiliary_table_is_created(self):
         # Prepare
         csv_file = get_repository_path('pheno2sql/example01.csv')
@@ -677,7 +1861,6 @@ class Pheno2SQLTest(DBTest):
         assert tmp.loc[3, 'c140_0_0'].strftime('%Y-%m-%d') == '1997-04-15'
         assert pd.isnull(tmp.loc[3, 'c150_0_0'])
 
-    @unittest.skip('sqlite being removed')
     def test_sqlite_query_single_table(self):
         # Prepare
         csv_file = get_repository_path('pheno2sql/example02.csv')
@@ -986,10 +2169,46 @@ class Pheno2SQLTest(DBTest):
         assert pd.isnull(query_result.loc[4, 'c150_0_0'])
         assert pd.isnull(query_result.loc[5, 'c150_0_0'])
 
-    @unittest.skip('sqlite being removed')
     def test_sqlite_query_custom_columns(self):
-        # SQLite is very limited when selecting variables, renaming, doing math operations, etc
-        pass
+        # SQLite is very limited when selecting variables, renaming, doing math operations, etc: only simple
+        # expressions are tested
+
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example02.csv')
+        db_engine = SQLITE_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=999999)
+        p2sql.load_data()
+
+        # Run
+        columns = ['c21_0_0', 'c21_2_0 as c21_renamed', 'c47_0_0', '(c47_0_0 * c47_0_0) as c47_squared',
+                   '(c34_0_0 + c46_0_0) as c34_plus_c46']
+
+        query_result = next(p2sql.query(columns))
+
+        # Validate
+        assert query_result is not None
+
+        assert query_result.index.name == 'eid'
+        assert query_result.index.tolist() == [1, 2, 3, 4]
+        assert query_result.columns.tolist() == ['c21_0_0', 'c21_renamed', 'c47_0_0', 'c47_squared', 'c34_plus_c46']
+
+        assert query_result.loc[1, 'c21_0_0'] == 'Option number 1'
+        assert query_result.loc[4, 'c21_0_0'] == 'Option number 4'
+
+        assert query_result.loc[1, 'c21_renamed'] == 'Yes'
+        assert query_result.loc[3, 'c21_renamed'] == 'Maybe'
+        ## missing values were loaded as NULL
+        assert pd.isnull(query_result.loc[4, 'c21_renamed'])
+
+        assert query_result.loc[1, 'c47_0_0'].round(5) == 45.55412
+        assert query_result.loc[1, 'c47_squared'].round(5) == round(45.55412 ** 2, 5)
+        assert query_result.loc[2, 'c47_squared'].round(5) == round((-0.55461) ** 2, 5)
+        assert query_result.loc[3, 'c47_squared'].round(5) == round((-5.32471) ** 2, 5)
+        assert query_result.loc[4, 'c47_squared'].round(5) == round(55.19832 ** 2, 5)
+
+        ## integer columns keep their values
+        assert query_result['c34_plus_c46'].tolist() == [12, 10, -6, 21]
 
     def test_postgresql_query_custom_columns(self):
         # Prepare
@@ -1185,7 +2404,6 @@ class Pheno2SQLTest(DBTest):
         assert query_result.loc[1, 'c48_0_0'].strftime('%Y-%m-%d') == '2011-08-14'
         assert query_result.loc[2, 'c48_0_0'].strftime('%Y-%m-%d') == '2016-11-30'
 
-    @unittest.skip('sqlite being removed')
     def test_sqlite_float_is_empty(self):
         # Prepare
         csv_file = get_repository_path('pheno2sql/example03.csv')
@@ -1526,6 +2744,48 @@ class Pheno2SQLTest(DBTest):
 
         assert index_len_sum == 4
 
+    def test_postgresql_query_streamed_from_server_side_cursor(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example02.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3)
+        p2sql.load_data()
+
+        # no sql_chunksize set
+        p2sql.QUERY_CHUNKSIZE = 3
+
+        # Run
+        columns = ['c21_0_0', 'c21_2_0', 'c48_0_0']
+
+        query_result = p2sql.query(columns)
+        first_chunk = next(query_result)
+
+        # Validate
+        # the rows are fetched from a cursor that is still open
+        queries = pd.read_sql("""
+            select query from pg_stat_activity
+            where datname = current_database() and pid <> pg_backend_pid() and query ilike 'fetch forward%%'
+        """, create_engine(db_engine))
+        assert queries.shape[0] == 1
+        assert queries.loc[0, 'query'].lower().startswith('fetch forward 3 ')
+
+        assert first_chunk.index.name == 'eid'
+        assert first_chunk.index.tolist() == [1, 2, 3]
+        assert first_chunk.columns.tolist() == columns
+
+        other_chunks = list(query_result)
+        assert len(other_chunks) == 1
+        assert other_chunks[0].index.tolist() == [4]
+        assert other_chunks[0].loc[4, 'c48_0_0'].strftime('%Y-%m-%d') == '2011-02-15'
+
+        # empty results keep their columns
+        query_result = list(p2sql.query(columns, filterings=["c21_2_0 = 'Unknown'"]))
+        assert len(query_result) == 1
+        assert query_result[0].empty
+        assert query_result[0].index.name == 'eid'
+        assert query_result[0].columns.tolist() == columns
+
     def test_postgresql_all_eids_table_created(self):
         # Prepare
         directory = get_repository_path('pheno2sql/example14')
@@ -1567,6 +2827,37 @@ class Pheno2SQLTest(DBTest):
         assert 1000061 in all_eids.index
         assert 1000070 in all_eids.index
 
+    def test_postgresql_all_eids_loaded_per_file(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example14')
+
+        csv_file1 = get_repository_path(os.path.join(directory, 'example14_00.csv'))
+        csv_file2 = get_repository_path(os.path.join(directory, 'example14_01.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=2, loading_n_jobs=1)
+        p2sql.load_data()
+
+        manifest = pd.read_sql("select * from load_manifest where table_name = 'all_eids'", create_engine(db_engine))
+        assert sorted(manifest['csv_file'].tolist()) == ['example14_00.csv', 'example14_01.csv']
+
+        # simulate a failure before eids of the second file were added
+        with create_engine(db_engine).connect() as conn:
+            conn.execute("delete from all_eids where eid in (1000020, 1000040, 1000070)")
+            conn.execute("delete from load_manifest where table_name = 'all_eids' and csv_file = 'example14_01.csv'")
+
+        # Run
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=2, loading_n_jobs=1)
+        p2sql.load_data(resume=True)
+
+        # Validate
+        all_eids = pd.read_sql('select * from all_eids', create_engine(db_engine), index_col='eid')
+        assert len(all_eids.index) == 6 + 4
+        assert all_eids.index.is_unique
+        assert 1000020 in all_eids.index
+        assert 1000040 in all_eids.index
+        assert 1000070 in all_eids.index
+
     def test_postgresql_all_eids_table_constraints(self):
         # Prepare
         directory = get_repository_path('pheno2sql/example14')
@@ -2097,6 +3388,212 @@ class Pheno2SQLTest(DBTest):
         assert constraints_results is not None
         assert not constraints_results.empty
 
+    def test_postgresql_primary_keys_created_after_loading(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example12')
+
+        csv_file = get_repository_path(os.path.join(directory, 'example12_diseases.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=15, loading_n_jobs=1)
+
+        # Run
+        ## there are no indexes before data is loaded
+        p2sql._init_load_manifest(resume=False)
+        p2sql._create_all_eids_table()
+        p2sql._create_events_table()
+        p2sql._loading_tmp['existing_col_names'] = p2sql._get_existing_col_names()
+        p2sql._loading_tmp['shared_fields_instances'] = p2sql._get_shared_fields_instances()
+        p2sql._loading_tmp['baskets'] = {}
+        p2sql._create_tables_schema(csv_file, 0)
+
+        tmp = pd.read_sql(self._get_table_contrains('ukb_pheno_0_00'), create_engine(db_engine))
+        assert tmp.empty
+
+        tmp = pd.read_sql(self._get_table_contrains('events'), create_engine(db_engine))
+        assert tmp.empty
+
+        ## builds are run concurrently
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=15, loading_n_jobs=1, loading_index_n_jobs=3,
+                          loading_index_memory='32MB')
+        p2sql.load_data()
+
+        # Validate
+        for table_name in ('ukb_pheno_0_00', 'ukb_pheno_0_01'):
+            constraints_results = pd.read_sql(self._get_table_contrains(table_name, column_query='eid', relationship_query='pk_%%'),
+                                              create_engine(db_engine))
+            assert constraints_results.shape[0] == 1
+
+        constraints_results = pd.read_sql(self._get_table_contrains('events', relationship_query='pk_%%'),
+                                          create_engine(db_engine), index_col='index_name')
+        assert sorted(constraints_results.loc['pk_events', 'column_name'].tolist()) == ['eid', 'event', 'field_id', 'instance']
+
+        constraints_results = pd.read_sql(self._get_table_contrains('events', relationship_query='ix_%%'),
+                                          create_engine(db_engine))
+        assert len(set(constraints_results['index_name'])) == 5
+
+        ## data was loaded
+        tmp = pd.read_sql('select count(*) as n from ukb_pheno_0_01', create_engine(db_engine))
+        assert tmp.loc[0, 'n'] == 6
+
+    def test_postgresql_primary_keys_missing_built_on_resume(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example12')
+
+        csv_file = get_repository_path(os.path.join(directory, 'example12_diseases.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=15, loading_n_jobs=1)
+        p2sql.load_data()
+
+        # simulate a failure while building indexes
+        with create_engine(db_engine).connect() as conn:
+            conn.execute('ALTER TABLE ukb_pheno_0_01 DROP CONSTRAINT pk_ukb_pheno_0_01')
+            conn.execute('DROP INDEX ix_events_field_id_event')
+            conn.execute("delete from load_manifest where table_name = 'constraints'")
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=15, loading_n_jobs=1, loading_index_n_jobs=2)
+        p2sql.load_data(resume=True)
+
+        # Validate
+        constraints_results = pd.read_sql(self._get_table_contrains('ukb_pheno_0_01', column_query='eid', relationship_query='pk_%%'),
+                                          create_engine(db_engine))
+        assert constraints_results.shape[0] == 1
+
+        constraints_results = pd.read_sql(self._get_table_contrains('events', relationship_query='ix_events_field_id_event'),
+                                          create_engine(db_engine))
+        assert sorted(constraints_results['column_name'].tolist()) == ['event', 'field_id']
+
+    def _get_tables_persistence(self, db_engine, schema='public'):
+        return pd.read_sql("""
+            select c.relname as table_name, c.relpersistence
+            from pg_class c join pg_namespace n on n.oid = c.relnamespace
+            where c.relkind = 'r' and n.nspname = '{}'
+        """.format(schema), create_engine(db_engine), index_col='table_name')['relpersistence']
+
+    def test_postgresql_staging_schema_replaces_live_tables(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example14')
+
+        csv_file1 = get_repository_path(os.path.join(directory, 'example14_00.csv'))
+        csv_file2 = get_repository_path(os.path.join(directory, 'example14_01.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, bgen_sample_file=os.path.join(directory, 'impv2.sample'),
+                          n_columns_per_table=2, loading_n_jobs=1)
+        p2sql.load_data()
+
+        live_fields = pd.read_sql('select * from fields', create_engine(db_engine))
+        assert live_fields['table_name'].str.startswith('ukb_pheno_1_').any()
+
+        # Run
+        ## a load that fails does not modify live tables
+        p2sql = Pheno2SQL(csv_file1, db_engine, bgen_sample_file=os.path.join(directory, 'impv2.sample'),
+                          n_columns_per_table=2, loading_n_jobs=1, loading_staging_schema='ukbrest_staging')
+
+        def _create_constraints_failing():
+            raise ValueError('failed')
+
+        p2sql._create_constraints = _create_constraints_failing
+
+        with self.assertRaises(ValueError):
+            p2sql.load_data()
+
+        assert pd.read_sql('select * from fields', create_engine(db_engine)).shape == live_fields.shape
+        assert all(self._get_tables_persistence(db_engine) == 'p')
+
+        staging_tables = self._get_tables_persistence(db_engine, 'ukbrest_staging')
+        assert 'ukb_pheno_0_00' in staging_tables.index
+        assert 'ukb_pheno_1_00' not in staging_tables.index
+        assert all(staging_tables == 'u')
+
+        ## the load is resumed and staging tables replace live ones
+        p2sql = Pheno2SQL(csv_file1, db_engine, bgen_sample_file=os.path.join(directory, 'impv2.sample'),
+                          n_columns_per_table=2, loading_n_jobs=1, loading_staging_schema='ukbrest_staging')
+        p2sql.load_data(resume=True)
+
+        # Validate
+        assert self._get_tables_persistence(db_engine, 'ukbrest_staging').empty
+
+        live_tables = self._get_tables_persistence(db_engine)
+        assert all(live_tables == 'p')
+        assert 'ukb_pheno_0_00' in live_tables.index
+        assert 'ukb_pheno_1_00' not in live_tables.index
+        assert BGEN_SAMPLES_TABLE in live_tables.index
+
+        fields = pd.read_sql('select * from fields', create_engine(db_engine))
+        assert fields['table_name'].str.startswith('ukb_pheno_0_').all()
+
+        constraints_results = pd.read_sql(self._get_table_contrains('ukb_pheno_0_00', column_query='eid', relationship_query='pk_%%'),
+                                          create_engine(db_engine))
+        assert constraints_results.shape[0] == 1
+
+        stats = pd.read_sql("select * from pg_stats where schemaname = 'public' and tablename = 'ukb_pheno_0_00'",
+                            create_engine(db_engine))
+        assert not stats.empty
+
+        query_result = next(p2sql.query(['c102_0_0', 'c103_0_0']))
+        assert len(query_result.index) == 6
+
+    def test_postgresql_staging_schema_keeps_samples_data(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example14')
+
+        csv_file1 = get_repository_path(os.path.join(directory, 'example14_00.csv'))
+        csv_file2 = get_repository_path(os.path.join(directory, 'example14_01.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=2, loading_n_jobs=1)
+        p2sql.load_data()
+
+        pl = Postloader(db_engine)
+        pl.load_samples_data(get_repository_path('postloader/samples_data01'))
+
+        samplesqc = pd.read_sql('select * from samplesqc', create_engine(db_engine), index_col='eid')
+
+        # Run
+        p2sql = Pheno2SQL(csv_file1, db_engine, n_columns_per_table=2, loading_n_jobs=1,
+                          loading_staging_schema='ukbrest_staging')
+        p2sql.load_data()
+
+        # Validate
+        live_tables = self._get_tables_persistence(db_engine)
+        assert 'ukb_pheno_0_00' in live_tables.index
+        assert 'ukb_pheno_1_00' not in live_tables.index
+        assert 'samplesqc' in live_tables.index
+
+        ## samples data is untouched and still registered in the fields table
+        pd.testing.assert_frame_equal(pd.read_sql('select * from samplesqc', create_engine(db_engine), index_col='eid'),
+                                      samplesqc)
+
+        fields = pd.read_sql('select * from fields', create_engine(db_engine), index_col='column_name')
+        assert fields.loc['ccolumn_name_0_0', 'table_name'] == 'samplesqc'
+        assert not fields['table_name'].str.startswith('ukb_pheno_1_').any()
+
+        query_result = next(p2sql.query(['c102_0_0', 'ccolumn_name_0_0']))
+        assert query_result.loc[2222240, 'ccolumn_name_0_0'] == samplesqc.loc[2222240, 'ccolumn_name_0_0']
+
+    def test_postgresql_staging_schema_keep_unlogged(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example12')
+
+        csv_file = get_repository_path(os.path.join(directory, 'example12_diseases.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=15, loading_n_jobs=2, loading_stream_copy=True,
+                          loading_staging_schema='ukbrest_staging', loading_keep_unlogged=True)
+
+        # Run
+        p2sql.load_data()
+
+        # Validate
+        live_tables = self._get_tables_persistence(db_engine)
+        assert all(live_tables[['ukb_pheno_0_00', 'ukb_pheno_0_01', 'fields', 'events', ALL_EIDS_TABLE]] == 'u')
+
+        tmp = pd.read_sql('select count(*) as n from ukb_pheno_0_01', create_engine(db_engine))
+        assert tmp.loc[0, 'n'] == 6
+
     def test_postgresql_vacuum(self):
         # Prepare
         directory = get_repository_path('pheno2sql/example12')
@@ -2163,6 +3660,61 @@ class Pheno2SQLTest(DBTest):
         assert query_result.loc[1000050, 'c221_0_0'] == 'Option number 25'
         assert query_result.loc[1000050, 'c221_1_0'] == 'Maybe ñó'
 
+    def test_postgresql_load_data_compressed_files_all_modes(self):
+        # Prepare
+        ## same files as example15 (with non-utf characters), compressed; encodings.txt lists uncompressed names
+        directory = tempfile.mkdtemp(prefix='ukbrest_compressed')
+        shutil.copytree(get_repository_path('pheno2sql/example15'), os.path.join(directory, 'example15'))
+        directory = os.path.join(directory, 'example15')
+
+        with open(os.path.join(directory, 'example15_00.csv'), 'rb') as f_in, \
+                gzip.open(os.path.join(directory, 'example15_00.csv.gz'), 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(os.path.join(directory, 'example15_00.csv'))
+
+        csv_files = [os.path.join(directory, 'example15_00.csv.gz'), os.path.join(directory, 'example15_01.csv'),
+                     os.path.join(directory, 'example15_02.csv')]
+
+        if shutil.which('zstd') is not None:
+            Popen(['zstd', '-q', '--rm', os.path.join(directory, 'example15_01.csv')]).wait()
+            csv_files[1] += '.zst'
+
+        db_engine = POSTGRESQL_ENGINE
+
+        loading_modes = (
+            {'loading_stream_copy': False, 'loading_single_pass': False},
+            {'loading_stream_copy': False, 'loading_single_pass': True},
+            {'loading_stream_copy': True, 'loading_single_pass': False},
+            {'loading_stream_copy': True, 'loading_single_pass': True},
+        )
+
+        for loading_mode in loading_modes:
+            p2sql = Pheno2SQL(csv_files, db_engine, bgen_sample_file=os.path.join(directory, 'impv2.sample'),
+                              n_columns_per_table=2, loading_n_jobs=2, loading_chunksize=3, **loading_mode)
+
+            # Run
+            p2sql.load_data()
+
+            columns = ['c21_1_0', 'c21_0_0', 'c103_0_0', 'c104_0_0', 'c221_0_0', 'c221_1_0']
+
+            query_result = next(p2sql.query(columns))
+
+            # Validate
+            assert len(query_result.index) == 10, loading_mode
+
+            assert query_result.loc[1000041, 'c103_0_0'] == 'Optión 4'
+            assert query_result.loc[1000041, 'c104_0_0'] == '158'
+
+            assert query_result.loc[1000070, 'c21_1_0'] == 'Of course ñ'
+            assert query_result.loc[1000070, 'c21_0_0'] == 'Option number 7'
+
+            assert query_result.loc[1000050, 'c221_0_0'] == 'Option number 25'
+            assert query_result.loc[1000050, 'c221_1_0'] == 'Maybe ñó'
+
+            ## data dictionary was found for compressed files
+            fields = pd.read_sql("select * from fields where column_name = 'c21_0_0'", create_engine(db_engine))
+            assert fields.loc[0, 'type'] == 'Categorical (single)'
+
     def test_postgresql_load_data_with_duplicated_data_field(self):
         # Prepare
         directory = get_repository_path('pheno2sql/example16')
@@ -1,5 +1,6 @@
 import io
 import json
+import os
 import unittest
 import tempfile
 from base64 import b64encode
@@ -10,6 +11,9 @@ import pandas as pd
 from tests.settings import POSTGRESQL_ENGINE
 from tests.utils import get_repository_path, DBTest
 from ukbrest.common.pheno2sql import Pheno2SQL
+from ukbrest.common.postloader import Postloader
+from ukbrest.common.utils.copy_stream import get_csv_column_sql, FLOAT8_OID
+from ukbrest.common.utils.result_cache import ResultCache
 from ukbrest.common.utils.auth import PasswordHasher
 
 
@@ -109,6 +113,127 @@ class TestRestApiPhenotype(DBTest):
         fields = json.loads(response.data.decode('utf-8'))
         assert len(fields) == 8
 
+    def test_phenotype_fields_stats(self):
+        # Prepare
+        self.setUp('pheno2sql/example09_with_arrays.csv', loading_field_stats=True)
+
+        # Run
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/fields/stats', query_string={
+            'columns': ['c21_1_0', 'c47_0_0'],
+        })
+
+        # Validate
+        assert response.status_code == 200, response.status_code
+
+        field_stats = json.loads(response.data.decode('utf-8'))
+        assert sorted(field_stats.keys()) == ['c21_1_0', 'c47_0_0']
+
+        assert field_stats['c21_1_0']['n_rows'] == 5
+        assert field_stats['c21_1_0']['n_nulls'] == 1
+        assert field_stats['c21_1_0']['n_distinct'] == 4
+        assert field_stats['c21_1_0']['histogram']['counts'] == [1, 1, 1, 1]
+
+        assert field_stats['c47_0_0']['min_value'] == '-35.31471'
+        assert field_stats['c47_0_0']['max_value'] == '41.55312'
+        assert sum(field_stats['c47_0_0']['histogram']['counts']) == 4
+
+    def test_phenotype_fields_stats_not_loaded(self):
+        # Prepare
+        # Run
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/fields/stats')
+
+        # Validate
+        assert response.status_code == 400, response.status_code
+
+    def test_phenotype_query_result_cache(self):
+        # Prepare
+        cache_dir = tempfile.mkdtemp(prefix='ukbrest_result_cache')
+        app.app.config['result_cache'] = ResultCache(cache_dir, 1024 ** 2)
+
+        # responses are streamed: results are cached once their data is read
+        def _get_phenotype(columns, filters, accept='text/csv'):
+            response = self.app.get('/ukbrest/api/v1.0/phenotype', query_string={
+                'columns': columns,
+                'filters': filters,
+            }, headers={'accept': accept})
+            response.get_data()
+
+            return response
+
+        yaml_data = b"""
+        samples_filters:
+          - c47_0_0 > 0
+
+        covariates:
+          field_name_34: c34_0_0
+          field_name_47: c47_0_0
+        """
+
+        def _post_query():
+            response = self.app.post('/ukbrest/api/v1.0/query', data={
+                'file': (io.BytesIO(yaml_data), 'data.yaml'),
+                'section': 'covariates',
+            }, headers={'accept': 'text/csv'})
+            response.get_data()
+
+            return response
+
+        try:
+            # Run
+            first_response = _get_phenotype(['c21_0_0', 'c48_0_0'], ['c47_0_0 > 0', 'c46_0_0 < 0'])
+            cached_response = _get_phenotype(['c21_0_0', 'c48_0_0'], ['c46_0_0 < 0 ', 'c47_0_0 > 0'])
+            other_columns_response = _get_phenotype(['c48_0_0', 'c21_0_0'], ['c47_0_0 > 0', 'c46_0_0 < 0'])
+            other_format_response = _get_phenotype(['c21_0_0', 'c48_0_0'], ['c47_0_0 > 0', 'c46_0_0 < 0'],
+                                                   accept='text/plink2')
+
+            first_query_response = _post_query()
+            cached_query_response = _post_query()
+
+            # Validate
+            for response in (first_response, cached_response, other_columns_response, other_format_response,
+                             first_query_response, cached_query_response):
+                assert response.status_code == 200, response.status_code
+
+            assert first_response.headers['X-Ukbrest-Cache'] == 'MISS'
+            assert cached_response.headers['X-Ukbrest-Cache'] == 'HIT'
+            assert cached_response.data == first_response.data
+
+            assert other_columns_response.headers['X-Ukbrest-Cache'] == 'MISS'
+            assert other_columns_response.data.decode('utf-8').startswith('eid,c48_0_0,c21_0_0')
+            assert other_format_response.headers['X-Ukbrest-Cache'] == 'MISS'
+            assert other_format_response.data != first_response.data
+
+            assert first_query_response.headers['X-Ukbrest-Cache'] == 'MISS'
+            assert cached_query_response.headers['X-Ukbrest-Cache'] == 'HIT'
+            assert cached_query_response.data == first_query_response.data
+
+            # postloader steps change the data version, so results are computed again, even before the fields
+            # catalog checks it
+            app.app.config['pheno2sql'].fields_catalog_check_interval = 3600
+            Postloader(POSTGRESQL_ENGINE).load_codings(get_repository_path('postloader/codings01'))
+
+            new_version_response = _get_phenotype(['c21_0_0', 'c48_0_0'], ['c47_0_0 > 0', 'c46_0_0 < 0'])
+            assert new_version_response.headers['X-Ukbrest-Cache'] == 'MISS'
+            assert new_version_response.data == first_response.data
+
+            # least recently used results are removed first
+            result_files = [os.path.join(root, f) for root, dirs, files in os.walk(cache_dir) for f in files]
+            assert len(result_files) == 5
+
+            app.app.config['result_cache'].max_size = sum(os.path.getsize(f) for f in result_files)
+            assert _get_phenotype(['c21_0_0', 'c48_0_0'], ['c47_0_0 > 0', 'c46_0_0 < 0']).headers['X-Ukbrest-Cache'] == 'HIT'
+            assert _get_phenotype(['c21_0_0'], None).headers['X-Ukbrest-Cache'] == 'MISS'
+
+            result_files = [os.path.join(root, f) for root, dirs, files in os.walk(cache_dir) for f in files]
+            assert len(result_files) < 6
+            assert sum(os.path.getsize(f) for f in result_files) <= app.app.config['result_cache'].max_size
+
+            assert _get_phenotype(['c21_0_0'], None).headers['X-Ukbrest-Cache'] == 'HIT'
+            assert _get_phenotype(['c21_0_0', 'c48_0_0'], ['c47_0_0 > 0', 'c46_0_0 < 0']).headers['X-Ukbrest-Cache'] == 'HIT'
+            assert _get_phenotype(['c48_0_0', 'c21_0_0'], ['c47_0_0 > 0', 'c46_0_0 < 0']).headers['X-Ukbrest-Cache'] == 'MISS'
+        finally:
+            del app.app.config['result_cache']
+
     def test_phenotype_fields_http_auth_no_credentials(self):
         # Prepare
         self.configureAppWithAuth('user: thepassword2')
@@ -1922,6 +2047,145 @@ class TestRestApiPhenotype(DBTest):
         assert pheno_file.loc[1000040, 'field_name_34'] == '3'
         assert pheno_file.loc[1000040, 'field_name_47'] == '5.20832'
 
+    def test_phenotype_query_copy_output_same_as_pandas(self):
+        # Prepare
+        self.setUp('pheno2sql/example10/example10_diseases.csv',
+                   bgen_sample_file=get_repository_path('pheno2sql/example10/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2)
+
+        p2sql = app.app.config['pheno2sql']
+
+        columns = ['c21_0_0', 'c21_1_0', 'c31_0_0', 'c34_0_0', 'c47_0_0', 'c48_0_0', 'c84_0_0',
+                   '(c47_0_0 ^ 2.0) as squared', 'c34_0_0 as renamed_int', '(c46_0_0 > 0) as positive']
+
+        yaml_data = b"""
+        samples_filters:
+          - c47_0_0  > 0
+
+        covariates:
+          field_name_34: c34_0_0
+          field_name_47: c47_0_0
+          field_name_48: c48_0_0
+
+        fields:
+          instance0: c21_0_0
+          instance1: c21_1_0
+          instance2: c21_2_0
+
+        cancer:
+          has_cancer:
+            case_control:
+              84:
+                coding: [N308, Q750]
+        """
+
+        def _get_responses():
+            responses = []
+
+            for accept in ('text/csv', 'text/plink2', 'text/bgenie'):
+                response = self.app.get('/ukbrest/api/v1.0/phenotype', query_string={
+                    'columns': columns,
+                }, headers={'accept': accept})
+                assert response.status_code == 200, response.status_code
+                responses.append(response.data)
+
+                for section in ('covariates', 'fields', 'cancer'):
+                    for missing_code in (None, '-999'):
+                        data = {
+                            'file': (io.BytesIO(yaml_data), 'data.yaml'),
+                            'section': section,
+                        }
+
+                        if missing_code is not None:
+                            data['missing_code'] = missing_code
+
+                        response = self.app.post('/ukbrest/api/v1.0/query', data=data, headers={'accept': accept})
+                        assert response.status_code == 200, response.status_code
+                        responses.append(response.data)
+
+            return responses
+
+        # Run
+        assert p2sql.sql_copy_output
+        assert p2sql.query(columns).copy_csv() is not None
+        copy_responses = _get_responses()
+
+        p2sql.sql_copy_output = False
+        assert p2sql.query(columns).copy_csv() is None
+        pandas_responses = _get_responses()
+
+        # Validate
+        assert len(copy_responses) == len(pandas_responses) == 21
+
+        for copy_response, pandas_response in zip(copy_responses, pandas_responses):
+            assert copy_response == pandas_response, (copy_response, pandas_response)
+
+        assert copy_responses[0].decode('utf-8').startswith(
+            'eid,c21_0_0,c21_1_0,c31_0_0,c34_0_0,c47_0_0,c48_0_0,c84_0_0,squared,renamed_int,positive\n')
+        assert copy_responses[7].decode('utf-8').startswith('FID\tIID\tc21_0_0\t')
+
+    def test_phenotype_query_copy_output_floats_and_timestamps(self):
+        # Prepare
+        self.setUp('pheno2sql/example10/example10_diseases.csv', n_columns_per_table=2)
+
+        p2sql = app.app.config['pheno2sql']
+
+        columns = [
+            'c47_0_0', '(0.1::float8 + 0.2::float8) as float_sum', '(c47_0_0 / 3.0) as third', 'c48_0_0',
+            "(c48_0_0 + (case when eid = 1000020 then interval '10 hours' else interval '0' end)) as mixed_time",
+            "(c48_0_0 + (case when eid = 1000020 then interval '0.5 seconds' else interval '0' end)) as ms_time",
+        ]
+
+        def _get_response():
+            response = self.app.get('/ukbrest/api/v1.0/phenotype', query_string={
+                'columns': columns,
+            }, headers={'accept': 'text/csv'})
+            assert response.status_code == 200, response.status_code
+            return response.data
+
+        # Run
+        copy_response = _get_response()
+
+        p2sql.sql_copy_output = False
+        pandas_response = _get_response()
+
+        # Validate
+        assert copy_response == pandas_response, (copy_response, pandas_response)
+
+        results = pd.read_csv(io.StringIO(copy_response.decode('utf-8')), index_col='eid', dtype=str)
+        assert results.loc[1000010, 'float_sum'] == '0.30000000000000004'
+        assert results.loc[1000010, 'third'] == repr(41.55312 / 3.0)
+
+        ## timestamps have the same format in all rows and columns
+        assert results.loc[1000010, 'c48_0_0'] == '2010-07-14 00:00:00.000'
+        assert results.loc[1000010, 'mixed_time'] == '2010-07-14 00:00:00.000'
+        assert results.loc[1000020, 'mixed_time'] == '2017-11-30 10:00:00.000'
+        assert results.loc[1000020, 'ms_time'] == '2017-11-30 00:00:00.500'
+
+
+        ## floats keep all their digits if the server is configured to round them
+        p2sql = self._get_p2sql('pheno2sql/example10/example10_diseases.csv',
+                                db_uri=POSTGRESQL_ENGINE + '?options=-c%20extra_float_digits%3D0')
+        copy_csv = p2sql.query(columns).copy_csv(na_rep='NA')
+        assert copy_csv is not None
+        assert b''.join(copy_csv) == copy_response
+
+        ## without fractional seconds
+        columns = columns[:-1]
+        p2sql.sql_copy_output = True
+        copy_response = _get_response()
+
+        p2sql.sql_copy_output = False
+        assert copy_response == _get_response()
+
+        results = pd.read_csv(io.StringIO(copy_response.decode('utf-8')), index_col='eid', dtype=str)
+        assert results.loc[1000010, 'c48_0_0'] == '2010-07-14 00:00:00'
+        assert results.loc[1000020, 'mixed_time'] == '2017-11-30 10:00:00'
+
+        ## older PostgreSQL versions round floats, so they are written by pandas
+        assert get_csv_column_sql('c47_0_0', FLOAT8_OID, server_version=110005) is None
+        assert get_csv_column_sql('c47_0_0', FLOAT8_OID, integer=True, server_version=110005) is not None
+
     def test_phenotype_query_yaml_specify_bgenie_format(self):
         # Prepare
         self.setUp('pheno2sql/example10/example10_diseases.csv',
@@ -1,7 +1,8 @@
 import logging
 
 from flask import Flask
-from ukbrest.resources.phenotype import PhenotypeFieldsAPI, PhenotypeAPI, QueryAPI, PhenotypeApiObject
+from ukbrest.resources.phenotype import PhenotypeFieldsAPI, PhenotypeFieldsStatsAPI, PhenotypeAPI, QueryAPI, \
+    PhenotypeApiObject
 
 from ukbrest.resources.genotype import GenotypeApiObject
 from ukbrest.resources.genotype import GenotypePositionsAPI, GenotypeRsidsAPI
@@ -41,6 +42,11 @@ phenotype_info_api.add_resource(
     '/ukbrest/api/v1.0/phenotype/fields',
 )
 
+phenotype_info_api.add_resource(
+    PhenotypeFieldsStatsAPI,
+    '/ukbrest/api/v1.0/phenotype/fields/stats',
+)
+
 # Query API
 phenotype_api = PhenotypeApiObject(app)
 
@@ -61,6 +67,8 @@ if __name__ == '__main__':
     from ukbrest.common.genoquery import GenoQuery
     from ukbrest.common.pheno2sql import Pheno2SQL
     from ukbrest.common.utils.auth import PasswordHasher
+    from ukbrest.common.utils.result_cache import ResultCache
+    from ukbrest.common.utils.memory import parse_memory_size
     from ukbrest import config
     from ukbrest.common.utils.misc import update_parameters_from_args, parameter_empty
 
@@ -90,6 +98,15 @@ if __name__ == '__main__':
 
     app.config.update({'pheno2sql': p2sql})
 
+    # Result cache
+    result_cache_parameters = config.get_result_cache_parameters()
+    result_cache_parameters = update_parameters_from_args(result_cache_parameters, args)
+
+    if not parameter_empty(result_cache_parameters, 'result_cache_dir'):
+        result_cache = ResultCache(result_cache_parameters['result_cache_dir'],
+                                   parse_memory_size(result_cache_parameters['result_cache_size']))
+        app.config.update({'result_cache': result_cache})
+
     ph = PasswordHasher(args.users_file, method='pbkdf2:sha256')
     ph.process_users_file()
     auth = ph.setup_http_basic_auth()
@@ -1,24 +1,45 @@
 import csv
+import hashlib
+import json
 import os
 import re
+import shutil
 import sys
 import tempfile
+import time
+from io import StringIO, BytesIO
 from subprocess import Popen, PIPE
 from urllib.parse import urlparse
 
 import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
+from lxml import etree
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import ProgrammingError
-from sqlalchemy.types import TEXT, FLOAT, TIMESTAMP, INT
+from sqlalchemy.types import TEXT, FLOAT, TIMESTAMP, INT, SMALLINT
 from sqlalchemy.exc import OperationalError
 
-from ukbrest.common.utils.db import create_table, create_indexes, DBAccess
+from ukbrest.common.utils.db import create_table, get_indexes_sql, run_index_builds, DBAccess
 from ukbrest.common.utils.datagen import get_tmpdir
-from ukbrest.common.utils.constants import BGEN_SAMPLES_TABLE, ALL_EIDS_TABLE
+from ukbrest.common.utils.compression import open_csv_file, strip_compression_extension
+from ukbrest.common.utils.binary_copy import get_binary_copy_data
+from ukbrest.common.utils.field_stats import ColumnStats
+from ukbrest.common.utils.fields_catalog import FieldsCatalog
+from ukbrest.common.utils.partitioning import read_co_access_sets, partition_columns
+from ukbrest.common.utils.load_report import LoadMetrics, get_timestamp, no_measure
+from ukbrest.common.utils.copy_stream import copy_to_stream, get_csv_column_sql, get_sql_string, get_sql_identifier, \
+    TIMESTAMP_OID, TIMESTAMP_FORMATS, TIMESTAMP_PRECISION_SQL
+from ukbrest.common.utils.query_results import QueryResults
+from ukbrest.common.utils.memory import ChunkSizer, parse_memory_size, get_rss, get_available_memory, \
+    get_columns_bytes_per_row
+from ukbrest.common.utils.constants import BGEN_SAMPLES_TABLE, ALL_EIDS_TABLE, LOAD_MANIFEST_TABLE, \
+    CATEGORICAL_CODES_TABLE, FIELD_STATS_TABLE
 from ukbrest.config import logger, SQL_CHUNKSIZE_ENV
-from ukbrest.common.utils.misc import get_list
-from ukbrest.resources.exceptions import UkbRestSQLExecutionError, UkbRestProgramExecutionError
+from ukbrest.common.utils.misc import get_list, get_n_jobs
+from ukbrest.resources.exceptions import UkbRestSQLExecutionError, UkbRestProgramExecutionError, \
+    UkbRestValidationError
 
 
 class Pheno2SQL(DBAccess):
@@ -34,9 +55,31 @@ class Pheno2SQL(DBAccess):
     _RE_FULL_COLUMN_NAME_RENAME_PATTERN = '^(?i)\(?(?P<field>{})\)?([ ]+([ ]*as[ ]+)?(?P<rename>[\w_]+))?$'.format(_RE_COLUMN_NAME_PATTERN)
     RE_FULL_COLUMN_NAME_RENAME = re.compile(_RE_FULL_COLUMN_NAME_RENAME_PATTERN)
 
+    _RE_SQL_STRING_PATTERN = "'((?:[^']|'')*)'"
+    RE_SQL_STRING = re.compile(_RE_SQL_STRING_PATTERN)
+
+    # a column, optionally compared with a string (=, <>, !=) or a list of strings (in, not in)
+    _RE_COLUMN_COMPARISON_PATTERN = '(?P<column>{column})(?P<comparison>[ ]*(=|<>|!=)[ ]*{string}|[ ]+(not[ ]+)?in[ ]*\\([ ]*{string}([ ]*,[ ]*{string})*[ ]*\\))?'.format(
+        column=_RE_COLUMN_NAME_PATTERN, string="'(?:[^']|'')*'")
+    RE_COLUMN_COMPARISON = re.compile(_RE_COLUMN_COMPARISON_PATTERN)
+
+    # chunk sizes used with a loading memory budget (see ChunkSizer)
+    LOADING_MIN_CHUNKSIZE = 100
+    LOADING_MAX_CHUNKSIZE = 100000
+    LOADING_CHUNK_MEMORY_OVERHEAD = 4
+    LOADING_MEMORY_SAMPLE_ROWS = 100
+
+    # number of rows of each chunk of query results when sql_chunksize is not set
+    QUERY_CHUNKSIZE = 5000
+
     def __init__(self, ukb_csvs, db_uri, bgen_sample_file=None, table_prefix='ukb_pheno_',
                  n_columns_per_table=sys.maxsize, loading_n_jobs=-1, tmpdir=tempfile.mkdtemp(prefix='ukbrest'),
-                 loading_chunksize=5000, sql_chunksize=None, delete_temp_csv=True):
+                 loading_chunksize=5000, sql_chunksize=None, delete_temp_csv=True, loading_single_pass=False,
+                 loading_stream_copy=False, loading_index_n_jobs=None, loading_index_memory=None,
+                 loading_staging_schema=None, loading_keep_unlogged=False, loading_binary_copy=False,
+                 loading_array_columns=False, loading_categorical_codes=False, loading_field_stats=False,
+                 loading_query_files=None, loading_report_file=None, loading_memory_limit=None,
+                 loading_worker_memory_limit=None, fields_catalog_check_interval=5, sql_copy_output=True):
         """
         :param ukb_csvs: files are loaded in the order they are specified
         :param db_uri:
@@ -46,7 +89,61 @@ class Pheno2SQL(DBAccess):
         :param tmpdir:
         :param loading_chunksize: number of lines to read when loading CSV files to the SQL database.
         :param sql_chunksize: when an SQL query is submited to get phenotypes, this parameteres indicates the
-        chunksize (number of rows).
+        chunksize (number of rows). Results are read from a server-side cursor, so only one chunk is kept in memory.
+        By default, QUERY_CHUNKSIZE is used.
+        :param loading_single_pass: if True, each CSV file is read only once and its rows are written to all tables'
+        temporary files at the same time, instead of reading the whole file once per column range.
+        :param loading_stream_copy: if True, chunks read from CSV files are streamed directly into the database
+        tables with COPY ... FROM STDIN, without writing temporary CSV files. Only supported in PostgreSQL.
+        :param loading_index_n_jobs: number of primary keys and indexes built at the same time once data is loaded.
+        By default, loading_n_jobs is used.
+        :param loading_index_memory: memory used by each primary key or index build (PostgreSQL's
+        maintenance_work_mem), like '1GB'. If None, the server setting is used.
+        :param loading_staging_schema: if set, data is loaded into unlogged tables of this schema (which is created),
+        so live tables can still be queried while loading. Once loaded and analyzed, they replace the live tables in a
+        single transaction. Only supported in PostgreSQL, and not used when loading incrementally.
+        :param loading_keep_unlogged: if True, tables loaded through loading_staging_schema are not made logged before
+        replacing the live ones. This avoids writing all data to the WAL, but PostgreSQL empties unlogged tables after
+        a crash. By default (False), tables are made logged with ALTER TABLE ... SET LOGGED, which writes all their
+        data to the WAL at that point: loading is not slowed down by the WAL while tables are written, but the total
+        WAL volume is about the same as loading logged tables directly.
+        :param loading_binary_copy: if True, values are converted to the type of their columns in Python (vectorized)
+        and streamed into PostgreSQL in binary COPY format, so the server does not parse them from text. It implies
+        loading_stream_copy.
+        :param loading_array_columns: if True, the columns of each field instance with several arrays (like c41202_0_0,
+        c41202_0_1, etc) are stored in a single PostgreSQL array column (like c41202_0), and n_columns_per_table counts
+        these array columns. Queries still use the original column names, which are rewritten to array subscripts.
+        Only supported in PostgreSQL, and not compatible with incremental loads.
+        :param loading_categorical_codes: if True, categorical (single) columns are stored as smallint or int codes of
+        their data-coding values, taken from the codings table (it has to be loaded before, see
+        Postloader.load_codings). Queries still compare and return the original values. Only supported in PostgreSQL,
+        and not compatible with incremental loads.
+        :param loading_field_stats: if True, statistics of each column (number of missing values, minimum and maximum,
+        an estimate of the number of distinct values and a small histogram) are computed while data is loaded, and
+        written to the field_stats table (see get_field_stats). They are not updated by incremental loads.
+        :param loading_query_files: list of files with queries representative of the workload: YAML files (like those
+        of the query API) or query logs, with one query per line. If given, columns of each CSV file queried together
+        are stored in the same table, instead of splitting columns in tables in their CSV order, so queries need fewer
+        joins (see partition_columns). The columns of each table are recorded in the load manifest, and a resumed load
+        keeps them even if these files (or n_columns_per_table) changed.
+        :param loading_report_file: if given, a JSON report with metrics of each stage of load_data (wall time, rows per
+        second, bytes read and written and peak memory of each worker) is written to this file (see LoadMetrics).
+        Metrics of each stage are also logged as stages finish.
+        :param loading_memory_limit: memory used by all workers reading CSV files, as a number of bytes or a string
+        like '8GB'. If set, the number of concurrent workers is reduced (if needed) so that each one can process chunks
+        of loading_chunksize rows, measured on the first rows of each file; read chunks are then sized, from the
+        memory of the rows already read, to fit in the memory of each worker.
+        :param loading_worker_memory_limit: memory used by each worker reading CSV files (same format as
+        loading_memory_limit). If loading_memory_limit is not set, the memory available in the machine is shared
+        between workers.
+        :param fields_catalog_check_interval: queries are planned with an in-memory copy of the fields table (see
+        FieldsCatalog), which is read again when the data version changes (see DBAccess._bump_data_version). The data
+        version is checked at most once every this number of seconds (0 means on every query).
+        :param sql_copy_output: if True, query results requested as CSV (also for plink2 and BGENIE) are written by
+        PostgreSQL with COPY ... TO STDOUT, with values formatted in SQL as pandas would write them, and streamed to
+        the client without reading them as data frames (see QueryResults.copy_csv). Integer columns are always written
+        without decimals. Only supported in PostgreSQL; before version 12, results with float columns are written by
+        pandas.
         """
 
         super(Pheno2SQL, self).__init__(db_uri)
@@ -76,14 +173,71 @@ class Pheno2SQL(DBAccess):
         self.loading_n_jobs = loading_n_jobs
         self.tmpdir = tmpdir
         self.loading_chunksize = loading_chunksize
+        self.loading_single_pass = loading_single_pass
+
+        self.loading_stream_copy = loading_stream_copy
+        if self.db_type == 'sqlite':
+            # SQLite is always loaded in-process, without temporary CSV files (see _insert_data_frame)
+            self.loading_stream_copy = True
+        elif self.loading_stream_copy and self.db_type != 'postgresql':
+            logger.warning('Streaming COPY is only supported in PostgreSQL, temporary CSV files will be used')
+            self.loading_stream_copy = False
+
+        self.loading_binary_copy = loading_binary_copy
+        if self.loading_binary_copy and self.db_type != 'postgresql':
+            logger.warning('Binary COPY is only supported in PostgreSQL')
+            self.loading_binary_copy = False
+        elif self.loading_binary_copy:
+            self.loading_stream_copy = True
+
+        self.loading_array_columns = loading_array_columns
+        if self.loading_array_columns and self.db_type != 'postgresql':
+            logger.warning('Array columns are only supported in PostgreSQL')
+            self.loading_array_columns = False
+        elif self.loading_array_columns and self.loading_binary_copy:
+            logger.warning('Binary COPY does not support array columns, text COPY will be used')
+            self.loading_binary_copy = False
+
+        self.loading_field_stats = loading_field_stats
+        self.loading_query_files = get_list(loading_query_files) if loading_query_files is not None else []
+        self.loading_report_file = loading_report_file
+        self.loading_memory_limit = parse_memory_size(loading_memory_limit)
+        self.loading_worker_memory_limit = parse_memory_size(loading_worker_memory_limit)
+
+        self.loading_categorical_codes = loading_categorical_codes
+        if self.loading_categorical_codes and self.db_type != 'postgresql':
+            logger.warning('Encoded categorical columns are only supported in PostgreSQL')
+            self.loading_categorical_codes = False
+
+        self.loading_index_n_jobs = loading_index_n_jobs
+        if self.loading_index_n_jobs is None:
+            self.loading_index_n_jobs = self.loading_n_jobs
+
+        self.loading_index_memory = loading_index_memory
+
+        self.loading_staging_schema = loading_staging_schema
+        if self.loading_staging_schema is not None and self.db_type != 'postgresql':
+            logger.warning('Staging schemas are only supported in PostgreSQL, tables will be loaded directly')
+            self.loading_staging_schema = None
+
+        self.loading_keep_unlogged = loading_keep_unlogged
+
+        self.fields_catalog_check_interval = fields_catalog_check_interval
+
+        self.sql_copy_output = sql_copy_output and self.db_type == 'postgresql'
 
         self.sql_chunksize = sql_chunksize
         if self.sql_chunksize is None:
-            logger.warning('{} was not set, no chunksize for SQL queries, what can lead to '
-                           'memory problems.'.format(SQL_CHUNKSIZE_ENV))
+            logger.info('{} was not set, using {} rows for SQL queries'.format(SQL_CHUNKSIZE_ENV, self.QUERY_CHUNKSIZE))
 
         self._fields_dtypes = {}
 
+        # in-memory copy of the fields table and time of its last data version check (see _get_fields_catalog), and
+        # codes of data-codings (see _get_coding_codes)
+        self._fields_catalog = None
+        self._fields_catalog_checked = None
+        self._codings_codes = {}
+
         # this is a temporary variable that holds information about loading
         self._loading_tmp = {}
 
@@ -123,19 +277,11 @@ class Pheno2SQL(DBAccess):
 
         logger.info('Getting columns types')
 
-        filename = os.path.splitext(ukbcsv_file)[0] + '.html'
-
-        logger.info('Reading data types from {}'.format(filename))
-        with open(filename, 'r', encoding='latin1') as f:
-            tmp = pd.read_html(f, match='UDI', header=0, index_col=1, flavor='html5lib')
-
-        logger.debug('Filling NaN values')
-        df_types = tmp[0].loc[:, 'Type']
-        df_types = df_types.fillna(method='ffill')
-
-        df_descriptions = tmp[0].loc[:, 'Description']
-        df_descriptions = df_descriptions.fillna(method='ffill')
-        del tmp
+        filename = os.path.splitext(strip_compression_extension(ukbcsv_file))[0] + '.html'
+        with self._measure_stage('html_parse', csv_file=ukbcsv_file) as stage_metrics:
+            data_dictionary = self._read_data_dictionary(filename)
+            stage_metrics['rows'] = len(data_dictionary)
+            stage_metrics['bytes_read'] = os.path.getsize(filename)
 
         db_column_types = {}
         column_types = {}
@@ -143,13 +289,14 @@ class Pheno2SQL(DBAccess):
         column_codings = {}
 
         # open just to get columns
-        csv_df = pd.read_csv(ukbcsv_file, index_col=0, header=0, nrows=1)
+        csv_df = self._read_csv_sample(ukbcsv_file)
         columns = csv_df.columns.tolist()
         del csv_df
 
         logger.debug('Reading columns')
         for col in columns:
-            col_type = df_types[col]
+            col_info = data_dictionary[col]
+            col_type = col_info['type']
             final_db_col_type = TEXT
 
             if col_type == 'Continuous':
@@ -163,15 +310,128 @@ class Pheno2SQL(DBAccess):
 
             db_column_types[col] = final_db_col_type
             column_types[self._rename_columns(col)] = col_type
-            column_descriptions[self._rename_columns(col)] = df_descriptions[col].split('Uses data-coding ')[0]
+            column_descriptions[self._rename_columns(col)] = col_info['description']
 
-            # search for column coding
-            coding_matches = re.search(Pheno2SQL.RE_FIELD_CODING, df_descriptions[col])
-            if coding_matches is not None:
-                column_codings[self._rename_columns(col)] = int(coding_matches.group('coding'))
+            if col_info['coding'] is not None:
+                column_codings[self._rename_columns(col)] = col_info['coding']
 
         return db_column_types, column_types, column_descriptions, column_codings
 
+    def _parse_data_dictionary(self, html_file):
+        """
+        Parses the data dictionary table (the one with the UDI column) of a basket HTML file. The file is read
+        incrementally with lxml, so only one row is kept in memory at any time. Cells spanning several rows (Type and
+        Description) are carried forward to the following rows.
+
+        :param html_file: path to the HTML file.
+        :return: a dictionary with UDIs (like '21-0.0') as keys and a dictionary with keys 'type', 'description' and
+        'coding' as values.
+        """
+
+        data_dictionary = {}
+
+        in_table = False
+        column_indexes = None
+        last_type = None
+        last_description = None
+
+        def _get_cell_text(cell):
+            return ''.join(cell.itertext()).strip()
+
+        for event, element in etree.iterparse(html_file, events=('end',), tag=('tr', 'table'), html=True,
+                                              encoding='latin1'):
+            if element.tag == 'table':
+                if in_table:
+                    break
+
+                element.clear()
+                continue
+
+            if not in_table:
+                header = [_get_cell_text(cell) for cell in element.findall('th')]
+                if 'UDI' in header:
+                    in_table = True
+                    column_indexes = {col_name: idx for idx, col_name in enumerate(header)}
+
+                element.clear()
+                continue
+
+            cells = element.findall('td')
+            n_cells = len(cells)
+
+            if n_cells > column_indexes['UDI']:
+                if n_cells > column_indexes['Description']:
+                    last_type = _get_cell_text(cells[column_indexes['Type']])
+                    last_description = _get_cell_text(cells[column_indexes['Description']])
+
+                coding = None
+                coding_matches = re.search(Pheno2SQL.RE_FIELD_CODING, last_description)
+                if coding_matches is not None:
+                    coding = int(coding_matches.group('coding'))
+
+                data_dictionary[_get_cell_text(cells[column_indexes['UDI']])] = {
+                    'type': last_type,
+                    'description': last_description.split('Uses data-coding ')[0].strip(),
+                    'coding': coding,
+                }
+
+            element.clear()
+
+        if not in_table:
+            raise ValueError('No data dictionary table found in {}'.format(html_file))
+
+        return data_dictionary
+
+    def _get_file_hash(self, filename):
+        file_hash = hashlib.sha256()
+
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                file_hash.update(block)
+
+        return file_hash.hexdigest()
+
+    def _get_data_dictionary_cache_file(self, html_file):
+        return os.path.splitext(html_file)[0] + '.dictionary.json'
+
+    def _read_data_dictionary(self, html_file):
+        """
+        Returns the data dictionary of a basket HTML file (see _parse_data_dictionary). The parsed data is cached in a
+        sidecar JSON file next to the HTML file, keyed by the SHA-256 hash of the HTML file, so it is parsed again only
+        if its content changes.
+
+        :param html_file: path to the HTML file.
+        :return: same as _parse_data_dictionary.
+        """
+
+        html_hash = self._get_file_hash(html_file)
+        cache_file = self._get_data_dictionary_cache_file(html_file)
+
+        if os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'r') as f:
+                    cache_data = json.load(f)
+
+                if cache_data.get('sha256') == html_hash:
+                    logger.info('Reading data types from cache {}'.format(cache_file))
+                    return cache_data['columns']
+            except (ValueError, KeyError, OSError):
+                logger.warning('Could not read data dictionary cache {}'.format(cache_file))
+
+        logger.info('Reading data types from {}'.format(html_file))
+        data_dictionary = self._parse_data_dictionary(html_file)
+
+        tmp_cache_file = cache_file + '.{}.tmp'.format(os.getpid())
+        try:
+            with open(tmp_cache_file, 'w') as f:
+                json.dump({'sha256': html_hash, 'columns': data_dictionary}, f)
+
+            os.replace(tmp_cache_file, cache_file)
+        except OSError:
+            logger.warning('Could not write data dictionary cache {}'.format(cache_file))
+
+        return data_dictionary
+
     def _rename_columns(self, column_name):
         if column_name == 'eid':
             return column_name
@@ -185,51 +445,103 @@ class Pheno2SQL(DBAccess):
         """
         logger.info('Creating database tables')
 
-        tmp = pd.read_csv(csv_file, index_col=0, header=0, nrows=1, low_memory=False)
+        tmp = self._read_csv_sample(csv_file, low_memory=False)
         old_columns = tmp.columns.tolist()
         del tmp
         new_columns = [self._rename_columns(x) for x in old_columns]
 
-        # Remove columns that were previously loaded in other datasets
-        if 'existing_col_names' not in self._loading_tmp:
-            # dictionary with data-field as key and csv file as value
-            columns_and_csv_files = {}
-        else:
-            columns_and_csv_files = self._loading_tmp['existing_col_names']
+        # Remove columns that are loaded from other datasets (see _get_existing_col_names)
+        columns_and_csv_files = self._loading_tmp['existing_col_names']
 
         old_columns_clean = []
         new_columns_clean = []
 
         for old_col_name, new_col_name in tuple(zip(old_columns, new_columns)):
-            if new_col_name in columns_and_csv_files:
-                corresponding_csv_file = columns_and_csv_files[new_col_name]
+            corresponding_csv_file = columns_and_csv_files[new_col_name]
+            if corresponding_csv_file != csv_file:
                 logger.warning(f'Column {new_col_name} already loaded from {corresponding_csv_file}. Skipping.')
                 continue
 
-            columns_and_csv_files[new_col_name] = csv_file
-
             old_columns_clean.append(old_col_name)
             new_columns_clean.append(new_col_name)
 
-        self._loading_tmp['existing_col_names'] = columns_and_csv_files
-
         # keep only unique columns (not loaded in previous files)
         old_columns = old_columns_clean
         new_columns = new_columns_clean
         all_columns = tuple(zip(old_columns, new_columns))
 
+        # loading plan of this file, used by the rest of loading steps
+        basket = {}
+        self._loading_tmp['baskets'][csv_file_idx] = basket
+
         # FIXME: check if self.n_columns_per_table is greater than the real number of columns
-        self._loading_tmp['chunked_column_names'] = tuple(enumerate(self._chunker(all_columns, self.n_columns_per_table)))
-        self._loading_tmp['chunked_table_column_names'] = \
-            {self._get_table_name(col_idx, csv_file_idx): [col[1] for col in col_names]
-             for col_idx, col_names in self._loading_tmp['chunked_column_names']}
+        # columns of an array column are always in the same table
+        all_columns_by_name = dict((x[1], x) for x in all_columns)
+        storage_columns = self._get_storage_columns([x[1] for x in all_columns])
+
+        # tables of a resumed load keep the columns they were created with
+        manifest_partition = self._get_manifest_partition(csv_file, csv_file_idx)
+
+        if manifest_partition is not None:
+            if sorted(x for col_names in manifest_partition for x in col_names) != sorted(all_columns_by_name):
+                raise UkbRestProgramExecutionError('Columns of {} differ from those of the load being resumed; load '
+                                                   'it again without resuming'.format(csv_file))
+
+            basket['chunked_column_names'] = tuple(enumerate(
+                [all_columns_by_name[new_col_name] for new_col_name in col_names]
+                for col_names in manifest_partition
+            ))
+        else:
+            co_access_sets = self._loading_tmp.get('co_access_sets', {})
+
+            if len(co_access_sets) > 0:
+                # columns queried together are stored in the same table
+                storage_columns_chunks = partition_columns(storage_columns, co_access_sets, self.n_columns_per_table)
+            else:
+                storage_columns_chunks = self._chunker(storage_columns, self.n_columns_per_table)
+
+            basket['chunked_column_names'] = tuple(enumerate(
+                [all_columns_by_name[new_col_name] for storage_name, new_col_names in storage_columns_chunk
+                 for new_col_name in new_col_names]
+                for storage_columns_chunk in storage_columns_chunks
+            ))
+
+            self._save_manifest_partition(csv_file, csv_file_idx, basket['chunked_column_names'])
+
+        self.table_list.update(self._get_table_name(col_idx, csv_file_idx)
+                               for col_idx, col_names in basket['chunked_column_names'])
+
+        # column ranges whose tables were not completely loaded in a previous run
+        basket['pending_column_names'] = tuple(
+            (col_idx, col_names) for col_idx, col_names in basket['chunked_column_names']
+            if not self._is_step_done(csv_file, self._get_table_name(col_idx, csv_file_idx), 'verified')
+        )
 
         # get columns dtypes (for PostgreSQL and standard ones)
         db_types_old_column_names, all_fields_dtypes, all_fields_description, all_fields_coding = self._get_db_columns_dtypes(csv_file)
         db_dtypes = {self._rename_columns(k): v for k, v in db_types_old_column_names.items()}
         self._fields_dtypes.update(all_fields_dtypes)
 
-        data_sample = pd.read_csv(csv_file, index_col=0, header=0, nrows=1, dtype=str)
+        if self.loading_categorical_codes:
+            db_dtypes.update(self._get_encoded_columns_dtypes(all_fields_dtypes, all_fields_coding))
+
+        self._loading_tmp.setdefault('db_dtypes', {}).update(db_dtypes)
+
+        # categorical (multiple) columns, whose values are also written to the events table while loading
+        basket['events_column_names'] = ()
+        if self.db_type == 'postgresql' and not self._is_step_done(csv_file, 'events', 'copy'):
+            # events of field instances loaded from several files are written after loading (see _load_shared_events)
+            basket['events_column_names'] = tuple(
+                col for col in all_columns
+                if all_fields_dtypes[col[1]] == 'Categorical (multiple)' and
+                re.match(Pheno2SQL.RE_FIELD_INFO, col[1]).group('field_id', 'instance') not in
+                self._loading_tmp['shared_fields_instances']
+            )
+
+            if self._loading_tmp['resume']:
+                self._delete_events(basket['events_column_names'])
+
+        data_sample = self._read_csv_sample(csv_file, dtype=str)
         data_sample = data_sample.rename(columns=self._rename_columns)
 
         # create fields table
@@ -244,73 +556,291 @@ class Pheno2SQL(DBAccess):
                     'inst bigint',
                     'arr bigint',
                     'type text NOT NULL',
-                ],
+                ] + (['array_column text'] if self.loading_array_columns else []) +
+                    (['encoded boolean'] if self.loading_categorical_codes else []),
                  constraints=[
                      'pk_fields PRIMARY KEY (column_name)'
                  ],
                  db_engine=self._get_db_engine(),
-                 drop_if_exists=True
+                 drop_if_exists=not self._loading_tmp['resume'],
+                 unlogged=self.db_schema is not None
              )
 
-        current_stop = 0
-        for column_names_idx, column_names in self._loading_tmp['chunked_column_names']:
+        for column_names_idx, column_names in basket['chunked_column_names']:
             new_columns_names = [x[1] for x in column_names]
+            table_name = self._get_table_name(column_names_idx, csv_file_idx)
 
-            fields_ids = []
-            instances = []
-            arrays = []
-            fields_dtypes = []
-            fields_descriptions = []
-            fields_codings = []
-
-            for col_name in new_columns_names:
-                match = re.match(Pheno2SQL.RE_FIELD_INFO, col_name)
-
-                fields_ids.append(match.group('field_id'))
-                instances.append(int(match.group('instance')))
-                arrays.append(int(match.group('array')))
+            if self._is_step_done(csv_file, table_name, 'schema'):
+                logger.info('Table {} already created'.format(table_name))
 
-                fields_dtypes.append(all_fields_dtypes[col_name])
-                fields_descriptions.append(all_fields_description[col_name])
+                if (column_names_idx, column_names) in basket['pending_column_names']:
+                    # remove any partially loaded data
+                    with self._get_db_engine().connect() as conn:
+                        if self.db_type == 'sqlite':
+                            conn.execute('DELETE FROM {table_name};'.format(table_name=table_name))
+                        else:
+                            conn.execute('TRUNCATE {table_name};'.format(table_name=table_name))
 
-                if col_name in all_fields_coding:
-                    fields_codings.append(all_fields_coding[col_name])
-                else:
-                    fields_codings.append(np.nan)
+                continue
 
             # Create main table structure
-            table_name = self._get_table_name(column_names_idx, csv_file_idx)
             logger.info('Table {} ({} columns)'.format(table_name, len(new_columns_names)))
-            data_sample.loc[[], new_columns_names].to_sql(table_name, self._get_db_engine(), if_exists='replace', dtype=db_dtypes)
+            self._create_table_structure(table_name, self._get_table_data(data_sample.loc[[], :], new_columns_names),
+                                         self._get_table_db_dtypes(new_columns_names, db_dtypes))
 
-            with self._get_db_engine().connect() as conn:
-                conn.execute("""
-                    ALTER TABLE {table_name} ADD CONSTRAINT pk_{table_name} PRIMARY KEY (eid);
-                """.format(table_name=table_name))
+            # Create auxiliary table
+            aux_table = self._get_fields_table_data(table_name, new_columns_names, all_fields_dtypes,
+                                                    all_fields_description, all_fields_coding)
 
             with self._get_db_engine().connect() as conn:
-                conn.execute('DROP INDEX ix_{table_name}_eid;'.format(table_name=table_name))
+                conn.execute(text('delete from fields where table_name = :table_name'), table_name=table_name)
 
-            # Create auxiliary table
-            n_column_names = len(new_columns_names)
-            current_start = current_stop
-            current_stop = current_start + n_column_names
-
-            aux_table = pd.DataFrame({
-                'column_name': new_columns_names,
-                'field_id': fields_ids,
-                'inst': instances,
-                'arr': arrays,
-                'coding': fields_codings,
-                'table_name': table_name,
-                'type': fields_dtypes,
-                'description': fields_descriptions
-            })
-            # aux_table = aux_table.set_index('column_name')
             aux_table.to_sql('fields', self._get_db_engine(), index=False, if_exists='append')
 
+            self._mark_step_done(csv_file, table_name, 'schema')
+
+    def _create_table_structure(self, table_name, empty_data, db_dtypes):
+        """
+        Creates table_name with the columns of empty_data (a data frame indexed by eid). The table has no indexes, its
+        primary key (eid) is created after data is loaded (see _create_constraints).
+        """
+        empty_data.to_sql(table_name, self._get_db_engine(), if_exists='replace', dtype=db_dtypes)
+
+        with self._get_db_engine().connect() as conn:
+            conn.execute('DROP INDEX ix_{table_name}_eid;'.format(table_name=table_name))
+
+            if self.db_schema is not None:
+                conn.execute('ALTER TABLE {table_name} SET UNLOGGED'.format(table_name=table_name))
+
+    def _get_storage_columns(self, new_columns_names):
+        """
+        Returns how the given columns are stored in a table. If loading_array_columns is True, columns of the same
+        field instance are stored in an array column (named like c41202_0) if there are more than one. Field instances
+        with columns in several CSV files (see _get_shared_fields_instances) are not stored in array columns, since
+        each file would have its own array column with the same name.
+        :param new_columns_names: list of column names (like c41202_0_0).
+        :return: a list of tuples (storage_column_name, new_columns_names); columns not stored in an array have
+        themselves as the only element.
+        """
+        if not self.loading_array_columns:
+            return [(col_name, [col_name]) for col_name in new_columns_names]
+
+        shared_fields_instances = getattr(self, '_loading_tmp', {}).get('shared_fields_instances', set())
+        fields_instances = {}
+
+        for col_name in new_columns_names:
+            match = re.match(Pheno2SQL.RE_FIELD_INFO, col_name)
+
+            if match.group('field_id', 'instance') in shared_fields_instances:
+                fields_instances[col_name] = [col_name]
+                continue
+
+            array_col_name = 'c{}_{}'.format(match.group('field_id'), match.group('instance'))
+            fields_instances.setdefault(array_col_name, []).append(col_name)
+
+        return [
+            (array_col_name, col_names) if len(col_names) > 1 else (col_names[0], col_names)
+            for array_col_name, col_names in fields_instances.items()
+        ]
+
+    def _get_table_db_dtypes(self, new_columns_names, db_dtypes):
+        """
+        Returns the SQLAlchemy types of the columns of a table, including array columns (see _get_storage_columns).
+        """
+        return {
+            storage_name: db_dtypes[col_names[0]] if storage_name in col_names else ARRAY(db_dtypes[col_names[0]])
+            for storage_name, col_names in self._get_storage_columns(new_columns_names)
+        }
+
+    def _get_array_column_data(self, chunk, new_columns_names):
+        """
+        Returns the values of an array column as PostgreSQL array literals (like {"a","b",NULL}), where the value of
+        each column is at position array + 1. Rows with all values missing are null.
+        """
+        columns_arrays = {
+            int(re.match(Pheno2SQL.RE_FIELD_INFO, col_name).group('array')): col_name
+            for col_name in new_columns_names
+        }
+
+        array_data = pd.Series('{', index=chunk.index)
+
+        for array_idx in range(max(columns_arrays.keys()) + 1):
+            if array_idx > 0:
+                array_data = array_data + ','
+
+            if array_idx not in columns_arrays:
+                array_data = array_data + 'NULL'
+                continue
+
+            values = chunk[columns_arrays[array_idx]]
+            values = pd.Series([
+                x.replace('\\', '\\\\').replace('"', '\\"') if isinstance(x, str) else x for x in values
+            ], index=values.index, dtype=object)
+            array_data = array_data + ('"' + values + '"').fillna('NULL')
+
+        array_data = array_data + '}'
+
+        return array_data.where(chunk.loc[:, new_columns_names].notnull().any(axis=1))
+
+    def _create_categorical_codes_table(self):
+        """
+        Creates the table with the values of each data-coding of the codings table, in the order given by their codes:
+        the value with code 0 is first. It is kept if the load is resumed, so codes do not change.
+        """
+        codings_table = 'codings'
+        if self.db_schema is not None:
+            codings_table = '{}.codings'.format(self._loading_tmp['live_schema'])
+
+        with self._get_db_engine().connect() as conn:
+            if conn.execute("select to_regclass('{}')".format(codings_table)).scalar() is None:
+                logger.warning('Codings table not found, categorical columns will not be encoded (load codings first)')
+                self._loading_tmp['categorical_codes'] = {}
+                return
+
+            if not self._loading_tmp['resume']:
+                conn.execute('DROP TABLE IF EXISTS {}'.format(CATEGORICAL_CODES_TABLE))
+
+            conn.execute("""
+                CREATE {unlogged} TABLE IF NOT EXISTS {table_name} AS
+                select data_coding, array_agg(coding order by coding) as codings
+                from (select distinct data_coding, coding from {codings_table}) c
+                group by data_coding
+            """.format(unlogged='UNLOGGED' if self.db_schema is not None else '', table_name=CATEGORICAL_CODES_TABLE,
+                       codings_table=codings_table))
+
+        categorical_codes = pd.read_sql('select data_coding, codings from {}'.format(CATEGORICAL_CODES_TABLE),
+                                        self._get_db_engine())
+
+        # codes are kept as strings, like the rest of the data read from CSV files
+        self._loading_tmp['categorical_codes'] = {
+            row.data_coding: {value: str(code) for code, value in enumerate(row.codings)}
+            for row in categorical_codes.itertuples()
+        }
+
+    def _get_encoded_columns_dtypes(self, all_fields_dtypes, all_fields_coding):
+        """
+        Returns the SQLAlchemy types of categorical (single) columns that are stored as codes: smallint, or int if the
+        data-coding has too many values. Columns whose data-coding is not in the codings table are not encoded.
+        """
+        categorical_codes = self._loading_tmp['categorical_codes']
+        encoded_columns = self._loading_tmp.setdefault('encoded_columns', {})
+        encoded_db_dtypes = {}
+
+        for col_name, col_type in all_fields_dtypes.items():
+            if col_type != 'Categorical (single)' or all_fields_coding.get(col_name) not in categorical_codes:
+                continue
+
+            data_coding = all_fields_coding[col_name]
+            encoded_columns[col_name] = data_coding
+            encoded_db_dtypes[col_name] = \
+                SMALLINT if len(categorical_codes[data_coding]) <= np.iinfo(np.int16).max else INT
+
+        return encoded_db_dtypes
+
+    def _encode_categorical_columns(self, table_data):
+        """
+        Replaces the values of encoded categorical columns of table_data by their codes (see
+        _create_categorical_codes_table).
+        """
+        encoded_columns = self._loading_tmp.get('encoded_columns', {})
+
+        for col_name in table_data.columns:
+            if col_name not in encoded_columns:
+                continue
+
+            data_coding = encoded_columns[col_name]
+            codes = table_data[col_name].map(self._loading_tmp['categorical_codes'][data_coding])
+
+            unknown_values = table_data[col_name].notnull() & codes.isnull()
+            if unknown_values.any():
+                raise UkbRestProgramExecutionError(
+                    'Value "{}" of column {} not found in data-coding {}'.format(
+                        table_data.loc[unknown_values, col_name].iloc[0], col_name, data_coding)
+                )
+
+            table_data[col_name] = codes
+
+        return table_data
+
+    def _get_table_data(self, chunk, new_columns_names):
+        """
+        Returns the data of a table (the given columns of chunk), with categorical columns encoded (see
+        _encode_categorical_columns) and array columns built (see _get_storage_columns).
+        """
+        storage_columns = self._get_storage_columns(new_columns_names)
+        chunk = self._encode_categorical_columns(chunk.loc[:, new_columns_names])
+
+        if len(storage_columns) == len(new_columns_names):
+            return chunk
+
+        table_data = pd.DataFrame(index=chunk.index)
+
+        for storage_name, col_names in storage_columns:
+            if storage_name in col_names:
+                table_data[storage_name] = chunk[storage_name]
+            else:
+                table_data[storage_name] = self._get_array_column_data(chunk, col_names)
+
+        return table_data
+
+    def _get_fields_table_data(self, table_name, new_columns_names, all_fields_dtypes, all_fields_description,
+                               all_fields_coding):
+        """
+        Returns a data frame with the rows of the fields table for the given columns of table_name.
+        """
+        fields_ids = []
+        instances = []
+        arrays = []
+        fields_dtypes = []
+        fields_descriptions = []
+        fields_codings = []
+
+        for col_name in new_columns_names:
+            match = re.match(Pheno2SQL.RE_FIELD_INFO, col_name)
+
+            fields_ids.append(match.group('field_id'))
+            instances.append(int(match.group('instance')))
+            arrays.append(int(match.group('array')))
+
+            fields_dtypes.append(all_fields_dtypes[col_name])
+            fields_descriptions.append(all_fields_description[col_name])
+
+            if col_name in all_fields_coding:
+                fields_codings.append(all_fields_coding[col_name])
+            else:
+                fields_codings.append(np.nan)
+
+        fields_table_data = pd.DataFrame({
+            'column_name': new_columns_names,
+            'field_id': fields_ids,
+            'inst': instances,
+            'arr': arrays,
+            'coding': fields_codings,
+            'table_name': table_name,
+            'type': fields_dtypes,
+            'description': fields_descriptions
+        })
+
+        if self.loading_categorical_codes:
+            fields_table_data['encoded'] = fields_table_data['column_name'].isin(
+                self._loading_tmp.get('encoded_columns', {}).keys())
+
+        if self.loading_array_columns:
+            arrays_columns = {
+                col_name: storage_name
+                for storage_name, col_names in self._get_storage_columns(new_columns_names)
+                if storage_name not in col_names
+                for col_name in col_names
+            }
+
+            fields_table_data['array_column'] = fields_table_data['column_name'].map(arrays_columns)
+
+        return fields_table_data
+
     def _get_file_encoding(self, csv_file):
+        # compressed files can be listed with or without their compression extension
         csv_file_name = os.path.basename(csv_file)
+        uncompressed_csv_file_name = strip_compression_extension(csv_file_name)
 
         csv_file_full_path = os.path.realpath(csv_file)
         csv_file_dir = os.path.dirname(csv_file_full_path)
@@ -324,113 +854,952 @@ class Pheno2SQL(DBAccess):
                 logger.error(f'{self.csv_files_encoding_file} has no unique files. Not using the file')
                 return self.csv_files_encoding
 
-            if csv_file_name in enc_file.index:
-                file_encoding = enc_file.at[csv_file_name]
-                logger.info(f'Encoding found in {self.csv_files_encoding_file}: {file_encoding}')
+            for enc_file_name in (csv_file_name, uncompressed_csv_file_name):
+                if enc_file_name in enc_file.index:
+                    file_encoding = enc_file.at[enc_file_name]
+                    logger.info(f'Encoding found in {self.csv_files_encoding_file}: {file_encoding}')
 
-                return file_encoding
+                    return file_encoding
         else:
             logger.warning(f'No {self.csv_files_encoding_file} found, assuming {self.csv_files_encoding}')
             return self.csv_files_encoding
 
-    def _save_column_range(self, csv_file, csv_file_idx, column_names_idx, column_names):
-        table_name = self._get_table_name(column_names_idx, csv_file_idx)
-        output_csv_filename = os.path.join(get_tmpdir(self.tmpdir), table_name + '.csv')
+    def _read_csv_sample(self, csv_file, nrows=1, **kwargs):
+        """
+        Reads the first rows of csv_file (which can be compressed), indexed by eid.
+        """
+        with open_csv_file(csv_file) as f:
+            return pd.read_csv(f, index_col=0, header=0, nrows=nrows, **kwargs)
+
+    def _get_csv_chunks(self, csv_file, column_names):
+        """
+        Reads the given columns of csv_file by chunks of self.loading_chunksize rows. Compressed files (.csv.gz or
+        .csv.zst) are decompressed while being read (see open_csv_file), without writing them to disk.
+        :param column_names: a list of tuples (old_column_name, new_column_name).
+        :return: a generator of data frames, indexed by eid, with the columns already renamed.
+        """
         full_column_names = ['eid'] + [x[0] for x in column_names]
+        worker_memory_limit = self._loading_tmp.get('worker_memory_limit')
+
+        with open_csv_file(csv_file) as f:
+            if worker_memory_limit is None:
+                data_reader = pd.read_csv(f, index_col=0, header=0, usecols=full_column_names,
+                                          chunksize=self.loading_chunksize, dtype=str,
+                                          encoding=self._get_file_encoding(csv_file))
+
+                for chunk in data_reader:
+                    yield chunk.rename(columns=self._rename_columns)
+
+                return
+
+            # chunks are sized to fit in the memory left to this worker; the first one is small, to measure rows
+            chunk_sizer = ChunkSizer(worker_memory_limit - get_rss(), self.LOADING_MIN_CHUNKSIZE,
+                                     min_chunksize=self.LOADING_MIN_CHUNKSIZE,
+                                     max_chunksize=self.LOADING_MAX_CHUNKSIZE,
+                                     overhead=self.LOADING_CHUNK_MEMORY_OVERHEAD)
+
+            data_reader = pd.read_csv(f, index_col=0, header=0, usecols=full_column_names, iterator=True, dtype=str,
+                                      encoding=self._get_file_encoding(csv_file))
+
+            while True:
+                try:
+                    chunk = data_reader.get_chunk(chunk_sizer.get_chunksize())
+                except StopIteration:
+                    break
+
+                chunk_sizer.update(chunk)
+                yield chunk.rename(columns=self._rename_columns)
+
+    def _get_loading_n_jobs(self, jobs_column_names):
+        """
+        Returns the number of concurrent workers used to read CSV files. If a loading memory budget is set, workers
+        are limited so that each one can process chunks of loading_chunksize rows of its widest job, and the memory
+        budget of each worker is saved for _get_csv_chunks.
+        :param jobs_column_names: a list of tuples (csv_file, column_names) with the columns read by each job;
+        column_names is a list of tuples (old_column_name, new_column_name).
+        """
+        if self.loading_memory_limit is None and self.loading_worker_memory_limit is None:
+            return self.loading_n_jobs
+
+        # SQLite is loaded in-process
+        n_jobs = get_n_jobs(self.loading_n_jobs) if self.db_type != 'sqlite' else 1
+
+        memory_limit = self.loading_memory_limit
+        if memory_limit is None:
+            memory_limit = get_available_memory() or self.loading_worker_memory_limit * n_jobs
+
+        # memory of a row of the widest job, measured on the first rows of each file
+        columns_bytes_per_row = {}
+        job_bytes_per_row = 0.0
+
+        for csv_file, column_names in jobs_column_names:
+            if csv_file not in columns_bytes_per_row:
+                data_sample = self._read_csv_sample(csv_file, nrows=self.LOADING_MEMORY_SAMPLE_ROWS, dtype=str,
+                                                    encoding=self._get_file_encoding(csv_file))
+                columns_bytes_per_row[csv_file] = get_columns_bytes_per_row(data_sample)
+
+            job_columns_bytes = columns_bytes_per_row[csv_file].reindex([x[0] for x in column_names]).fillna(0)
+            job_bytes_per_row = max(job_bytes_per_row, float(job_columns_bytes.sum()))
+
+        worker_memory = get_rss() + self.loading_chunksize * job_bytes_per_row * self.LOADING_CHUNK_MEMORY_OVERHEAD
+
+        if self.loading_worker_memory_limit is not None:
+            if worker_memory > self.loading_worker_memory_limit:
+                logger.warning('Worker memory limit is too low for chunks of {} rows, smaller chunks will be '
+                               'read'.format(self.loading_chunksize))
+
+            worker_memory = self.loading_worker_memory_limit
+
+        n_workers = int(max(1, min(n_jobs, memory_limit // max(worker_memory, 1))))
+
+        worker_memory_limit = memory_limit // n_workers
+        if self.loading_worker_memory_limit is not None:
+            worker_memory_limit = min(worker_memory_limit, self.loading_worker_memory_limit)
+
+        self._loading_tmp['worker_memory_limit'] = worker_memory_limit
+
+        logger.info('Loading with {} workers ({} requested), {:.0f} MB each ({:.0f} bytes per row)'.format(
+            n_workers, n_jobs, worker_memory_limit / 1024 ** 2, job_bytes_per_row))
 
-        data_reader = pd.read_csv(csv_file, index_col=0, header=0, usecols=full_column_names,
-                                  chunksize=self.loading_chunksize, dtype=str,
-                                  encoding=self._get_file_encoding(csv_file))
+        return n_workers
 
+    def _get_table_csv_file(self, table_name):
+        return os.path.join(get_tmpdir(self.tmpdir), table_name + '.csv')
+
+    def _get_events_csv_file(self, csv_file_idx):
+        return self._get_table_csv_file('{}{}_events'.format(self.table_prefix, csv_file_idx))
+
+    def _get_events_data(self, chunk, events_column_names):
+        """
+        Returns the rows of the events table for a chunk of data: one row for each participant, field instance and
+        distinct value found in the categorical (multiple) columns.
+        :param chunk: a data frame indexed by eid, with columns already renamed.
+        :param events_column_names: a list of tuples (old_column_name, new_column_name).
+        :return: a data frame indexed by eid, with columns field_id, instance and event.
+        """
+        fields_info = {
+            new_col_name: re.match(Pheno2SQL.RE_FIELD_INFO, new_col_name).group('field_id', 'instance')
+            for old_col_name, new_col_name in events_column_names
+        }
+
+        events_data = chunk.loc[:, list(fields_info.keys())].stack().reset_index()
+        events_data.columns = ['eid', 'column_name', 'event']
+
+        events_data = pd.DataFrame({
+            'eid': events_data['eid'],
+            'field_id': events_data['column_name'].map(lambda x: fields_info[x][0]),
+            'instance': events_data['column_name'].map(lambda x: fields_info[x][1]),
+            'event': events_data['event'],
+        }, columns=['eid', 'field_id', 'instance', 'event'])
+
+        return events_data.drop_duplicates().set_index('eid')
+
+    def _save_events(self, csv_file, csv_file_idx, events_column_names):
+        """
+        Writes the events of the categorical (multiple) columns of csv_file to a temporary CSV file, which is loaded
+        into the events table together with the rest of temporary files.
+        :return: a tuple ('events', output_csv_filename).
+        """
+        output_csv_filename = self._get_events_csv_file(csv_file_idx)
+
+        logger.debug('{}'.format(output_csv_filename))
+
+        with self._measure_stage('events', csv_file=csv_file, table_name='events') as stage_metrics:
+            with open(output_csv_filename, 'w', newline='') as output_file:
+                for chunk_idx, chunk in enumerate(self._get_csv_chunks(csv_file, events_column_names)):
+                    self._get_events_data(chunk, events_column_names).to_csv(output_file, quoting=csv.QUOTE_NONNUMERIC,
+                                                                             header=(chunk_idx == 0))
+            stage_metrics['bytes_read'] = os.path.getsize(csv_file)
+            stage_metrics['bytes_written'] = os.path.getsize(output_csv_filename)
+
+        self._mark_step_done(csv_file, 'events', 'split')
+
+        return 'events', output_csv_filename
+
+    def _save_column_range(self, csv_file, csv_file_idx, column_names_idx, column_names):
+        table_name = self._get_table_name(column_names_idx, csv_file_idx)
+        output_csv_filename = self._get_table_csv_file(table_name)
         new_columns = [x[1] for x in column_names]
 
-        logger.debug('{}'.format(output_csv_filename))
+        logger.debug('{}'.format(output_csv_filename))
+
+        write_headers = True
+        if self.db_type == 'sqlite':
+            write_headers = False
+
+        n_rows = 0
+        columns_stats = self._get_columns_stats(new_columns)
+
+        with self._measure_stage('split', csv_file=csv_file, table_name=table_name) as stage_metrics:
+            for chunk_idx, chunk in enumerate(self._get_csv_chunks(csv_file, column_names)):
+                # chunk = self._replace_null_str(chunk)
+                n_rows += chunk.shape[0]
+                self._update_columns_stats(columns_stats, chunk)
+
+                if chunk_idx == 0:
+                    self._get_table_data(chunk, new_columns).to_csv(output_csv_filename, quoting=csv.QUOTE_NONNUMERIC, na_rep=np.nan, header=write_headers, mode='w')
+                else:
+                    self._get_table_data(chunk, new_columns).to_csv(output_csv_filename, quoting=csv.QUOTE_NONNUMERIC, na_rep=np.nan, header=False, mode='a')
+
+            stage_metrics['rows'] = n_rows
+            stage_metrics['bytes_read'] = os.path.getsize(csv_file)
+            stage_metrics['bytes_written'] = os.path.getsize(output_csv_filename)
+
+        self._save_columns_stats(columns_stats)
+        self._mark_step_done(csv_file, table_name, 'split', n_rows)
+
+        return table_name, output_csv_filename
+
+    def _save_all_column_ranges(self, csv_file, csv_file_idx, chunked_column_names, events_column_names=()):
+        """
+        Reads csv_file only once and, for each chunk of rows, writes the columns of every column range to its own
+        temporary CSV file.
+        :param chunked_column_names: a list of tuples (column_names_idx, column_names).
+        :param events_column_names: categorical (multiple) columns whose events are written to their own temporary
+        CSV file (see _save_events).
+        :return: a list of tuples (table_name, output_csv_filename), one per column range (and one for events).
+        """
+        tables_columns = [
+            (self._get_table_name(column_names_idx, csv_file_idx), [x[1] for x in column_names])
+            for column_names_idx, column_names in chunked_column_names
+        ]
+
+        all_column_names = [x for column_names_idx, column_names in chunked_column_names for x in column_names]
+        all_column_names.extend(x for x in events_column_names if x not in all_column_names)
+
+        write_headers = True
+        if self.db_type == 'sqlite':
+            write_headers = False
+
+        output_files = {
+            table_name: open(self._get_table_csv_file(table_name), 'w', newline='')
+            for table_name, new_columns in tables_columns
+        }
+
+        if len(events_column_names) > 0:
+            output_files['events'] = open(self._get_events_csv_file(csv_file_idx), 'w', newline='')
+
+        n_rows = 0
+        columns_stats = self._get_columns_stats([x for table_name, new_columns in tables_columns for x in new_columns])
+
+        with self._measure_stage('split', csv_file=csv_file, n_tables=len(tables_columns)) as stage_metrics:
+            try:
+                for chunk_idx, chunk in enumerate(self._get_csv_chunks(csv_file, all_column_names)):
+                    n_rows += chunk.shape[0]
+                    self._update_columns_stats(columns_stats, chunk)
+
+                    for table_name, new_columns in tables_columns:
+                        self._get_table_data(chunk, new_columns).to_csv(output_files[table_name], quoting=csv.QUOTE_NONNUMERIC,
+                                                         na_rep=np.nan, header=(write_headers and chunk_idx == 0))
+
+                    if len(events_column_names) > 0:
+                        self._get_events_data(chunk, events_column_names).to_csv(
+                            output_files['events'], quoting=csv.QUOTE_NONNUMERIC, header=(chunk_idx == 0))
+            finally:
+                for output_file in output_files.values():
+                    output_file.close()
+
+            stage_metrics['rows'] = n_rows
+            stage_metrics['bytes_read'] = os.path.getsize(csv_file)
+            stage_metrics['bytes_written'] = sum(os.path.getsize(f.name) for f in output_files.values())
+
+        self._save_columns_stats(columns_stats)
+
+        for table_name, new_columns in tables_columns:
+            self._mark_step_done(csv_file, table_name, 'split', n_rows)
+
+        if len(events_column_names) > 0:
+            self._mark_step_done(csv_file, 'events', 'split')
+
+        return [(table_name, output_file.name) for table_name, output_file in output_files.items()]
+
+    def _create_temporary_csvs(self, csv_files_idx):
+        """
+        Writes the temporary CSV files of all given CSV files. Files are split concurrently, sharing the same pool of
+        loading_n_jobs workers: each column range (and events) is a job, or each CSV file if loading_single_pass is
+        True.
+        :param csv_files_idx: indexes of CSV files in self.ukb_csvs.
+        """
+        logger.info('Writing temporary CSV files')
+
+        # list of tuples (csv_file, table_name, file_path); temporary files written in a previous run are reused
+        self.table_csvs = []
+        save_jobs = []
+        save_jobs_csv_files = []
+        save_jobs_column_names = []
+
+        for csv_file_idx in csv_files_idx:
+            csv_file = self.ukb_csvs[csv_file_idx]
+            basket = self._loading_tmp['baskets'][csv_file_idx]
+            column_ranges_to_save = []
+
+            for column_names_idx, column_names in basket['pending_column_names']:
+                table_name = self._get_table_name(column_names_idx, csv_file_idx)
+                output_csv_filename = self._get_table_csv_file(table_name)
+
+                if self._is_step_done(csv_file, table_name, 'split') and os.path.isfile(output_csv_filename):
+                    logger.info('Temporary CSV file for table {} already written'.format(table_name))
+                    self.table_csvs.append((csv_file, table_name, output_csv_filename))
+                else:
+                    column_ranges_to_save.append((column_names_idx, column_names))
+
+            events_column_names = basket['events_column_names']
+            events_csv_filename = self._get_events_csv_file(csv_file_idx)
+
+            if len(events_column_names) > 0 and self._is_step_done(csv_file, 'events', 'split') \
+                    and os.path.isfile(events_csv_filename):
+                logger.info('Temporary CSV file for events already written')
+                self.table_csvs.append((csv_file, 'events', events_csv_filename))
+                events_column_names = ()
+
+            if len(column_ranges_to_save) == 0 and len(events_column_names) == 0:
+                continue
+
+            if self.loading_single_pass:
+                save_jobs.append(delayed(self._save_all_column_ranges)(csv_file, csv_file_idx, column_ranges_to_save,
+                                                                       events_column_names))
+                save_jobs_csv_files.append(csv_file)
+                save_jobs_column_names.append(
+                    [x for idx, column_names in column_ranges_to_save for x in column_names] + list(events_column_names))
+                continue
+
+            for column_names_idx, column_names in column_ranges_to_save:
+                save_jobs.append(delayed(self._save_column_range)(csv_file, csv_file_idx, column_names_idx,
+                                                                  column_names))
+                save_jobs_csv_files.append(csv_file)
+                save_jobs_column_names.append(column_names)
+
+            if len(events_column_names) > 0:
+                save_jobs.append(delayed(self._save_events)(csv_file, csv_file_idx, events_column_names))
+                save_jobs_csv_files.append(csv_file)
+                save_jobs_column_names.append(events_column_names)
+
+        if len(save_jobs) == 0:
+            return
+
+        n_jobs = self._get_loading_n_jobs(list(zip(save_jobs_csv_files, save_jobs_column_names)))
+
+        self._close_db_engine()
+        saved_files = Parallel(n_jobs=n_jobs)(save_jobs)
+
+        for csv_file, job_saved_files in zip(save_jobs_csv_files, saved_files):
+            if not self.loading_single_pass:
+                job_saved_files = [job_saved_files]
+
+            self.table_csvs.extend((csv_file, table_name, file_path) for table_name, file_path in job_saved_files)
+
+    def _load_single_csv(self, csv_file, table_name, file_path):
+        logger.info('{} -> {}'.format(file_path, table_name))
+
+        statement = (
+            "\copy {table_name} from '{file_path}' (format csv, header, null ('nan'))"
+        ).format(**locals())
+
+        with self._measure_stage('copy', csv_file=csv_file, table_name=table_name) as stage_metrics:
+            self._run_psql(statement)
+            stage_metrics['bytes_read'] = os.path.getsize(file_path)
+
+        self._mark_step_done(csv_file, table_name, 'copy')
+
+        if self.delete_temp_csv:
+            logger.debug(f'Removing CSV already loaded: {file_path}')
+            os.remove(file_path)
+
+    def _load_csv(self):
+        logger.info('Loading CSV files into database')
+
+        self._close_db_engine()
+        Parallel(n_jobs=self.loading_n_jobs)(
+            delayed(self._load_single_csv)(csv_file, table_name, file_path)
+            for csv_file, table_name, file_path in self.table_csvs
+        )
+
+    def _copy_data_frame(self, cursor, table_name, data_frame):
+        """
+        Writes data_frame into table_name using COPY ... FROM STDIN. The data frame is serialized into an in-memory
+        buffer, so its size should be bounded (a chunk of rows). Returns the number of characters written.
+        """
+        buffer = StringIO()
+        data_frame.to_csv(buffer, quoting=csv.QUOTE_NONNUMERIC, na_rep=np.nan, header=False)
+        n_chars = buffer.tell()
+        buffer.seek(0)
+
+        copy_sql = "COPY {table_name} ({columns}) FROM STDIN (format csv, null 'nan')".format(
+            table_name=table_name,
+            columns=', '.join([data_frame.index.name] + data_frame.columns.tolist())
+        )
+
+        cursor.copy_expert(copy_sql, buffer)
+
+        return n_chars
+
+    def _copy_binary_data_frame(self, cursor, table_name, data_frame):
+        """
+        Writes data_frame into table_name using COPY ... FROM STDIN in binary format. Values are converted to the types
+        returned by _get_db_columns_dtypes (see get_binary_copy_data). Returns the number of bytes written.
+        """
+        if table_name == 'events':
+            db_dtypes = {'field_id': INT, 'instance': INT, 'event': TEXT}
+        else:
+            db_dtypes = self._loading_tmp['db_dtypes']
+
+        data = get_binary_copy_data(data_frame, db_dtypes)
+        buffer = BytesIO(data)
+
+        copy_sql = "COPY {table_name} ({columns}) FROM STDIN (format binary)".format(
+            table_name=table_name,
+            columns=', '.join([data_frame.index.name] + data_frame.columns.tolist())
+        )
+
+        cursor.copy_expert(copy_sql, buffer)
+
+        return len(data)
+
+    def _insert_data_frame(self, cursor, table_name, data_frame):
+        """
+        Writes data_frame into table_name using batched INSERT statements (executemany). This is used for SQLite,
+        which has no COPY command. Missing values are written as NULL.
+        """
+        insert_sql = 'INSERT INTO {table_name} ({columns}) VALUES ({values})'.format(
+            table_name=table_name,
+            columns=', '.join([data_frame.index.name] + data_frame.columns.tolist()),
+            values=', '.join(['?'] * (data_frame.shape[1] + 1))
+        )
+
+        data_frame = data_frame.astype(object).where(data_frame.notnull(), None)
+
+        cursor.executemany(insert_sql, data_frame.itertuples(index=True, name=None))
+
+    def _set_sqlite_pragmas(self, cursor):
+        """
+        Tunes SQLite for bulk loading: no fsync and rollback journal kept in memory. The database might be corrupted if
+        the process is killed, but it is always loaded from scratch in that case.
+        """
+        cursor.execute('PRAGMA synchronous = OFF')
+        cursor.execute('PRAGMA journal_mode = MEMORY')
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        cursor.execute('PRAGMA cache_size = -{}'.format(256 * 1024))
+
+    def _stream_column_ranges(self, csv_file, csv_file_idx, chunked_column_names, events_column_names=()):
+        """
+        Reads csv_file once and streams the columns of each column range into its table. All tables are written in
+        a single transaction, using one connection from the pool.
+        :param chunked_column_names: a list of tuples (column_names_idx, column_names).
+        :param events_column_names: categorical (multiple) columns whose events are streamed into the events table.
+        :return: list of table names loaded.
+        """
+        tables_columns = [
+            (self._get_table_name(column_names_idx, csv_file_idx), [x[1] for x in column_names])
+            for column_names_idx, column_names in chunked_column_names
+        ]
+
+        all_column_names = [x for column_names_idx, column_names in chunked_column_names for x in column_names]
+        all_column_names.extend(x for x in events_column_names if x not in all_column_names)
+
+        n_rows = 0
+        columns_stats = self._get_columns_stats([x for table_name, new_columns in tables_columns for x in new_columns])
+
+        write_data_frame = self._copy_data_frame
+        if self.db_type == 'sqlite':
+            write_data_frame = self._insert_data_frame
+        elif self.loading_binary_copy:
+            write_data_frame = self._copy_binary_data_frame
+
+        stage_name = 'copy' if len(tables_columns) > 0 else 'events'
+        stage_table_name = tables_columns[0][0] if len(tables_columns) == 1 else None
+
+        with self._measure_stage(stage_name, csv_file=csv_file, table_name=stage_table_name,
+                                 n_tables=len(tables_columns)) as stage_metrics:
+            conn = self._get_db_engine().raw_connection()
+            n_bytes_written = 0
+
+            try:
+                cursor = conn.cursor()
+
+                if self.db_type == 'sqlite':
+                    self._set_sqlite_pragmas(cursor)
+
+                for chunk in self._get_csv_chunks(csv_file, all_column_names):
+                    n_rows += chunk.shape[0]
+                    self._update_columns_stats(columns_stats, chunk)
+
+                    for table_name, new_columns in tables_columns:
+                        n_bytes_written += write_data_frame(cursor, table_name,
+                                                            self._get_table_data(chunk, new_columns)) or 0
+
+                    if len(events_column_names) > 0:
+                        n_bytes_written += write_data_frame(cursor, 'events',
+                                                            self._get_events_data(chunk, events_column_names)) or 0
+
+                cursor.close()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+
+            stage_metrics['rows'] = n_rows
+            stage_metrics['bytes_read'] = os.path.getsize(csv_file)
+            stage_metrics['bytes_written'] = n_bytes_written
+
+        self._save_columns_stats(columns_stats)
+
+        for table_name, new_columns in tables_columns:
+            self._mark_step_done(csv_file, table_name, 'copy', n_rows)
+
+        if len(events_column_names) > 0:
+            self._mark_step_done(csv_file, 'events', 'copy')
+
+        return [table_name for table_name, new_columns in tables_columns]
+
+    def _stream_csv(self, csv_files_idx):
+        """
+        Streams all given CSV files into the database. As with temporary CSV files, files are loaded concurrently
+        sharing the same pool of loading_n_jobs workers.
+        :param csv_files_idx: indexes of CSV files in self.ukb_csvs.
+        """
+        logger.info('Streaming CSV files into database')
+
+        # list of tuples with the arguments of _stream_column_ranges
+        stream_jobs = []
+
+        for csv_file_idx in csv_files_idx:
+            csv_file = self.ukb_csvs[csv_file_idx]
+            basket = self._loading_tmp['baskets'][csv_file_idx]
+            chunked_column_names = basket['pending_column_names']
+            events_column_names = basket['events_column_names']
+
+            if self.db_type == 'sqlite' or self.loading_single_pass:
+                stream_jobs.append((csv_file, csv_file_idx, chunked_column_names, events_column_names))
+            else:
+                stream_jobs.extend(
+                    (csv_file, csv_file_idx, (column_range,), ())
+                    for column_range in chunked_column_names
+                )
+
+                if len(events_column_names) > 0:
+                    stream_jobs.append((csv_file, csv_file_idx, (), events_column_names))
+
+        if len(stream_jobs) == 0:
+            return
+
+        n_jobs = self._get_loading_n_jobs([
+            (csv_file, [x for idx, column_names in chunked_column_names for x in column_names] +
+             list(events_column_names))
+            for csv_file, csv_file_idx, chunked_column_names, events_column_names in stream_jobs
+        ])
+
+        # SQLite supports only one writer at a time
+        if self.db_type == 'sqlite':
+            for stream_job in stream_jobs:
+                self._stream_column_ranges(*stream_job)
+
+            return
+
+        self._close_db_engine()
+        Parallel(n_jobs=n_jobs)(delayed(self._stream_column_ranges)(*stream_job) for stream_job in stream_jobs)
+
+    def _get_basket_tables(self, csv_file):
+        """Returns the names of the tables created for csv_file, according to the load manifest."""
+        manifest_csv_file = self._get_manifest_csv_file(csv_file)
+
+        return sorted(
+            table_name for manifest_file, table_name, step in self._loading_tmp['manifest']
+            if manifest_file == manifest_csv_file and step == 'schema'
+        )
+
+    def _get_next_table_names(self, csv_file, n_tables):
+        """
+        Returns n_tables new table names for csv_file. If the file was loaded before, the new tables continue its
+        numbering; otherwise, a new file index (not used by any other table) is taken.
+        """
+        table_name_pattern = re.compile('^{}(?P<file_idx>[0-9]+)_(?P<range_idx>[0-9]+)$'.format(re.escape(self.table_prefix)))
+
+        all_tables = pd.read_sql('select distinct table_name from fields', self._get_db_engine())['table_name']
+        all_tables_matches = [re.match(table_name_pattern, t) for t in all_tables if t is not None]
+        all_tables_idxs = [(int(m.group('file_idx')), int(m.group('range_idx'))) for m in all_tables_matches if m is not None]
+
+        basket_tables_matches = [re.match(table_name_pattern, t) for t in self._get_basket_tables(csv_file)]
+        basket_tables_idxs = [(int(m.group('file_idx')), int(m.group('range_idx'))) for m in basket_tables_matches if m is not None]
+
+        if len(basket_tables_idxs) > 0:
+            csv_file_idx = basket_tables_idxs[0][0]
+        else:
+            csv_file_idx = max([file_idx for file_idx, range_idx in all_tables_idxs], default=-1) + 1
+
+        next_range_idx = max([range_idx for file_idx, range_idx in all_tables_idxs if file_idx == csv_file_idx], default=-1) + 1
+
+        return [self._get_table_name(next_range_idx + i, csv_file_idx) for i in range(n_tables)]
+
+    def _add_new_columns(self, csv_file, new_columns):
+        """
+        Adds the new columns of csv_file to the database: first, the tables of csv_file with space left (according to
+        n_columns_per_table) are filled, then new tables are created.
+        :param new_columns: a list of tuples (old_column_name, new_column_name).
+        :return: a dictionary with table names as keys and the list of columns added to them as values.
+        """
+        if len(new_columns) == 0:
+            return {}
+
+        db_types_old_column_names, all_fields_dtypes, all_fields_description, all_fields_coding = self._get_db_columns_dtypes(csv_file)
+        db_dtypes = {self._rename_columns(k): v for k, v in db_types_old_column_names.items()}
+        self._fields_dtypes.update(all_fields_dtypes)
+
+        tables_n_columns = pd.read_sql('select table_name, count(*) as n_columns from fields group by table_name',
+                                       self._get_db_engine(), index_col='table_name')['n_columns']
+
+        pending_columns = list(new_columns)
+        tables_new_columns = {}
+
+        # fill existing tables of this file
+        for table_name in self._get_basket_tables(csv_file):
+            n_free_columns = self.n_columns_per_table - (tables_n_columns[table_name] if table_name in tables_n_columns else 0)
+
+            if n_free_columns <= 0 or len(pending_columns) == 0:
+                continue
+
+            table_columns = pending_columns[:n_free_columns]
+            pending_columns = pending_columns[n_free_columns:]
+
+            with self._get_db_engine().connect() as conn:
+                for old_col_name, new_col_name in table_columns:
+                    conn.execute('ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type};'.format(
+                        table_name=table_name, column_name=new_col_name,
+                        column_type=db_dtypes[new_col_name]().compile(dialect=self._get_db_engine().dialect)
+                    ))
+
+            tables_new_columns[table_name] = table_columns
+
+        # create new tables for the rest
+        chunked_pending_columns = list(self._chunker(pending_columns, self.n_columns_per_table))
+        data_sample = self._read_csv_sample(csv_file, dtype=str)
+        data_sample = data_sample.rename(columns=self._rename_columns)
+
+        for table_name, table_columns in zip(self._get_next_table_names(csv_file, len(chunked_pending_columns)),
+                                             chunked_pending_columns):
+            new_columns_names = [x[1] for x in table_columns]
+            logger.info('Table {} ({} columns)'.format(table_name, len(new_columns_names)))
+
+            self._create_table_structure(table_name, data_sample.loc[[], new_columns_names], db_dtypes)
+            self._mark_step_done(csv_file, table_name, 'schema')
+
+            tables_new_columns[table_name] = table_columns
+
+        # update fields table
+        for table_name, table_columns in tables_new_columns.items():
+            logger.info('Adding {} new columns to table {}'.format(len(table_columns), table_name))
+
+            aux_table = self._get_fields_table_data(table_name, [x[1] for x in table_columns], all_fields_dtypes,
+                                                    all_fields_description, all_fields_coding)
+            aux_table.to_sql('fields', self._get_db_engine(), index=False, if_exists='append')
+
+            self.table_list.add(table_name)
+
+        return tables_new_columns
+
+    def _merge_csv_data(self, csv_file, tables_columns):
+        """
+        Reads csv_file once into temporary staging tables, and then, for each table, updates only the rows that
+        changed and inserts new participants. New participants are also added to the all_eids table, and the events
+        of all participants updated or inserted are recomputed. Everything is done in a single transaction.
+        :param tables_columns: a dictionary with table names as keys and a list of tuples (old_column_name,
+        new_column_name) as values.
+        """
+        all_column_names = [x for table_columns in tables_columns.values() for x in table_columns]
+
+        conn = self._get_db_engine().raw_connection()
+
+        try:
+            cursor = conn.cursor()
+
+            cursor.execute('CREATE TEMP TABLE refreshed_eids (eid bigint NOT NULL) ON COMMIT DROP')
+
+            for table_name, table_columns in tables_columns.items():
+                cursor.execute("""
+                    CREATE TEMP TABLE staging_{table_name} ON COMMIT DROP AS
+                    SELECT eid, {columns} FROM {table_name} WITH NO DATA
+                """.format(table_name=table_name, columns=', '.join(x[1] for x in table_columns)))
+
+            for chunk in self._get_csv_chunks(csv_file, all_column_names):
+                for table_name, table_columns in tables_columns.items():
+                    self._copy_data_frame(cursor, 'staging_' + table_name, chunk.loc[:, [x[1] for x in table_columns]])
+
+            for table_name, table_columns in tables_columns.items():
+                columns = [x[1] for x in table_columns]
+
+                cursor.execute("""
+                    WITH updated AS (
+                        UPDATE {table_name} t
+                        SET {set_columns}
+                        FROM staging_{table_name} s
+                        WHERE t.eid = s.eid AND ({target_columns}) IS DISTINCT FROM ({staging_columns})
+                        RETURNING t.eid
+                    )
+                    INSERT INTO refreshed_eids (eid) SELECT eid FROM updated
+                """.format(
+                    table_name=table_name,
+                    set_columns=', '.join('{0} = s.{0}'.format(c) for c in columns),
+                    target_columns=', '.join('t.{}'.format(c) for c in columns),
+                    staging_columns=', '.join('s.{}'.format(c) for c in columns),
+                ))
+                n_updated = cursor.rowcount
+
+                cursor.execute("""
+                    WITH inserted AS (
+                        INSERT INTO {table_name} (eid, {columns})
+                        SELECT s.eid, {staging_columns}
+                        FROM staging_{table_name} s
+                        WHERE NOT EXISTS (SELECT 1 FROM {table_name} t WHERE t.eid = s.eid)
+                        RETURNING eid
+                    )
+                    INSERT INTO refreshed_eids (eid) SELECT eid FROM inserted
+                """.format(
+                    table_name=table_name,
+                    columns=', '.join(columns),
+                    staging_columns=', '.join('s.{}'.format(c) for c in columns),
+                ))
+                n_inserted = cursor.rowcount
+
+                logger.info('Table {}: {} rows updated, {} rows inserted'.format(table_name, n_updated, n_inserted))
+
+            cursor.execute("""
+                INSERT INTO {all_eids_table} (eid)
+                SELECT DISTINCT r.eid
+                FROM refreshed_eids r
+                WHERE NOT EXISTS (SELECT 1 FROM {all_eids_table} a WHERE a.eid = r.eid)
+            """.format(all_eids_table=ALL_EIDS_TABLE))
+
+            # recompute events of participants updated or inserted
+            categorical_variables = pd.read_sql("""
+                select column_name, field_id, inst, table_name
+                from fields
+                where type = 'Categorical (multiple)'
+            """, self._get_db_engine())
+
+            categorical_variables = categorical_variables.loc[categorical_variables['table_name'].isin(tables_columns.keys())]
+
+            for (field_id, field_instance), field_data in categorical_variables.groupby(by=['field_id', 'inst']):
+                cursor.execute("""
+                    DELETE FROM events
+                    WHERE field_id = {field_id} AND instance = {field_instance}
+                    AND eid IN (SELECT eid FROM refreshed_eids)
+                """.format(field_id=field_id, field_instance=field_instance))
+
+                cursor.execute(self._get_events_insert_sql(field_id, field_instance, field_data,
+                                                           eids_table='refreshed_eids'))
+
+            cursor.close()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _refresh_csv(self, csv_file):
+        """
+        Updates the database with the content of csv_file, a new version of a file already loaded (with the same file
+        name). New columns are added, and only rows that changed or new participants are written.
+        """
+        logger.info('Refreshing data from {}'.format(csv_file))
+
+        tmp = self._read_csv_sample(csv_file, low_memory=False)
+        old_columns = tmp.columns.tolist()
+        del tmp
+
+        loaded_columns = pd.read_sql('select column_name, table_name from fields', self._get_db_engine())
+        loaded_columns = dict(zip(loaded_columns['column_name'], loaded_columns['table_name']))
+
+        basket_tables = self._get_basket_tables(csv_file)
+
+        tables_columns = {}
+        new_columns = []
+
+        for old_col_name in old_columns:
+            new_col_name = self._rename_columns(old_col_name)
+
+            if new_col_name not in loaded_columns:
+                new_columns.append((old_col_name, new_col_name))
+                continue
+
+            table_name = loaded_columns[new_col_name]
+            if table_name not in basket_tables:
+                logger.warning(f'Column {new_col_name} already loaded from another file ({table_name}). Skipping.')
+                continue
+
+            tables_columns.setdefault(table_name, []).append((old_col_name, new_col_name))
+
+        for table_name, table_columns in self._add_new_columns(csv_file, new_columns).items():
+            tables_columns.setdefault(table_name, []).extend(table_columns)
+
+        if len(tables_columns) == 0:
+            logger.warning('No columns to refresh in {}'.format(csv_file))
+            return
+
+        self._merge_csv_data(csv_file, tables_columns)
+
+    def _refresh_data(self):
+        if self.db_type != 'postgresql':
+            raise UkbRestProgramExecutionError('Incremental loading is only supported in PostgreSQL')
+
+        if self.loading_array_columns or self.loading_categorical_codes or len(self._get_columns_storage()[0]) > 0:
+            raise UkbRestProgramExecutionError('Incremental loading is not supported with array columns or encoded '
+                                               'categorical columns')
+
+        if self.loading_field_stats:
+            logger.warning('Field statistics are not updated by incremental loads')
+
+        self._init_load_manifest(resume=True)
+
+        for csv_file in self.ukb_csvs:
+            self._refresh_csv(csv_file)
+
+        self._create_constraints()
+
+    def _get_manifest_csv_file(self, csv_file):
+        return os.path.basename(csv_file)
+
+    def _init_load_manifest(self, resume):
+        """
+        Creates the load manifest table, where the completed steps of each table are recorded, and the columns of each
+        table (step 'partition'). If resume is False, any previous manifest is discarded.
+        """
+        create_table(LOAD_MANIFEST_TABLE,
+            columns=[
+                'csv_file text NOT NULL',
+                'table_name text NOT NULL',
+                'step text NOT NULL',
+                'n_rows bigint',
+                'column_names text',
+            ],
+            constraints=[
+                'pk_{} PRIMARY KEY (csv_file, table_name, step)'.format(LOAD_MANIFEST_TABLE)
+            ],
+            db_engine=self._get_db_engine(),
+            drop_if_exists=not resume,
+            unlogged=self.db_schema is not None
+         )
 
-        write_headers = True
-        if self.db_type == 'sqlite':
-            write_headers = False
+        manifest = pd.read_sql("select csv_file, table_name, step from {} where step <> 'partition'".format(
+            LOAD_MANIFEST_TABLE), self._get_db_engine())
 
-        for chunk_idx, chunk in enumerate(data_reader):
-            chunk = chunk.rename(columns=self._rename_columns)
-            # chunk = self._replace_null_str(chunk)
+        self._loading_tmp['resume'] = resume
+        self._loading_tmp['manifest'] = set(manifest.itertuples(index=False, name=None))
 
-            if chunk_idx == 0:
-                chunk.loc[:, new_columns].to_csv(output_csv_filename, quoting=csv.QUOTE_NONNUMERIC, na_rep=np.nan, header=write_headers, mode='w')
-            else:
-                chunk.loc[:, new_columns].to_csv(output_csv_filename, quoting=csv.QUOTE_NONNUMERIC, na_rep=np.nan, header=False, mode='a')
+        if len(self._loading_tmp['manifest']) > 0:
+            logger.info('Resuming previous load ({} steps already completed)'.format(len(self._loading_tmp['manifest'])))
 
+    def _is_step_done(self, csv_file, table_name, step):
+        return (self._get_manifest_csv_file(csv_file), table_name, step) in self._loading_tmp['manifest']
 
-        return table_name, output_csv_filename
+    def _mark_step_done(self, csv_file, table_name, step, n_rows=None):
+        manifest_key = (self._get_manifest_csv_file(csv_file), table_name, step)
 
-    def _create_temporary_csvs(self, csv_file, csv_file_idx):
-        logger.info('Writing temporary CSV files')
+        with self._get_db_engine().connect() as conn:
+            conn.execute(text("""
+                delete from {manifest_table}
+                where csv_file = :csv_file and table_name = :table_name and step = :step
+            """.format(manifest_table=LOAD_MANIFEST_TABLE)), csv_file=manifest_key[0], table_name=table_name, step=step)
 
-        self._close_db_engine()
-        self.table_csvs = Parallel(n_jobs=self.loading_n_jobs)(
-            delayed(self._save_column_range)(csv_file, csv_file_idx, column_names_idx, column_names)
-            for column_names_idx, column_names in self._loading_tmp['chunked_column_names']
-        )
+            conn.execute(text("""
+                insert into {manifest_table} (csv_file, table_name, step, n_rows)
+                values (:csv_file, :table_name, :step, :n_rows)
+            """.format(manifest_table=LOAD_MANIFEST_TABLE)), csv_file=manifest_key[0], table_name=table_name, step=step,
+                n_rows=n_rows)
 
-        self.table_list.update(table_name for table_name, file_path in self.table_csvs)
+        self._loading_tmp['manifest'].add(manifest_key)
 
-    def _load_single_csv(self, table_name, file_path):
-        logger.info('{} -> {}'.format(file_path, table_name))
+    def _get_manifest_partition(self, csv_file, csv_file_idx):
+        """
+        Returns the column names of each table of csv_file recorded in the load manifest (see _save_manifest_partition),
+        as a list of lists ordered like tables, or None if they were not recorded.
+        :raise ValueError: if the recorded tables are not those of csv_file in this load (like if input files are given
+        in a different order than in the load being resumed).
+        """
+        manifest_partition = pd.read_sql(text("""
+            select table_name, column_names
+            from {manifest_table}
+            where csv_file = :csv_file and step = 'partition'
+        """.format(manifest_table=LOAD_MANIFEST_TABLE)), self._get_db_engine(),
+            params={'csv_file': self._get_manifest_csv_file(csv_file)}, index_col='table_name')['column_names']
 
-        if self.db_type == 'sqlite':
-            statement = (
-                '.mode csv\n' +
-                '.separator ","\n' +
-                '.headers on\n' +
-                '.import {file_path} {table_name}\n'
-            ).format(**locals())
+        if manifest_partition.shape[0] == 0:
+            return None
 
-            p = Popen(['sqlite3', self.db_file], stdout=PIPE, stdin=PIPE, stderr=PIPE)
-            stdout_data, stderr_data = p.communicate(input=str.encode(statement))
+        table_names = [self._get_table_name(col_idx, csv_file_idx) for col_idx in range(manifest_partition.shape[0])]
 
-            if p.returncode != 0:
-                raise Exception(stdout_data + b'\n' + stderr_data)
+        if sorted(table_names) != sorted(manifest_partition.index):
+            raise ValueError('The load manifest does not match the input files: {} was loaded into tables {}, but now '
+                             'its tables would be {}. Use the same files in the same order, or load them again without '
+                             'resuming'.format(csv_file, ', '.join(sorted(manifest_partition.index)),
+                                               ', '.join(table_names)))
 
-            # For each column, set NULL rows with empty strings
-            # FIXME: this codes needs refactoring
-            for col_name in self._loading_tmp['chunked_table_column_names'][table_name]:
-                statement = (
-                    'update {table_name} set {col_name} = null where {col_name} == "nan";'
-                ).format(**locals())
+        return [manifest_partition.loc[table_name].split(',') for table_name in table_names]
 
-                p = Popen(['sqlite3', self.db_file], stdout=PIPE, stdin=PIPE, stderr=PIPE)
-                stdout_data, stderr_data = p.communicate(input=str.encode(statement))
+    def _save_manifest_partition(self, csv_file, csv_file_idx, chunked_column_names):
+        """
+        Records in the load manifest the column names of each table of csv_file, so a resumed load creates the same
+        tables, even if the partition of columns would be different (see _create_tables_schema).
+        :param chunked_column_names: a list of tuples (column_names_idx, column_names).
+        """
+        manifest_csv_file = self._get_manifest_csv_file(csv_file)
+
+        with self._get_db_engine().connect() as conn:
+            conn.execute(text("""
+                delete from {manifest_table}
+                where csv_file = :csv_file and step = 'partition'
+            """.format(manifest_table=LOAD_MANIFEST_TABLE)), csv_file=manifest_csv_file)
+
+            for column_names_idx, column_names in chunked_column_names:
+                conn.execute(text("""
+                    insert into {manifest_table} (csv_file, table_name, step, column_names)
+                    values (:csv_file, :table_name, 'partition', :column_names)
+                """.format(manifest_table=LOAD_MANIFEST_TABLE)), csv_file=manifest_csv_file,
+                    table_name=self._get_table_name(column_names_idx, csv_file_idx),
+                    column_names=','.join(x[1] for x in column_names))
+
+    def _reset_post_load_steps(self):
+        """Post-load steps (like all_eids or events) need to run again if any table was (re)loaded."""
+        with self._get_db_engine().connect() as conn:
+            conn.execute("delete from {} where csv_file = ''".format(LOAD_MANIFEST_TABLE))
+
+        self._loading_tmp['manifest'] = {x for x in self._loading_tmp['manifest'] if x[0] != ''}
+
+    def _run_post_load_step(self, step_name, step_function):
+        if self._is_step_done('', step_name, 'done'):
+            logger.info('Step {} already completed'.format(step_name))
+            return
 
-                if p.returncode != 0:
-                    raise Exception(stdout_data + b'\n' + stderr_data)
+        with self._measure_stage(step_name):
+            step_function()
 
-        elif self.db_type == 'postgresql':
-            statement = (
-                "\copy {table_name} from '{file_path}' (format csv, header, null ('nan'))"
-            ).format(**locals())
+        self._mark_step_done('', step_name, 'done')
 
-            self._run_psql(statement)
+    def _verify_tables(self, csv_file, csv_file_idx):
+        """
+        Checks that the number of rows in each loaded table matches the number of rows read from csv_file.
+        """
+        for column_names_idx, column_names in self._loading_tmp['baskets'][csv_file_idx]['pending_column_names']:
+            table_name = self._get_table_name(column_names_idx, csv_file_idx)
 
-            if self.delete_temp_csv:
-                logger.debug(f'Removing CSV already loaded: {file_path}')
-                os.remove(file_path)
+            expected_n_rows = pd.read_sql(text("""
+                select max(n_rows) as n_rows
+                from {manifest_table}
+                where csv_file = :csv_file and table_name = :table_name
+            """.format(manifest_table=LOAD_MANIFEST_TABLE)), self._get_db_engine(),
+                params={'csv_file': self._get_manifest_csv_file(csv_file), 'table_name': table_name}).iloc[0, 0]
 
-    def _load_csv(self):
-        logger.info('Loading CSV files into database')
+            n_rows = pd.read_sql('select count(*) as n_rows from {}'.format(table_name),
+                                 self._get_db_engine()).iloc[0, 0]
 
-        if self.db_type != 'sqlite':
-            self._close_db_engine()
-            # parallel csv loading is only supported in databases different than sqlite
-            Parallel(n_jobs=self.loading_n_jobs)(
-                delayed(self._load_single_csv)(table_name, file_path)
-                for table_name, file_path in self.table_csvs
-            )
-        else:
-            for table_name, file_path in self.table_csvs:
-                self._load_single_csv(table_name, file_path)
+            if n_rows != expected_n_rows:
+                raise UkbRestSQLExecutionError('Table {} has {} rows, but {} were read from {}'.format(
+                    table_name, n_rows, expected_n_rows, csv_file))
 
-    def _load_all_eids(self):
-        logger.info('Loading all eids into table {}'.format(ALL_EIDS_TABLE))
+            self._mark_step_done(csv_file, table_name, 'verified', int(n_rows))
 
+    def _create_all_eids_table(self):
         create_table(ALL_EIDS_TABLE,
             columns=[
                 'eid bigint NOT NULL',
@@ -438,26 +1807,35 @@ class Pheno2SQL(DBAccess):
             constraints=[
                 'pk_{} PRIMARY KEY (eid)'.format(ALL_EIDS_TABLE)
             ],
-            db_engine=self._get_db_engine()
+            db_engine=self._get_db_engine(),
+            drop_if_exists=not self._loading_tmp['resume'],
+            unlogged=self.db_schema is not None
          )
 
-        select_eid_sql = ' UNION DISTINCT '.join(
-            'select eid from {}'.format(table_name)
-            for table_name in self.table_list
-        )
+    def _load_basket_eids(self, csv_file, csv_file_idx):
+        """
+        Adds the participants of csv_file to the all_eids table. All tables of a CSV file have the same participants,
+        so only one of them is read, and eids already present (from other files) are skipped.
+        """
+        chunked_column_names = self._loading_tmp['baskets'][csv_file_idx]['chunked_column_names']
 
-        insert_eids_sql = """
-            insert into {all_eids_table} (eid)
-            (
-                {sql_eids}
+        if len(chunked_column_names) > 0:
+            logger.info('Loading eids from {} into table {}'.format(csv_file, ALL_EIDS_TABLE))
+
+            insert_eids_sql = """
+                insert into {all_eids_table} (eid)
+                select t.eid
+                from {table_name} t
+                where not exists (select 1 from {all_eids_table} a where a.eid = t.eid)
+            """.format(
+                all_eids_table=ALL_EIDS_TABLE,
+                table_name=self._get_table_name(chunked_column_names[0][0], csv_file_idx)
             )
-        """.format(
-            all_eids_table=ALL_EIDS_TABLE,
-            sql_eids=select_eid_sql
-        )
 
-        with self._get_db_engine().connect() as con:
-            con.execute(insert_eids_sql)
+            with self._get_db_engine().connect() as con:
+                con.execute(insert_eids_sql)
+
+        self._mark_step_done(csv_file, ALL_EIDS_TABLE, 'copy')
 
     def _load_bgen_samples(self):
         if self.bgen_sample_file is None or not os.path.isfile(self.bgen_sample_file):
@@ -474,7 +1852,8 @@ class Pheno2SQL(DBAccess):
             constraints=[
                 'pk_{} PRIMARY KEY (index, eid)'.format(BGEN_SAMPLES_TABLE)
             ],
-            db_engine=self._get_db_engine()
+            db_engine=self._get_db_engine(),
+            unlogged=self.db_schema is not None
          )
 
         samples_data = pd.read_table(self.bgen_sample_file, sep=' ', header=0, usecols=['ID_1', 'ID_2'], skiprows=[1])
@@ -488,6 +1867,9 @@ class Pheno2SQL(DBAccess):
         current_env = os.environ.copy()
         current_env['PGPASSWORD'] = self.db_pass
 
+        if self.db_schema is not None:
+            current_env['PGOPTIONS'] = '-c search_path={}'.format(self.db_schema)
+
         p = Popen(['psql', '-w', '-h', self.db_host, '-p', str(self.db_port),
                    '-U', self.db_user, '-d', self.db_name,
                    '-f' if is_file else '-c', sql_statement],
@@ -502,16 +1884,14 @@ class Pheno2SQL(DBAccess):
         elif stderr_data is not None and 'ERROR:' in stderr_data:
             raise UkbRestSQLExecutionError(stderr_data)
 
-    def _load_events(self):
+    def _create_events_table(self):
+        """
+        Creates the events table. Its rows are written while loading each CSV file (see _get_events_data).
+        """
         if self.db_type == 'sqlite':
             logger.warning('Events loading is not supported in SQLite')
             return
 
-        logger.info('Loading events table')
-
-        # create table
-        db_engine = self._get_db_engine()
-
         create_table('events',
             columns=[
                 'eid bigint NOT NULL',
@@ -519,13 +1899,168 @@ class Pheno2SQL(DBAccess):
                 'instance integer NOT NULL',
                 'event text NOT NULL',
             ],
+            db_engine=self._get_db_engine(),
+            drop_if_exists=not self._loading_tmp['resume'],
+            unlogged=self.db_schema is not None
+         )
+
+    def _measure_stage(self, stage, **info):
+        """
+        Returns a context manager that records the metrics of a stage of load_data (see LoadMetrics.measure). Outside
+        load_data, metrics are not recorded.
+        """
+        load_metrics = getattr(self, '_loading_tmp', {}).get('load_metrics')
+
+        if load_metrics is None:
+            return no_measure()
+
+        return load_metrics.measure(stage, **info)
+
+    def _write_load_report(self, start_time, status):
+        """
+        Writes the report of load_data to loading_report_file, if set, and removes the metrics of its stages.
+        """
+        load_metrics = self._loading_tmp['load_metrics']
+
+        try:
+            if self.loading_report_file is not None:
+                load_metrics.write_report(
+                    self.loading_report_file,
+                    status=status,
+                    started=get_timestamp(start_time),
+                    finished=get_timestamp(time.time()),
+                    seconds=time.time() - start_time,
+                    csv_files=list(self.ukb_csvs),
+                    db_type=self.db_type,
+                    parameters={
+                        'n_columns_per_table': self.n_columns_per_table,
+                        'loading_n_jobs': self.loading_n_jobs,
+                        'loading_chunksize': self.loading_chunksize,
+                        'loading_single_pass': self.loading_single_pass,
+                        'loading_stream_copy': self.loading_stream_copy,
+                        'loading_binary_copy': self.loading_binary_copy,
+                        'loading_memory_limit': self.loading_memory_limit,
+                        'loading_worker_memory_limit': self.loading_worker_memory_limit,
+                    },
+                )
+        finally:
+            shutil.rmtree(load_metrics.metrics_dir, ignore_errors=True)
+
+    def _create_field_stats_table(self):
+        """
+        Creates the table with the statistics of each column (see _get_columns_stats). Its rows are written while
+        loading each CSV file.
+        """
+        create_table(FIELD_STATS_TABLE,
+            columns=[
+                'column_name text NOT NULL',
+                'n_rows bigint NOT NULL',
+                'n_nulls bigint NOT NULL',
+                'n_distinct bigint NOT NULL',
+                'min_value text',
+                'max_value text',
+                'histogram text',
+            ],
             constraints=[
-                'pk_events PRIMARY KEY (eid, field_id, instance, event)'
+                'pk_{} PRIMARY KEY (column_name)'.format(FIELD_STATS_TABLE)
             ],
-            db_engine=db_engine
+            db_engine=self._get_db_engine(),
+            drop_if_exists=not self._loading_tmp['resume'],
+            unlogged=self.db_schema is not None
          )
 
-        # insert data of categorical multiple fields
+    def _get_columns_stats(self, new_columns_names):
+        """
+        Returns a dictionary with a ColumnStats object for each column, or an empty one if loading_field_stats is False.
+        Continuous and integer columns are numeric; for the rest (like dates and categorical columns), values are
+        compared as strings.
+        """
+        if not self.loading_field_stats:
+            return {}
+
+        return {
+            col_name: ColumnStats(numeric=self._fields_dtypes.get(col_name) in ('Continuous', 'Integer'))
+            for col_name in new_columns_names
+        }
+
+    def _update_columns_stats(self, columns_stats, chunk):
+        for col_name, column_stats in columns_stats.items():
+            column_stats.update(chunk[col_name].values)
+
+    def _save_columns_stats(self, columns_stats):
+        """
+        Writes the statistics of the columns to the field_stats table, replacing any previous ones.
+        """
+        if len(columns_stats) == 0:
+            return
+
+        stats_data = pd.DataFrame([
+            dict(column_name=col_name, **column_stats.get_stats())
+            for col_name, column_stats in columns_stats.items()
+        ], columns=['column_name', 'n_rows', 'n_nulls', 'n_distinct', 'min_value', 'max_value', 'histogram'])
+
+        columns_quoted = ["'{}'".format(x.replace("'", "''")) for x in columns_stats.keys()]
+
+        with self._get_db_engine().connect() as conn:
+            conn.execute('delete from {} where column_name in ({})'.format(FIELD_STATS_TABLE, ','.join(columns_quoted)))
+
+        stats_data.to_sql(FIELD_STATS_TABLE, self._get_db_engine(), index=False, if_exists='append')
+
+    def _get_co_access_sets(self):
+        """
+        Reads the sets of columns queried together from loading_query_files (see read_co_access_sets).
+        """
+        if len(self.loading_query_files) == 0:
+            return {}
+
+        co_access_sets = read_co_access_sets(self.loading_query_files, Pheno2SQL.RE_COLUMN_NAME)
+        logger.info('Read {} queries ({} different sets of columns) from {} query files'.format(
+            sum(co_access_sets.values()), len(co_access_sets), len(self.loading_query_files)))
+
+        return co_access_sets
+
+    def _get_existing_col_names(self):
+        """
+        Decides, before loading any data, the CSV file each column is loaded from: the first file that contains it.
+        Only the headers of CSV files are read.
+        :return: a dictionary with column names (like c21_0_0) as keys and CSV files as values.
+        """
+        columns_and_csv_files = {}
+
+        for csv_file in self.ukb_csvs:
+            columns = self._read_csv_sample(csv_file, nrows=0).columns
+
+            for new_col_name in [self._rename_columns(x) for x in columns]:
+                columns_and_csv_files.setdefault(new_col_name, csv_file)
+
+        return columns_and_csv_files
+
+    def _get_shared_fields_instances(self):
+        """
+        Returns the field instances, as tuples (field_id, instance), with columns loaded from more than one CSV file
+        (see _get_existing_col_names).
+        """
+        fields_instances_files = {}
+
+        for new_col_name, csv_file in self._loading_tmp['existing_col_names'].items():
+            field_instance = re.match(Pheno2SQL.RE_FIELD_INFO, new_col_name).group('field_id', 'instance')
+            fields_instances_files.setdefault(field_instance, set()).add(csv_file)
+
+        return {
+            field_instance for field_instance, csv_files in fields_instances_files.items()
+            if len(csv_files) > 1
+        }
+
+    def _load_shared_events(self):
+        """
+        Writes the events of categorical (multiple) field instances with columns in tables from different CSV files.
+        These are not written while loading each file, since values would be duplicated.
+        """
+        shared_fields_instances = self._loading_tmp['shared_fields_instances']
+
+        if self.db_type == 'sqlite' or len(shared_fields_instances) == 0:
+            return
+
         categorical_variables = pd.read_sql("""
             select column_name, field_id, inst, table_name
             from fields
@@ -533,25 +2068,80 @@ class Pheno2SQL(DBAccess):
         """, self._get_db_engine())
 
         for (field_id, field_instance), field_data in categorical_variables.groupby(by=['field_id', 'inst']):
-            sql_st = """
-                insert into events (eid, field_id, instance, event)
-                (
-                    select distinct *
-                    from (
-                        select eid, {field_id}, {field_instance}, unnest(array[{field_columns}]) as event
-                        from {tables}
-                    ) t
-                    where t.event is not null
-                )
-            """.format(
-                field_id=field_id,
-                field_instance=field_instance,
-                field_columns=', '.join([cn for cn in set(field_data['column_name'])]),
-                tables=self._create_joins(list(set(field_data['table_name'])), join_type='inner join'),
+            if (str(field_id), str(field_instance)) not in shared_fields_instances:
+                continue
+
+            logger.info('Loading events of field {} (instance {}) from several files'.format(field_id, field_instance))
+
+            with self._get_db_engine().connect() as conn:
+                conn.execute('delete from events where field_id = {} and instance = {}'.format(field_id, field_instance))
+                conn.execute(self._get_events_insert_sql(field_id, field_instance, field_data))
+
+    def _delete_events(self, events_column_names):
+        """
+        Removes from the events table the rows of the field instances of the given columns, possibly written by a
+        previous run that did not finish.
+        """
+        fields_instances = {
+            re.match(Pheno2SQL.RE_FIELD_INFO, new_col_name).group('field_id', 'instance')
+            for old_col_name, new_col_name in events_column_names
+        }
+
+        if len(fields_instances) == 0:
+            return
+
+        with self._get_db_engine().connect() as conn:
+            conn.execute("""
+                delete from events
+                where (field_id, instance) in ({fields_instances})
+            """.format(fields_instances=', '.join('({}, {})'.format(*x) for x in sorted(fields_instances))))
+
+    def _get_events_insert_sql(self, field_id, field_instance, field_data, eids_table=None):
+        """
+        Returns the SQL statement that inserts into the events table all the values of a categorical (multiple) field
+        instance.
+        :param field_data: a data frame with columns 'column_name' and 'table_name' of the field instance.
+        :param eids_table: if given, only participants in this table (with column eid) are considered.
+        """
+        return """
+            insert into events (eid, field_id, instance, event)
+            (
+                select distinct *
+                from (
+                    select eid, {field_id}, {field_instance}, unnest(array[{field_columns}]) as event
+                    from {tables}
+                    {where_st}
+                ) t
+                where t.event is not null
             )
+        """.format(
+            field_id=field_id,
+            field_instance=field_instance,
+            field_columns=', '.join([cn for cn in set(field_data['column_name'])]),
+            tables=self._create_joins(list(set(field_data['table_name'])), join_type='inner join'),
+            where_st='where eid in (select eid from {})'.format(eids_table) if eids_table is not None else '',
+        )
 
-            with db_engine.connect() as con:
-                con.execute(sql_st)
+    def _get_primary_keys_sql(self):
+        """
+        Returns the SQL statements to create the primary keys of phenotype tables and the events table, which are not
+        created before loading data. Primary keys that already exist are skipped.
+        """
+        existing_primary_keys = set(pd.read_sql("""
+            select conname from pg_constraint
+            where contype = 'p' and connamespace = (select oid from pg_namespace where nspname = current_schema())
+        """, self._get_db_engine())['conname'])
+
+        tables = pd.read_sql('select distinct table_name from fields', self._get_db_engine())['table_name']
+        primary_keys = [(table_name, 'eid') for table_name in sorted(tables)]
+        primary_keys.append(('events', 'eid, field_id, instance, event'))
+
+        return [
+            'ALTER TABLE {table_name} ADD CONSTRAINT pk_{table_name} PRIMARY KEY ({columns})'.format(
+                table_name=table_name, columns=columns)
+            for table_name, columns in primary_keys
+            if 'pk_{}'.format(table_name) not in existing_primary_keys
+        ]
 
     def _create_constraints(self):
         if self.db_type == 'sqlite':
@@ -560,17 +2150,107 @@ class Pheno2SQL(DBAccess):
 
         logger.info('Creating table constraints (indexes, primary keys, etc)')
 
+        build_statements = self._get_primary_keys_sql()
+
         # bgen's samples table
         if self.bgen_sample_file is not None and os.path.isfile(self.bgen_sample_file):
-            create_indexes(BGEN_SAMPLES_TABLE, ('index', 'eid'), db_engine=self._get_db_engine())
+            build_statements.extend(get_indexes_sql(BGEN_SAMPLES_TABLE, ('index', 'eid')))
 
         # fields table
-        create_indexes('fields', ('field_id', 'inst', 'arr', 'table_name', 'type', 'coding'),
-                       db_engine=self._get_db_engine())
+        build_statements.extend(get_indexes_sql('fields', ('field_id', 'inst', 'arr', 'table_name', 'type', 'coding')))
 
         # events table
-        create_indexes('events', ('eid', 'field_id', 'instance', 'event', ('field_id', 'event')),
-                       db_engine=self._get_db_engine())
+        build_statements.extend(get_indexes_sql('events', ('eid', 'field_id', 'instance', 'event', ('field_id', 'event'))))
+
+        logger.info('Running {} index builds with {} jobs'.format(len(build_statements), self.loading_index_n_jobs))
+
+        run_index_builds(build_statements, self._get_db_engine(), n_jobs=self.loading_index_n_jobs,
+                         maintenance_work_mem=self.loading_index_memory, search_path=self.db_schema)
+
+    def _init_staging_schema(self, resume):
+        """
+        Creates the staging schema (self.loading_staging_schema) and makes all loading connections use it, so tables
+        are created and loaded there while the live ones are still queried. If resume is False, any previous staging
+        schema is discarded.
+        """
+        staging_schema = self.loading_staging_schema
+
+        with self._get_db_engine().connect() as conn:
+            self._loading_tmp['live_schema'] = conn.execute('select current_schema()').scalar()
+
+            if staging_schema == self._loading_tmp['live_schema']:
+                raise UkbRestProgramExecutionError('Staging schema must be different from {}'.format(staging_schema))
+
+            if not resume:
+                conn.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(staging_schema))
+
+            conn.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(staging_schema))
+
+        logger.info('Loading data into staging schema {}'.format(staging_schema))
+
+        self._close_db_engine()
+        self.db_schema = staging_schema
+
+    def _swap_staging_schema(self):
+        """
+        Analyzes the tables of the staging schema and, in a single transaction, replaces the live tables with them.
+        Live tables of a previous load that are not in the new one (like those of a removed CSV file) are dropped, but
+        tables of other loaders registered in the fields table (like samples data, see Postloader.load_samples_data)
+        are kept, together with their fields. Unless loading_keep_unlogged is True, staging tables are made logged before the swap, which writes all their
+        data to the WAL.
+        """
+        staging_schema = self.db_schema
+        live_schema = self._loading_tmp['live_schema']
+
+        staging_tables = pd.read_sql(text('select tablename from pg_tables where schemaname = :schema'),
+                                     self._get_db_engine(), params={'schema': staging_schema})['tablename'].tolist()
+
+        logger.info('Analyzing {} tables in staging schema {}'.format(len(staging_tables), staging_schema))
+
+        build_statements = ['ANALYZE {}'.format(table_name) for table_name in staging_tables]
+
+        if not self.loading_keep_unlogged:
+            build_statements.extend('ALTER TABLE {} SET LOGGED'.format(table_name) for table_name in staging_tables)
+
+        run_index_builds(build_statements, self._get_db_engine(), n_jobs=self.loading_index_n_jobs,
+                         maintenance_work_mem=self.loading_index_memory, search_path=staging_schema)
+
+        logger.info('Replacing tables in schema {} with those in {}'.format(live_schema, staging_schema))
+
+        basket_table_pattern = re.compile('^{}[0-9]+_[0-9]+$'.format(re.escape(self.table_prefix)))
+
+        with self._get_db_engine().begin() as conn:
+            live_tables = set(staging_tables)
+            live_tables.update(('fields', 'events', ALL_EIDS_TABLE, BGEN_SAMPLES_TABLE, LOAD_MANIFEST_TABLE,
+                                CATEGORICAL_CODES_TABLE, FIELD_STATS_TABLE))
+
+            if conn.execute("select to_regclass('{}.fields')".format(live_schema)).scalar() is not None:
+                fields_tables = [x[0] for x in conn.execute(
+                    'select distinct table_name from {}.fields where table_name is not null'.format(live_schema))]
+
+                live_tables.update(x for x in fields_tables if basket_table_pattern.match(x))
+                other_tables = sorted(x for x in fields_tables if x not in live_tables)
+
+                if len(other_tables) > 0:
+                    logger.info('Keeping tables of other loaders: {}'.format(', '.join(other_tables)))
+
+                    fields_columns = 'column_name, table_name, field_id, description, coding, inst, arr, type'
+                    conn.execute(text("""
+                        insert into {staging_schema}.fields ({fields_columns})
+                        select {fields_columns}
+                        from {live_schema}.fields
+                        where table_name in :other_tables
+                        on conflict do nothing
+                    """.format(staging_schema=staging_schema, live_schema=live_schema, fields_columns=fields_columns)),
+                        other_tables=tuple(other_tables))
+
+            for table_name in sorted(live_tables):
+                conn.execute('DROP TABLE IF EXISTS {}.{}'.format(live_schema, table_name))
+
+            for table_name in staging_tables:
+                conn.execute('ALTER TABLE {}.{} SET SCHEMA {}'.format(staging_schema, table_name, live_schema))
+
+            conn.execute('DROP SCHEMA {}'.format(staging_schema))
 
     def _vacuum(self):
         logger.info('Vacuuming')
@@ -580,42 +2260,121 @@ class Pheno2SQL(DBAccess):
                 vacuum analyze;
             """)
 
-    def load_data(self, vacuum=False):
+    def load_data(self, vacuum=False, resume=False, incremental=False):
         """
         Load all CSV files specified into the database configured.
+        :param vacuum:
+        :param resume: if True, the steps already completed in a previous run (recorded in the load manifest) are
+        skipped, and only incomplete tables are loaded. Otherwise, everything is loaded from scratch.
+        :param incremental: if True, CSV files are considered new versions of files already loaded (with the same
+        file names), and only the differences are written: new columns, rows that changed and new participants.
+        Files not loaded before are added as new tables.
         :return:
         """
         logger.info('Loading phenotype data into database')
 
+        start_time = time.time()
+        load_status = 'failed'
+        self._loading_tmp = {
+            'load_metrics': LoadMetrics(tempfile.mkdtemp(prefix='ukbrest_load_metrics_', dir=get_tmpdir(self.tmpdir))),
+        }
+
         try:
-            for csv_file_idx, csv_file in enumerate(self.ukb_csvs):
-                logger.info('Working on {}'.format(csv_file))
+            if incremental:
+                self._refresh_data()
+            else:
+                if self.loading_staging_schema is not None:
+                    self._init_staging_schema(resume)
+
+                self._init_load_manifest(resume)
+                self._create_all_eids_table()
+                self._create_events_table()
+
+                if self.loading_categorical_codes:
+                    self._create_categorical_codes_table()
+
+                if self.loading_field_stats:
+                    self._create_field_stats_table()
+
+                self._loading_tmp['co_access_sets'] = self._get_co_access_sets()
+                self._loading_tmp['existing_col_names'] = self._get_existing_col_names()
+                self._loading_tmp['shared_fields_instances'] = self._get_shared_fields_instances()
+                self._loading_tmp['baskets'] = {}
+
+                # schemas are created first, so all CSV files can be loaded concurrently
+                pending_csv_files_idx = []
+
+                for csv_file_idx, csv_file in enumerate(self.ukb_csvs):
+                    logger.info('Working on {}'.format(csv_file))
+
+                    with self._measure_stage('schema', csv_file=csv_file):
+                        self._create_tables_schema(csv_file, csv_file_idx)
+
+                    basket = self._loading_tmp['baskets'][csv_file_idx]
+                    if len(basket['pending_column_names']) == 0 and len(basket['events_column_names']) == 0 and \
+                            self._is_step_done(csv_file, ALL_EIDS_TABLE, 'copy'):
+                        logger.info('All tables from {} were already loaded'.format(csv_file))
+                        continue
+
+                    pending_csv_files_idx.append(csv_file_idx)
 
-                self._create_tables_schema(csv_file, csv_file_idx)
-                self._create_temporary_csvs(csv_file, csv_file_idx)
-                self._load_csv()
+                if len(pending_csv_files_idx) > 0:
+                    self._reset_post_load_steps()
 
-            self._load_all_eids()
-            self._load_bgen_samples()
-            self._load_events()
-            self._create_constraints()
+                    if self.loading_stream_copy:
+                        self._stream_csv(pending_csv_files_idx)
+                    else:
+                        self._create_temporary_csvs(pending_csv_files_idx)
+                        self._load_csv()
+
+                    for csv_file_idx in pending_csv_files_idx:
+                        csv_file = self.ukb_csvs[csv_file_idx]
+
+                        with self._measure_stage('verify', csv_file=csv_file):
+                            self._verify_tables(csv_file, csv_file_idx)
+
+                        with self._measure_stage(ALL_EIDS_TABLE, csv_file=csv_file):
+                            self._load_basket_eids(csv_file, csv_file_idx)
+
+                self._run_post_load_step(BGEN_SAMPLES_TABLE, self._load_bgen_samples)
+                self._run_post_load_step('shared_events', self._load_shared_events)
+                self._run_post_load_step('constraints', self._create_constraints)
+
+                if self.db_schema is not None:
+                    with self._measure_stage('swap'):
+                        self._swap_staging_schema()
 
             if vacuum:
-                self._vacuum()
+                with self._measure_stage('vacuum'):
+                    self._vacuum()
+
+            load_status = 'finished'
 
         except OperationalError as e:
             raise UkbRestSQLExecutionError('There was an error with the database: ' + str(e))
         except UnicodeDecodeError as e:
             logger.debug(str(e))
             raise UkbRestProgramExecutionError('Unicode decoding error when reading CSV file. Activate debug to show more details.')
+        finally:
+            # queries always use live tables
+            if self.db_schema is not None:
+                self._close_db_engine()
+                self.db_schema = None
+
+            self._write_load_report(start_time, load_status)
 
         # delete temporary variable
         del(self._loading_tmp)
 
+        # fields and their storage could have changed
+        self._bump_data_version()
+        self._fields_catalog = None
+
         logger.info('Loading finished!')
 
     def load_sql(self, sql_file):
         self._run_psql(sql_file, is_file=True)
+        self._bump_data_version()
         logger.info(f'SQL file loaded successfully: {sql_file}')
 
     def initialize(self):
@@ -637,53 +2396,166 @@ class Pheno2SQL(DBAccess):
             '{join_type} {table} using (eid) '.format(join_type=join_type, table=t) for t in tables[1:]
         ])
 
-    def _get_needed_tables(self, all_columns):
-        if len(all_columns) == 0:
-            return []
+    def _get_fields_catalog(self, check=False):
+        """
+        Returns the in-memory copy of the fields table (see FieldsCatalog). It is read from the database the first
+        time, and again if the data version changed since then (checked at most once every
+        fields_catalog_check_interval seconds, or now if check is True).
+        """
+        now = time.monotonic()
 
-        all_columns_quoted = ["'{}'".format(x.replace("'", "''")) for x in all_columns]
+        if not check and self._fields_catalog is not None and \
+                now - self._fields_catalog_checked < self.fields_catalog_check_interval:
+            return self._fields_catalog
 
-        tables_needed_df = pd.read_sql(
-            'select distinct table_name '
-            'from fields '
-            'where column_name in (' + ','.join(all_columns_quoted) + ')',
-        self._get_db_engine()).loc[:, 'table_name'].tolist()
+        data_version = self._get_data_version()
+        self._fields_catalog_checked = now
 
-        if len(tables_needed_df) == 0:
-            return []
+        if self._fields_catalog is None or self._fields_catalog.data_version != data_version:
+            try:
+                fields = pd.read_sql('select * from fields', self._get_db_engine())
+            except (ProgrammingError, OperationalError):
+                fields = pd.DataFrame(columns=FieldsCatalog.FIELDS_COLUMNS)
+
+            self._fields_catalog = FieldsCatalog(fields, data_version)
+            self._fields_dtypes = dict(self._fields_catalog.columns_types)
+            self._codings_codes = {}
+
+        return self._fields_catalog
 
-        return tables_needed_df
+    def get_data_version(self, check=False):
+        """
+        Returns the version of the data used by queries: the one of the fields catalog (see _get_fields_catalog).
+        :param check: if True, the data version is read from the database now (and the fields catalog again if it
+        changed), instead of at most once every fields_catalog_check_interval seconds.
+        """
+        return self._get_fields_catalog(check=check).data_version
+
+    def _get_needed_tables(self, all_columns):
+        return self._get_fields_catalog().get_tables(all_columns)
 
     def get_field_dtype(self, field=None):
         """Returns the type of the field. If field is None, then it just loads all fields types"""
+        return self._get_fields_catalog().get_type(field)
+
+    def _get_columns_storage(self):
+        """
+        Returns how columns are stored: columns stored in array columns (see loading_array_columns) and categorical
+        columns stored as codes (see loading_categorical_codes).
+        :return: a tuple with two dictionaries, both with original column names (like c41202_0_0) as keys. The first
+        one has the SQL expression that returns the original value of a column (like c41202_0[1]); the second one, only
+        for encoded columns, has a tuple with the SQL expression of the code and the data-coding.
+        """
+        fields_catalog = self._get_fields_catalog()
+
+        return fields_catalog.columns_sql, fields_catalog.encoded_columns
+
+    def _get_coding_codes(self, data_coding):
+        """
+        Returns a dictionary with the codes of the values of a data-coding (see loading_categorical_codes).
+        """
+        if data_coding not in self._codings_codes:
+            codings = pd.read_sql(
+                'select codings from {} where data_coding = {}'.format(CATEGORICAL_CODES_TABLE, int(data_coding)),
+            self._get_db_engine())['codings']
+
+            self._codings_codes[data_coding] = \
+                {value: code for code, value in enumerate(codings.iloc[0])} if len(codings) > 0 else {}
+
+        return self._codings_codes[data_coding]
+
+    def _rewrite_column_comparison(self, match):
+        columns_sql, encoded_columns = self._get_columns_storage()
+        col_name = match.group('column')
+        comparison = match.group('comparison') if match.group('comparison') is not None else ''
+
+        if comparison and col_name.lower() in encoded_columns:
+            # the code is compared instead of the decoded value, if all values are known
+            code_sql, data_coding = encoded_columns[col_name.lower()]
+            codes = self._get_coding_codes(data_coding)
+
+            values = [x.replace("''", "'") for x in re.findall(Pheno2SQL.RE_SQL_STRING, comparison)]
+            operator = comparison[:comparison.index("'")]
 
-        if field in self._fields_dtypes:
-            return self._fields_dtypes[field]
+            if all(value in codes for value in values):
+                return '{}{}{}'.format(
+                    code_sql, operator,
+                    ', '.join(str(codes[value]) for value in values) + (')' if '(' in operator else '')
+                )
+
+        return columns_sql.get(col_name.lower(), col_name) + comparison
+
+    def _rewrite_columns(self, statement):
+        """
+        Replaces columns in the SQL statement by the expression that returns their original value, if they are not
+        stored as is: like c41202_0_0 by c41202_0[1] if it is stored in an array column. Comparisons of encoded
+        categorical columns with string values (like c21_0_0 = '1' or c21_0_0 in ('1', '2')) are rewritten to compare
+        codes.
+        """
+        columns_sql, encoded_columns = self._get_columns_storage()
+
+        if len(columns_sql) == 0:
+            return statement
+
+        return re.sub(Pheno2SQL.RE_COLUMN_COMPARISON, self._rewrite_column_comparison, statement)
+
+    def _rewrite_data_field(self, data_field):
+        """
+        Same as _rewrite_columns, but for an item of a select list: columns that are not renamed keep their original
+        name (c41202_0_0 is rewritten as c41202_0[1] as c41202_0_0).
+        """
+        columns_sql, encoded_columns = self._get_columns_storage()
+        match = re.search(Pheno2SQL.RE_FULL_COLUMN_NAME_RENAME, data_field)
+
+        if match is None or match.group('field').lower() not in columns_sql:
+            return self._rewrite_columns(data_field)
+
+        col_field = match.group('field')
+        col_rename = match.group('rename') if match.group('rename') is not None else col_field
+
+        return '{} as {}'.format(columns_sql[col_field.lower()], col_rename)
+
+    def get_field_stats(self, columns=None, ecolumns=None):
+        """
+        Returns the statistics of columns computed while loading (see loading_field_stats).
+        :param columns: list of column names (like c21_0_0).
+        :param ecolumns: list of regular expressions of column names.
+        :return: a data frame indexed by column_name, with columns n_rows, n_nulls, n_distinct, min_value, max_value
+        and histogram (a dictionary). If columns and ecolumns are None, all columns are returned.
+        """
+        where_st = ''
+
+        if columns is not None or ecolumns is not None:
+            all_columns = (columns if columns is not None else []) + self._get_fields_from_reg_exp(ecolumns)
+            all_columns_quoted = ["'{}'".format(x.replace("'", "''")) for x in all_columns]
+
+            if len(all_columns_quoted) == 0:
+                all_columns_quoted = ['NULL']
+
+            where_st = 'where column_name in ({})'.format(','.join(all_columns_quoted))
 
-        # initialize dbtypes for all fields
-        field_type = pd.read_sql(
-            'select distinct column_name, type '
-            'from fields',
-        self._get_db_engine())
+        try:
+            field_stats = pd.read_sql(
+                'select * from {} {} order by column_name'.format(FIELD_STATS_TABLE, where_st),
+                self._get_db_engine(), index_col='column_name'
+            )
+        except (ProgrammingError, OperationalError):
+            raise UkbRestSQLExecutionError('Field statistics are not available, data has to be loaded with '
+                                           'loading_field_stats')
 
-        for row in field_type.itertuples():
-            self._fields_dtypes[row.column_name] = row.type
+        field_stats['histogram'] = field_stats['histogram'].map(lambda x: json.loads(x) if x is not None else None)
 
-        return self._fields_dtypes[field] if field in self._fields_dtypes else None
+        return field_stats
 
     def _get_fields_from_reg_exp(self, ecolumns):
+        """Returns the sorted list of columns that match any of the regular expressions in ecolumns."""
         if ecolumns is None:
             return []
 
-        where_st = ["column_name ~ '{}'".format(ecol) for ecol in ecolumns]
-        select_st = """
-            select distinct column_name
-            from fields
-            where {}
-            order by column_name
-        """.format(' or '.join(where_st))
-
-        return pd.read_sql(select_st, self._get_db_engine()).loc[:, 'column_name'].tolist()
+        try:
+            return self._get_fields_catalog().get_columns_from_reg_exp(ecolumns)
+        except re.error as e:
+            raise UkbRestValidationError('Invalid regular expression in ecolumns: {}'.format(str(e)))
 
     def _get_fields_from_statements(self, statement):
         """This method gets all fields mentioned in the statements."""
@@ -721,7 +2593,7 @@ class Pheno2SQL(DBAccess):
     def _get_filterings(self, filter_statements):
         return ' AND '.join('({})'.format(afilter) for afilter in filter_statements)
 
-    def _query_generic(self, sql_query, order_by_dict=None, results_transformator=None):
+    def _get_final_sql_query(self, sql_query, order_by_dict=None):
         final_sql_query = sql_query
 
         if order_by_dict is not None:
@@ -740,23 +2612,146 @@ class Pheno2SQL(DBAccess):
 
             final_sql_query = outer_sql
 
+        return final_sql_query
+
+    def _query_generic(self, sql_query, order_by_dict=None, results_transformator=None, int_columns=None):
+        """
+        Returns the results of a query (see QueryResults).
+        :param results_transformator: function applied to each chunk of results.
+        :param int_columns: Integer fields of the results, which are formatted by results_transformator. They are
+        written without decimals when results are written by PostgreSQL.
+        """
+        final_sql_query = self._get_final_sql_query(sql_query, order_by_dict)
+
         logger.debug(final_sql_query)
 
+        copy_csv = None
+        if self.sql_copy_output:
+            def copy_csv(**kwargs):
+                return self._copy_query(final_sql_query, int_columns=int_columns, **kwargs)
+
+        return QueryResults(
+            lambda: self._query_chunks(final_sql_query, results_transformator),
+            copy_csv=copy_csv
+        )
+
+    def _query_chunks(self, final_sql_query, results_transformator=None):
+        chunksize = self.sql_chunksize if self.sql_chunksize is not None else self.QUERY_CHUNKSIZE
+
+        # with stream_results, PostgreSQL results are read from a server-side (named) cursor, so only one chunk of rows
+        # is kept in memory and the first one is returned without waiting for the whole query to finish. Rows are
+        # fetched in growing batches of up to max_row_buffer rows
+        conn = self._get_db_engine().connect()
+
         try:
-            results_iterator = pd.read_sql(
-                final_sql_query, self._get_db_engine(), index_col='eid', chunksize=self.sql_chunksize
-            )
+            try:
+                results = conn.execution_options(stream_results=True, max_row_buffer=chunksize) \
+                    .execute(final_sql_query)
+            except ProgrammingError as e:
+                raise UkbRestSQLExecutionError(str(e))
+
+            columns = results.keys()
+            first_chunk = True
+
+            while True:
+                rows = results.fetchmany(chunksize)
+
+                # an empty result still returns a chunk with its columns
+                if not rows and not first_chunk:
+                    break
+
+                chunk = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True).set_index('eid')
+                first_chunk = False
+
+                if results_transformator is not None:
+                    chunk = results_transformator(chunk)
+
+                yield chunk
+
+                if len(rows) < chunksize:
+                    break
+        finally:
+            conn.close()
+
+    def _copy_query(self, final_sql_query, sep, na_rep, index_labels, int_columns=None):
+        """
+        Returns a generator of the bytes of the results of a query as CSV, written by PostgreSQL with
+        COPY ... TO STDOUT (see copy_to_stream), or None if a column type is not supported. Values are formatted in SQL
+        as pandas writes them (see get_csv_column_sql), and missing values are replaced by na_rep. If there are
+        timestamp columns, the query is run once more before to choose their format.
+        """
+        # column types of the results, without running the query
+        try:
+            with self._get_db_engine().connect() as conn:
+                results = conn.execute('select * from ({}) q limit 0'.format(final_sql_query))
+                columns_types = [(col.name, col.type_code) for col in results.cursor.description
+                                 if col.name != 'eid']
+                results.close()
+
+                server_version = conn.connection.server_version
         except ProgrammingError as e:
             raise UkbRestSQLExecutionError(str(e))
 
-        if self.sql_chunksize is None:
-            results_iterator = iter([results_iterator])
+        int_columns = int_columns if int_columns is not None else []
+
+        columns_formats = {}
+        for column_name, column_type in columns_types:
+            column_sql = get_csv_column_sql('q.{}'.format(get_sql_identifier(column_name)), column_type,
+                                            integer=column_name in int_columns, server_version=server_version)
+
+            if column_sql is None:
+                logger.debug('Column {} of type {} not supported by COPY'.format(column_name, column_type))
+                return None
+
+            columns_formats[column_name] = column_sql
+
+        # like in pandas, all timestamps have the same format, given by the most precise value of all timestamp columns
+        timestamp_columns = [column_name for column_name, column_type in columns_types if column_type == TIMESTAMP_OID]
+
+        if len(timestamp_columns) > 0:
+            timestamps_precision = pd.read_sql("""
+                select {precisions}
+                from ({final_sql_query}) q
+            """.format(
+                precisions=', '.join('{} as {}'.format(
+                    TIMESTAMP_PRECISION_SQL.format(column='q.{}'.format(get_sql_identifier(column_name))),
+                    get_sql_identifier(column_name)) for column_name in timestamp_columns),
+                final_sql_query=final_sql_query,
+            ), self._get_db_engine()).iloc[0]
+
+            timestamp_precision = max(timestamps_precision, key=list(TIMESTAMP_FORMATS).index)
 
-        for chunk in results_iterator:
-            if results_transformator is not None:
-                chunk = results_transformator(chunk)
+            for column_name in timestamp_columns:
+                columns_formats[column_name] = get_csv_column_sql(
+                    'q.{}'.format(get_sql_identifier(column_name)), TIMESTAMP_OID,
+                    timestamp_precision=timestamp_precision)
 
-            yield chunk
+        columns_sql = ['q.eid::text as {}'.format(get_sql_identifier(label)) for label in index_labels]
+
+        for column_name, column_type in columns_types:
+            column_sql = columns_formats[column_name]
+
+            columns_sql.append('coalesce({}, {}) as {}'.format(
+                column_sql, get_sql_string(na_rep), get_sql_identifier(column_name)))
+
+        # all missing values are already replaced, so NULL is only a string that has to be quoted
+        copy_sql = """
+            COPY (
+                select {columns}
+                from ({final_sql_query}) q
+            ) TO STDOUT WITH (FORMAT csv, HEADER, DELIMITER {sep}, NULL {null}, ENCODING 'UTF8')
+        """.format(
+            columns=', '.join(columns_sql),
+            final_sql_query=final_sql_query,
+            sep=get_sql_string(sep),
+            null=get_sql_string('\\N'),
+        )
+
+        logger.debug(copy_sql)
+
+        # floats are written with their shortest exact representation only if extra_float_digits is greater than 0
+        return copy_to_stream(self._get_db_engine().raw_connection, copy_sql,
+                              pre_sql=['SET LOCAL extra_float_digits = 3'])
 
     def _get_query_sql(self, columns=None, ecolumns=None, filterings=None):
         # select needed tables to join
@@ -783,9 +2778,10 @@ class Pheno2SQL(DBAccess):
 
 
         return base_sql.format(
-            data_fields=','.join(all_columns),
+            data_fields=','.join(self._rewrite_data_field(col) for col in all_columns),
             from_clause=from_clause_sql,
-            where_statements=((' where ' + self._get_filterings(filterings)) if filterings is not None else ''),
+            where_statements=((' where ' + self._rewrite_columns(self._get_filterings(filterings)))
+                              if filterings is not None else ''),
         )
 
     def query(self, columns=None, ecolumns=None, filterings=None, order_by_table=None):
@@ -812,7 +2808,8 @@ class Pheno2SQL(DBAccess):
         return self._query_generic(
             final_sql_query,
             results_transformator=format_integer_columns,
-            order_by_dict=order_by_dict
+            order_by_dict=order_by_dict,
+            int_columns=int_columns
         )
 
     def query_yaml_simple_data(self, yaml_file, section, order_by_table=None):
@@ -824,9 +2821,7 @@ class Pheno2SQL(DBAccess):
 
         section_field_statements = ['({}) as {}'.format(v, x) for x, v in section_data.items()]
 
-        for chunk in self.query(section_field_statements, filterings=include_only_stmts, order_by_table=order_by_table):
-            # chunk = chunk.rename(columns={v:k for x in section_data.items()})
-            yield chunk
+        return self.query(section_field_statements, filterings=include_only_stmts, order_by_table=order_by_table)
 
     def query_yaml_data(self, yaml_file, section, order_by_table=None):
         all_columns = []
@@ -860,7 +2855,9 @@ class Pheno2SQL(DBAccess):
                                     cat_code=cat_code,
                                     column_name=column,
                                     cases_joins=self._create_joins(needed_tables + [ALL_EIDS_TABLE]),
-                                    where_st='where ({}) {}'.format(cat_condition, (' AND ({})'.format(where_st) if where_st else ''))
+                                    where_st=self._rewrite_columns(
+                                        'where ({}) {}'.format(cat_condition, (' AND ({})'.format(where_st) if where_st else ''))
+                                    )
                             )
 
                             subqueries.append(sql_code)
@@ -887,7 +2884,7 @@ class Pheno2SQL(DBAccess):
                             cases_joins=self._create_joins([
                                 '({}) ev'.format(sql_cases)
                             ] + self._get_needed_tables(where_fields)),
-                            where_st='where ' + (where_st if where_st else '1=1')
+                            where_st=self._rewrite_columns('where ' + (where_st if where_st else '1=1'))
                         )
 
                         subqueries.append(sql_cases_code)
@@ -905,7 +2902,7 @@ class Pheno2SQL(DBAccess):
                             controls_joins=self._create_joins([
                                 '{} aet'.format(ALL_EIDS_TABLE),
                             ] + self._get_needed_tables(where_fields)),
-                            where_st='where ' + (where_st if where_st else '1=1'),
+                            where_st=self._rewrite_columns('where ' + (where_st if where_st else '1=1')),
                             sql_cases=sql_cases,
                         )
 
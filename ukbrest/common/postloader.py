@@ -47,6 +47,8 @@ class Postloader(DBAccess):
                 logger.info(f'Writing to SQL table: {data.shape[0]} new sample IDs')
                 data.to_sql(WITHDRAWALS_TABLE, db_engine, index=False, if_exists='append')
 
+        self._bump_data_version()
+
     def load_codings(self, codings_dir):
         logger.info('Loading codings from {}'.format(codings_dir))
         db_engine = self._get_db_engine()
@@ -82,6 +84,8 @@ class Postloader(DBAccess):
 
         self._vacuum('codings')
 
+        self._bump_data_version()
+
     def _rename_column(self, column_name, identifier_columns):
         # first, substitute not-permitted characters
         standard_rename = re.sub(self.patterns['points'], '_', column_name.lower()).strip('_')
@@ -158,3 +162,5 @@ class Postloader(DBAccess):
             })
 
             fields_table_data.to_sql('fields', db_engine, index=False, if_exists='append')
+
+        self._bump_data_version()
@@ -0,0 +1,126 @@
+import struct
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.types import TEXT, FLOAT, TIMESTAMP, SMALLINT, INT, BIGINT
+
+# PostgreSQL binary COPY format: signature, flags field and header extension length
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+BINARY_COPY_TRAILER = struct.pack('>h', -1)
+
+# PostgreSQL timestamps are microseconds since 2000-01-01
+POSTGRES_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+
+# big-endian representation of each fixed-width type
+_FIXED_WIDTH_DTYPES = {
+    FLOAT: '>f8',
+    SMALLINT: '>i2',
+    INT: '>i4',
+    BIGINT: '>i8',
+    TIMESTAMP: '>i8',
+}
+
+
+def _get_type_class(db_type):
+    return db_type if isinstance(db_type, type) else type(db_type)
+
+
+def _get_column_values(values, db_type):
+    """
+    Converts a column of strings (with NaN as missing values) to its binary representation.
+    :param values: a pandas Series or NumPy array.
+    :param db_type: SQLAlchemy type of the column (FLOAT, SMALLINT, INT, BIGINT, TIMESTAMP or TEXT).
+    :return: a tuple with the lengths in bytes of each value (-1 for missing ones) and a flat array of bytes with all
+    non-missing values.
+    """
+    db_type = _get_type_class(db_type)
+    values = np.asarray(values)
+    missing = pd.isnull(values)
+
+    if db_type is TIMESTAMP:
+        datetimes = pd.to_datetime(values[~missing]).values.astype('datetime64[us]')
+        non_missing_values = (datetimes - POSTGRES_EPOCH).astype(np.int64)
+    elif db_type in _FIXED_WIDTH_DTYPES:
+        # strings are parsed by NumPy (faster than pd.to_numeric); integers are exact as floats up to 2^53
+        non_missing_values = values[~missing].astype(np.float64)
+    else:
+        # all values are encoded at once, separated by a NUL character (not allowed in PostgreSQL text values), which
+        # gives their lengths in bytes
+        encoded_values = np.frombuffer(
+            '\x00'.join(values[~missing].tolist() + ['']).encode('utf-8'), dtype=np.uint8)
+        separators = np.flatnonzero(encoded_values == 0)
+
+        lengths = np.full(len(values), -1, dtype=np.int64)
+        lengths[~missing] = np.diff(np.concatenate(([-1], separators))) - 1
+
+        return lengths, encoded_values[encoded_values != 0]
+
+    value_dtype = np.dtype(_FIXED_WIDTH_DTYPES[db_type])
+
+    if value_dtype.kind == 'i' and len(non_missing_values) > 0:
+        # values like 1.7 are rejected, as PostgreSQL does with text values (they would be truncated otherwise)
+        non_integral_values = np.mod(non_missing_values, 1) != 0
+        if non_integral_values.any():
+            raise ValueError('Invalid value for {}: {}'.format(
+                db_type.__name__, values[~missing][non_integral_values][0]))
+
+        if np.abs(non_missing_values).max() > np.iinfo(value_dtype).max:
+            raise ValueError('Value out of range for {}'.format(db_type.__name__))
+
+    lengths = np.where(missing, -1, value_dtype.itemsize)
+
+    return lengths, non_missing_values.astype(value_dtype).view(np.uint8)
+
+
+def get_binary_copy_data(data_frame, db_types, index_db_type=BIGINT):
+    """
+    Returns the rows of data_frame in PostgreSQL binary COPY format (COPY ... FROM STDIN (format binary)), including
+    the header and trailer. Values are converted with vectorized operations, one column at a time.
+    :param data_frame: a data frame with string values and NaN as missing values. Its index is written as the first
+    column.
+    :param db_types: a dictionary with the SQLAlchemy type (FLOAT, SMALLINT, INT, BIGINT, TIMESTAMP or TEXT) of each
+    column.
+    Columns not present are written as TEXT.
+    :param index_db_type: SQLAlchemy type of the index.
+    :return: bytes.
+    """
+    columns_values = [_get_column_values(data_frame.index.values, index_db_type)]
+    columns_values.extend(
+        _get_column_values(data_frame[column].values, db_types.get(column, TEXT))
+        for column in data_frame.columns
+    )
+
+    # each field is its length (int32) followed by its value; each row starts with the number of fields (int16)
+    fields_sizes = np.column_stack([4 + np.maximum(lengths, 0) for lengths, values in columns_values])
+
+    rows_sizes = 2 + fields_sizes.sum(axis=1)
+    rows_starts = len(BINARY_COPY_HEADER) + np.cumsum(rows_sizes) - rows_sizes
+
+    fields_starts = rows_starts[:, None] + 2 + np.cumsum(fields_sizes, axis=1) - fields_sizes
+
+    output = np.empty(len(BINARY_COPY_HEADER) + int(rows_sizes.sum()) + len(BINARY_COPY_TRAILER), dtype=np.uint8)
+    output[:len(BINARY_COPY_HEADER)] = np.frombuffer(BINARY_COPY_HEADER, dtype=np.uint8)
+    output[len(output) - len(BINARY_COPY_TRAILER):] = np.frombuffer(BINARY_COPY_TRAILER, dtype=np.uint8)
+
+    # number of fields of each row
+    n_fields = np.frombuffer(struct.pack('>h', len(columns_values)), dtype=np.uint8)
+    output[rows_starts[:, None] + np.arange(2)] = n_fields
+
+    for column_idx, (lengths, values) in enumerate(columns_values):
+        field_starts = fields_starts[:, column_idx]
+
+        output[field_starts[:, None] + np.arange(4)] = lengths.astype('>i4').view(np.uint8).reshape(-1, 4)
+
+        if len(values) == 0:
+            continue
+
+        non_missing_lengths = lengths[lengths >= 0]
+
+        # destination of each byte of non-missing values, which are stored one after the other in values
+        values_starts = field_starts[lengths >= 0] + 4
+        values_offsets = np.arange(len(values)) - np.repeat(np.cumsum(non_missing_lengths) - non_missing_lengths,
+                                                            non_missing_lengths)
+
+        output[np.repeat(values_starts, non_missing_lengths) + values_offsets] = values
+
+    return output.tobytes()
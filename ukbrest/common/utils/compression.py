@@ -0,0 +1,108 @@
+import gzip
+import os
+import shutil
+from contextlib import contextmanager
+from subprocess import Popen, PIPE
+
+# compression formats supported for CSV files, with the external programs used to decompress them (they run in their
+# own process, so decompression overlaps with parsing; pigz also uses extra threads)
+COMPRESSION_EXTENSIONS = {
+    '.gz': (('pigz', '-d', '-c'), ('gzip', '-d', '-c')),
+    '.zst': (('zstd', '-d', '-c', '-q'),),
+}
+
+CSV_FILE_EXTENSIONS = ('.csv',) + tuple('.csv' + ext for ext in COMPRESSION_EXTENSIONS)
+
+
+def get_compression(filename):
+    """
+    Returns the compression extension of filename (like '.gz'), or None if it is not compressed.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+
+    if extension in COMPRESSION_EXTENSIONS:
+        return extension
+
+    return None
+
+
+def is_csv_file(filename):
+    return filename.lower().endswith(CSV_FILE_EXTENSIONS)
+
+
+def strip_compression_extension(filename):
+    """
+    Returns filename without its compression extension, if any: 'ukb1234.csv.gz' -> 'ukb1234.csv'.
+    """
+    if get_compression(filename) is not None:
+        return os.path.splitext(filename)[0]
+
+    return filename
+
+
+def _get_decompression_command(compression):
+    for command in COMPRESSION_EXTENSIONS[compression]:
+        if shutil.which(command[0]) is not None:
+            return command
+
+    return None
+
+
+@contextmanager
+def _open_with_command(filename, command):
+    with open(filename, 'rb') as input_file:
+        p = Popen(list(command), stdin=input_file, stdout=PIPE, stderr=PIPE, bufsize=1024 * 1024)
+
+    completed = False
+
+    try:
+        yield p.stdout
+        completed = True
+    finally:
+        # the reader can stop before the end of the file (like when reading only the header)
+        if p.poll() is None:
+            p.kill()
+
+        p.stdout.close()
+        stderr_data = p.stderr.read()
+        p.stderr.close()
+        p.wait()
+
+    if completed and p.returncode not in (0, -9):
+        raise IOError('Could not decompress {}: {}'.format(filename, stderr_data.decode(errors='replace').strip()))
+
+
+@contextmanager
+def open_csv_file(filename):
+    """
+    Opens filename for reading as a binary stream, decompressing it on the fly if its extension is .gz or .zst. An
+    external program (pigz, gzip or zstd) is used if available; otherwise, Python modules gzip or zstandard (optional)
+    are used.
+    """
+    compression = get_compression(filename)
+
+    if compression is None:
+        with open(filename, 'rb') as f:
+            yield f
+        return
+
+    command = _get_decompression_command(compression)
+
+    if command is not None:
+        with _open_with_command(filename, command) as f:
+            yield f
+        return
+
+    if compression == '.gz':
+        with gzip.open(filename, 'rb') as f:
+            yield f
+        return
+
+    try:
+        import zstandard
+    except ImportError:
+        raise IOError('Cannot read {}: zstd program or Python package zstandard are needed'.format(filename))
+
+    with open(filename, 'rb') as input_file, \
+            zstandard.ZstdDecompressor().stream_reader(input_file, read_size=1024 * 1024) as f:
+        yield f
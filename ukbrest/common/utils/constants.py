@@ -1,3 +1,7 @@
 ALL_EIDS_TABLE='all_eids'
 WITHDRAWALS_TABLE='withdrawals'
-BGEN_SAMPLES_TABLE='bgen_samples'
\ No newline at end of file
+BGEN_SAMPLES_TABLE='bgen_samples'
+LOAD_MANIFEST_TABLE='load_manifest'
+CATEGORICAL_CODES_TABLE='categorical_codes'
+FIELD_STATS_TABLE='field_stats'
+DATA_VERSION_TABLE='data_version'
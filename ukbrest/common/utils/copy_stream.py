@@ -0,0 +1,234 @@
+import queue
+import threading
+
+# PostgreSQL type OIDs of the columns that can be written as CSV (see get_csv_column_sql)
+BOOL_OID = 16
+INT8_OID = 20
+INT2_OID = 21
+INT4_OID = 23
+TEXT_OID = 25
+FLOAT4_OID = 700
+FLOAT8_OID = 701
+VARCHAR_OID = 1043
+DATE_OID = 1082
+TIMESTAMP_OID = 1114
+NUMERIC_OID = 1700
+
+INTEGER_OIDS = (INT2_OID, INT4_OID, INT8_OID)
+FLOAT_OIDS = (FLOAT4_OID, FLOAT8_OID)
+TEXT_OIDS = (TEXT_OID, VARCHAR_OID)
+
+# floats are written as Python writes them (repr): integral values have a decimal point (3.0) and infinite ones are
+# inf/-inf. PostgreSQL 12 or later uses the same shortest representation otherwise, if extra_float_digits is greater
+# than 0 (but for non-integral values between 1e15 and 1e16, written in exponential notation). Older versions round
+# floats to 15 digits, so they are not written as text by them (see FLOAT_TEXT_MIN_SERVER_VERSION)
+FLOAT_SQL = """
+    case
+        when {column} = 'Infinity' then 'inf'
+        when {column} = '-Infinity' then '-inf'
+        when {column} = 'NaN' then null
+        when {column} = 0 then (case when {column}::text = '-0' then '-0.0' else '0.0' end)
+        when {column} = trunc({column}) and abs({column}) < 1e16 then {column}::bigint::text || '.0'
+        else {column}::text
+    end
+"""
+
+FLOAT_TEXT_MIN_SERVER_VERSION = 120000
+
+# timestamps are written as pandas writes them, with the same format for all values of all timestamp columns: only the
+# date if no value has a time, and otherwise with the precision needed by the most precise value (see
+# TIMESTAMP_PRECISION_SQL). Formats are sorted by precision
+TIMESTAMP_FORMATS = {
+    'day': 'YYYY-MM-DD',
+    'second': 'YYYY-MM-DD HH24:MI:SS',
+    'milliseconds': 'YYYY-MM-DD HH24:MI:SS.MS',
+    'microseconds': 'YYYY-MM-DD HH24:MI:SS.US',
+}
+
+# aggregate expression with the precision (a key of TIMESTAMP_FORMATS) needed by the values of a timestamp column
+TIMESTAMP_PRECISION_SQL = """
+    case
+        when coalesce(bool_and({column} = date_trunc('day', {column})), true) then 'day'
+        when bool_and({column} = date_trunc('second', {column})) then 'second'
+        when bool_and({column} = date_trunc('milliseconds', {column})) then 'milliseconds'
+        else 'microseconds'
+    end
+"""
+
+
+def get_sql_string(value):
+    """Returns a PostgreSQL string constant (with C-style escapes) of value."""
+    return "E'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'").replace('\t', '\\t')
+                          .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def get_sql_identifier(name):
+    """Returns a quoted PostgreSQL identifier."""
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def get_csv_column_sql(column, type_code, integer=False, server_version=FLOAT_TEXT_MIN_SERVER_VERSION,
+                       timestamp_precision='microseconds'):
+    """
+    Returns the SQL expression of a column formatted as text, like pandas' to_csv writes it, or None if its type is not
+    supported. Missing values are kept as null.
+    :param column: SQL expression of the column.
+    :param type_code: PostgreSQL type OID of the column.
+    :param integer: if True, the column is an Integer field, and it is written without decimals even if its type is a
+    float.
+    :param server_version: PostgreSQL version number (like 110005). Floats are not supported before version 12.
+    :param timestamp_precision: if the column is a timestamp, the precision of its values (see TIMESTAMP_PRECISION_SQL).
+    """
+    if type_code in INTEGER_OIDS:
+        return '{}::text'.format(column)
+
+    if integer and type_code in FLOAT_OIDS + (NUMERIC_OID,):
+        # like '{:1.0f}'.format(x): float rounding is to the nearest even value
+        return 'round({}::float8)::numeric::text'.format(column)
+
+    if type_code in FLOAT_OIDS + (NUMERIC_OID,) and server_version < FLOAT_TEXT_MIN_SERVER_VERSION:
+        return None
+
+    if type_code in FLOAT_OIDS:
+        return FLOAT_SQL.format(column=column)
+
+    if type_code == NUMERIC_OID:
+        # pandas reads decimal values as floats
+        return FLOAT_SQL.format(column='({})::float8'.format(column))
+
+    if type_code in TEXT_OIDS:
+        return '{}::text'.format(column)
+
+    if type_code == DATE_OID:
+        return "to_char({}, 'YYYY-MM-DD')".format(column)
+
+    if type_code == TIMESTAMP_OID:
+        return "to_char({}, '{}')".format(column, TIMESTAMP_FORMATS[timestamp_precision])
+
+    if type_code == BOOL_OID:
+        return "(case when {} then 'True' else 'False' end)".format(column)
+
+    return None
+
+
+class CopyCancelled(Exception):
+    pass
+
+
+class _BlockWriter(object):
+    """
+    File-like object where psycopg2 writes the output of a COPY ... TO STDOUT. Rows are grouped in blocks of about
+    block_size bytes, which are put in a queue.
+    """
+    def __init__(self, blocks, block_size, cancelled):
+        self.blocks = blocks
+        self.block_size = block_size
+        self.cancelled = cancelled
+
+        self._buffer = []
+        self._buffer_size = 0
+
+    def write(self, data):
+        if self.cancelled.is_set():
+            raise CopyCancelled()
+
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+
+        if self._buffer_size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.put(b''.join(self._buffer))
+            self._buffer = []
+            self._buffer_size = 0
+
+    def put(self, item):
+        # waits for the reader, unless it stopped reading
+        while not self.cancelled.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+        raise CopyCancelled()
+
+
+def copy_to_stream(get_connection, copy_sql, pre_sql=(), block_size=64 * 1024, max_blocks=16):
+    """
+    Runs a COPY ... TO STDOUT statement and returns a generator of blocks of bytes of its output. The statement is run
+    in a thread that puts the blocks in a queue of at most max_blocks, so the memory used does not depend on the size of
+    the output, and the first block is returned as soon as it is written. If the generator is closed before all the
+    output is read, the statement is cancelled.
+    :param get_connection: function that returns a psycopg2 connection, like Engine.raw_connection.
+    :param copy_sql: COPY statement.
+    :param pre_sql: statements run before copy_sql, in the same transaction (like SET LOCAL).
+    :param block_size: size of the blocks returned, in bytes.
+    :param max_blocks: maximum number of blocks written and not read yet.
+    """
+    blocks = queue.Queue(maxsize=max_blocks)
+    cancelled = threading.Event()
+    end_of_copy = object()
+
+    connection = get_connection()
+    writer = _BlockWriter(blocks, block_size, cancelled)
+
+    def _run_copy():
+        try:
+            cursor = connection.cursor()
+
+            for statement in pre_sql:
+                cursor.execute(statement)
+
+            cursor.copy_expert(copy_sql, writer)
+            cursor.close()
+
+            writer.flush()
+            writer.put(end_of_copy)
+        except CopyCancelled:
+            pass
+        except Exception as e:
+            try:
+                writer.put(e)
+            except CopyCancelled:
+                pass
+
+    copy_thread = threading.Thread(target=_run_copy, daemon=True)
+    copy_thread.start()
+
+    completed = False
+
+    try:
+        while True:
+            block = blocks.get()
+
+            if block is end_of_copy:
+                break
+
+            if isinstance(block, Exception):
+                raise block
+
+            yield block
+
+        completed = True
+    finally:
+        if not completed:
+            cancelled.set()
+
+            # pooled connections (SQLAlchemy) wrap the psycopg2 connection
+            try:
+                getattr(connection, 'connection', connection).cancel()
+            except Exception:
+                pass
+
+        copy_thread.join()
+
+        if completed:
+            connection.close()
+        elif hasattr(connection, 'invalidate'):
+            # a cancelled COPY can leave the connection in an unknown state, so it is not used again
+            connection.invalidate()
+        else:
+            connection.close()
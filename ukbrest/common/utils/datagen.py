@@ -1,3 +1,5 @@
+import csv
+import os
 import tempfile
 from os import makedirs
 from os.path import isdir
@@ -73,6 +75,187 @@ def generate_random_gen(n_variants, n_samples, chromosome=1, initial_position=10
     return pd.DataFrame(genotype, columns=new_cols)
 
 
+
+PHENO_FIELD_TYPES = ('Integer', 'Continuous', 'Categorical (single)', 'Categorical (multiple)', 'Date', 'Text')
+
+# codes of categorical (multiple) fields, like ICD10 codes
+PHENO_MULTIPLE_CODES = ['{}{:02d}{}'.format(letter, number, digit)
+                        for letter in 'ABCDEFGHIJ' for number in range(0, 100, 7) for digit in ('', '0', '1')]
+
+
+def get_random_pheno_fields(n_fields, max_instances=3, max_arrays=5, initial_field_id=100, random_state=None):
+    """
+    Returns a random definition of phenotype data-fields. Field types are taken in turns from PHENO_FIELD_TYPES.
+    :param max_instances: each field has between 1 and max_instances instances.
+    :param max_arrays: categorical (multiple) fields have between 2 and max_arrays arrays; the rest have one.
+    :return: a list of dictionaries with keys field_id, type, n_instances, n_arrays, coding and description.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    fields = []
+
+    for field_idx in range(n_fields):
+        field_id = initial_field_id + field_idx
+        field_type = PHENO_FIELD_TYPES[field_idx % len(PHENO_FIELD_TYPES)]
+
+        coding = None
+        description = 'Random {} field {}'.format(field_type.lower(), field_id)
+
+        if field_type.startswith('Categorical'):
+            coding = 100000 + field_id
+            description += ' Uses data-coding {} comprises {} members.'.format(coding, len(PHENO_MULTIPLE_CODES))
+
+        fields.append({
+            'field_id': field_id,
+            'type': field_type,
+            'n_instances': random_state.randint(1, max_instances + 1),
+            'n_arrays': random_state.randint(2, max_arrays + 1) if field_type == 'Categorical (multiple)' else 1,
+            'coding': coding,
+            'description': description,
+        })
+
+    return fields
+
+
+def get_random_pheno_columns(fields):
+    """Returns the column names (UDIs, like 21-0.0) of the given fields."""
+    return ['{}-{}.{}'.format(field['field_id'], instance, array)
+            for field in fields
+            for instance in range(field['n_instances'])
+            for array in range(field['n_arrays'])]
+
+
+def generate_random_pheno(eids, fields, missing_rate=0.2, random_state=None):
+    """
+    Generates random phenotype data for the given participants and fields. Missing values are empty strings, as in
+    the CSV files of UK Biobank. Arrays of categorical (multiple) fields are filled from the left with distinct codes.
+    :param eids: list of participant ids.
+    :param fields: fields definition as returned by get_random_pheno_fields.
+    :param missing_rate: proportion of missing values in each column.
+    :return: a data frame of strings indexed by eid, with one column per UDI.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    n_samples = len(eids)
+    data = {}
+
+    # possible values of dates and texts are formatted only once
+    all_dates = pd.date_range('1990-01-01', periods=10000, freq='D').strftime('%Y-%m-%d').values.astype(object)
+    all_texts = np.array(['text value {}'.format(i) for i in range(100)], dtype=object)
+
+    for field in fields:
+        field_id = field['field_id']
+        field_type = field['type']
+
+        for instance in range(field['n_instances']):
+            if field_type == 'Categorical (multiple)':
+                n_arrays = field['n_arrays']
+
+                # distinct codes for each participant (a random first code and a random step), filled from the left
+                n_codes = len(PHENO_MULTIPLE_CODES)
+                first_codes = random_state.randint(0, n_codes, size=n_samples)
+                codes_steps = random_state.randint(1, (n_codes - 1) // (n_arrays - 1) + 1, size=n_samples)
+                codes_idxs = (first_codes[:, np.newaxis] + np.arange(n_arrays)[np.newaxis, :] * codes_steps[:, np.newaxis]) % n_codes
+                values = np.array(PHENO_MULTIPLE_CODES, dtype=object)[codes_idxs]
+
+                n_values = random_state.binomial(n_arrays, 1 - missing_rate, size=n_samples)
+                values[np.arange(n_arrays)[np.newaxis, :] >= n_values[:, np.newaxis]] = ''
+
+                for array in range(n_arrays):
+                    data['{}-{}.{}'.format(field_id, instance, array)] = values[:, array]
+
+                continue
+
+            if field_type == 'Integer':
+                values = random_state.randint(-100, 1000, size=n_samples).astype(str)
+            elif field_type == 'Continuous':
+                values = np.char.mod('%.5f', random_state.normal(50, 20, size=n_samples))
+            elif field_type == 'Categorical (single)':
+                values = random_state.choice(['-3', '-1', '0', '1', '2', '3'], size=n_samples)
+            elif field_type == 'Date':
+                values = all_dates[random_state.randint(0, len(all_dates), size=n_samples)]
+            else:
+                values = all_texts[random_state.randint(0, len(all_texts), size=n_samples)]
+
+            values = values.astype(object)
+            values[random_state.rand(n_samples) < missing_rate] = ''
+
+            data['{}-{}.0'.format(field_id, instance)] = values
+
+    data = pd.DataFrame(data, index=pd.Index(eids, name='eid'), columns=get_random_pheno_columns(fields))
+
+    return data
+
+
+def write_random_pheno_html(html_file, fields, n_samples):
+    """
+    Writes the data dictionary (HTML file) of the given fields, with the same format as the ones from UK Biobank.
+    """
+    field_url = 'http://biobank.ctsu.ox.ac.uk/crystal/field.cgi?id={}'
+
+    def _get_row(column_idx, udi, field_id, field_type=None, description=None, rowspan=1):
+        row = '<tr><td style="text-align: right;">{}</td><td><a href="{}">{}</a></td>' \
+              '<td style="text-align: right;">{}</td>'.format(column_idx, field_url.format(field_id), udi, n_samples)
+
+        if field_type is not None:
+            row += '<td rowspan="{0}"><span style="white-space: nowrap;">{1}</span></td>' \
+                   '<td rowspan="{0}">{2}</td>'.format(rowspan, field_type, description)
+
+        return row + '</tr>\n'
+
+    with open(html_file, 'w', encoding='latin1') as f:
+        f.write('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" '
+                '"http://www.w3.org/TR/html4/loose.dtd">\n')
+        f.write('<html lang="en">\n<head>\n<title>Random phenotype data</title>\n</head>\n<body>\n')
+        f.write('<h1>Random phenotype data</h1>\n<p>\n<table border cellspacing="0">\n')
+        f.write('<tr><th>Column</th><th><a href="#udi">UDI</a></th><th><a href="#count">Count</a></th>'
+                '<th>Type</th><th>Description</th></tr>\n')
+        f.write(_get_row(0, 'eid', 0, 'Sequence', 'Encoded anonymised participant ID'))
+
+        column_idx = 1
+
+        for field in fields:
+            field_columns = get_random_pheno_columns([field])
+
+            for udi_idx, udi in enumerate(field_columns):
+                if udi_idx == 0:
+                    f.write(_get_row(column_idx, udi, field['field_id'], field['type'], field['description'],
+                                     rowspan=len(field_columns)))
+                else:
+                    f.write(_get_row(column_idx, udi, field['field_id']))
+
+                column_idx += 1
+
+        f.write('</table>\n</body>\n</html>\n')
+
+
+def write_random_pheno(csv_file, n_samples, n_fields, max_instances=3, max_arrays=5, missing_rate=0.2,
+                       chunksize=10000, seed=None):
+    """
+    Writes a random phenotype dataset (CSV file and its HTML data dictionary, with the same name) with n_samples
+    participants and n_fields data-fields. Data is generated and written by chunks of participants, so large datasets
+    can be created with bounded memory.
+    :return: list of fields, as returned by get_random_pheno_fields.
+    """
+    random_state = np.random.RandomState(seed)
+
+    fields = get_random_pheno_fields(n_fields, max_instances=max_instances, max_arrays=max_arrays,
+                                     random_state=random_state)
+
+    eids = 1000000 + np.sort(random_state.choice(n_samples * 10, size=n_samples, replace=False))
+
+    with open(csv_file, 'w', newline='') as f:
+        for chunk_idx, chunk_start in enumerate(range(0, n_samples, chunksize)):
+            chunk_data = generate_random_pheno(eids[chunk_start:chunk_start + chunksize], fields,
+                                               missing_rate=missing_rate, random_state=random_state)
+            chunk_data.to_csv(f, quoting=csv.QUOTE_ALL, header=(chunk_idx == 0))
+
+    write_random_pheno_html(os.path.splitext(csv_file)[0] + '.html', fields, n_samples)
+
+    return fields
+
 if __name__ == '__main__':
     import os
     import argparse
@@ -1,47 +1,99 @@
+from joblib import Parallel, delayed
 from sqlalchemy import create_engine
+from sqlalchemy.exc import ProgrammingError, OperationalError
 
+from ukbrest.common.utils.constants import DATA_VERSION_TABLE
+from ukbrest.common.utils.misc import get_n_jobs
 
-def create_table(table_name, columns, db_engine, constraints=None, drop_if_exists=True):
+
+def create_table(table_name, columns, db_engine, constraints=None, drop_if_exists=True, unlogged=False):
     with db_engine.connect() as conn:
+        if drop_if_exists:
+            conn.execute('DROP TABLE IF EXISTS {0};'.format(table_name))
+
         sql_st = """
-            {drop_st}
-            CREATE TABLE {create_if_not_exists} {table_name}
+            CREATE {unlogged} TABLE {create_if_not_exists} {table_name}
             (
                 {columns}
                 {constraints}
             )
-            WITH (
-                OIDS = FALSE
-            );
+            {table_options};
         """.format(
-            drop_st='DROP TABLE IF EXISTS {0};'.format(table_name) if drop_if_exists else '',
+            unlogged='UNLOGGED' if unlogged else '',
             create_if_not_exists='if not exists' if not drop_if_exists else '',
             table_name=table_name,
             columns=',\n'.join(columns),
             # FIXME support for more than one constraint
-            constraints=',CONSTRAINT {}'.format(constraints[0]) if constraints is not None else ''
+            constraints=',CONSTRAINT {}'.format(constraints[0]) if constraints is not None else '',
+            table_options='WITH (OIDS = FALSE)' if db_engine.dialect.name == 'postgresql' else ''
         )
 
         conn.execute(sql_st)
 
 
+def get_indexes_sql(table_name, columns):
+    """
+    Returns the SQL statements to create one index for each column specification (a column name or a tuple of column
+    names for multicolumn indexes).
+    """
+    indexes_sql = []
+
+    for column_spec in columns:
+
+        if not isinstance(column_spec, (tuple, list)):
+            column_spec = (column_spec,)
+
+        index_name_suffix = '_'.join(column_spec)
+        columns_name = ', '.join(column_spec)
+
+        indexes_sql.append("""
+            CREATE INDEX IF NOT EXISTS ix_{table_name}_{index_name_suffix}
+            ON {table_name} USING btree
+            ({columns_name})
+        """.format(table_name=table_name, index_name_suffix=index_name_suffix, columns_name=columns_name))
+
+    return indexes_sql
+
+
 def create_indexes(table_name, columns, db_engine):
     with db_engine.connect() as conn:
-        for column_spec in columns:
+        for index_sql in get_indexes_sql(table_name, columns):
+            conn.execute(index_sql)
 
-            if not isinstance(column_spec, (tuple, list)):
-                column_spec = (column_spec,)
 
-            index_name_suffix = '_'.join(column_spec)
-            columns_name = ', '.join(column_spec)
+def run_index_builds(statements, db_engine, n_jobs=1, maintenance_work_mem=None, search_path=None):
+    """
+    Runs index and constraint creation statements concurrently, each one in its own connection and transaction.
+    :param statements: list of SQL statements.
+    :param n_jobs: number of statements run at the same time (-1 means the number of cores).
+    :param maintenance_work_mem: if given, memory used by each build (PostgreSQL's maintenance_work_mem), like '1GB'.
+    :param search_path: if given, schema where the tables of statements are looked up.
+    """
+    if len(statements) == 0:
+        return
 
-            index_sql = """
-                CREATE INDEX ix_{table_name}_{index_name_suffix}
-                ON {table_name} USING btree
-                ({columns_name})
-            """.format(table_name=table_name, index_name_suffix=index_name_suffix, columns_name=columns_name)
+    n_jobs = min(get_n_jobs(n_jobs), len(statements))
 
-            conn.execute(index_sql)
+    # a separate engine, so there are enough connections for all builds
+    builds_engine = create_engine(db_engine.url, pool_size=n_jobs)
+
+    def _run_build(sql_statement):
+        with builds_engine.connect() as conn:
+            with conn.begin():
+                if maintenance_work_mem is not None:
+                    conn.execute("SET LOCAL maintenance_work_mem = '{}'".format(maintenance_work_mem))
+
+                if search_path is not None:
+                    conn.execute('SET LOCAL search_path TO {}'.format(search_path))
+
+                conn.execute(sql_statement)
+
+    try:
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(_run_build)(sql_statement) for sql_statement in statements
+        )
+    finally:
+        builds_engine.dispose()
 
 
 class DBAccess():
@@ -49,6 +101,9 @@ class DBAccess():
         self.db_uri = db_uri
         self.db_engine = None
 
+        # if set, schema used by all connections instead of the default one (PostgreSQL only)
+        self.db_schema = None
+
     def _close_db_engine(self):
         if self.db_engine is not None:
             self.db_engine.dispose()
@@ -60,11 +115,40 @@ class DBAccess():
             if self.db_uri is None or self.db_uri == "":
                 raise ValueError('DB URI was not set')
 
-            kargs = {'pool_size': 10}
+            kargs = {}
+            if not self.db_uri.startswith('sqlite'):
+                # SQLite engines do not use a connection pool with a fixed size
+                kargs['pool_size'] = 10
+
+            if self.db_schema is not None:
+                kargs['connect_args'] = {'options': '-c search_path={}'.format(self.db_schema)}
+
             self.db_engine = create_engine(self.db_uri, **kargs)
 
         return self.db_engine
 
+    def _get_data_version(self):
+        """
+        Returns the version of the data in the database (see _bump_data_version), or None if it was never set.
+        """
+        try:
+            with self._get_db_engine().connect() as conn:
+                return conn.execute('select max(version) from {}'.format(DATA_VERSION_TABLE)).scalar()
+        except (ProgrammingError, OperationalError):
+            return None
+
+    def _bump_data_version(self):
+        """
+        Increases the version of the data in the database. It has to be called after data is changed, so that
+        information cached from it (like the fields catalog) is refreshed.
+        """
+        with self._get_db_engine().connect() as conn:
+            conn.execute('create table if not exists {} (version bigint not null)'.format(DATA_VERSION_TABLE))
+
+            with conn.begin():
+                if conn.execute('update {} set version = version + 1'.format(DATA_VERSION_TABLE)).rowcount == 0:
+                    conn.execute('insert into {} (version) values (1)'.format(DATA_VERSION_TABLE))
+
     def _vacuum(self, table_name):
         with self._get_db_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
             conn.execute("""
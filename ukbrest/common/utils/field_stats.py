@@ -0,0 +1,178 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+
+def _get_hyperloglog_ranks(hashes, precision):
+    """
+    Returns, for each 64-bit hash, its HyperLogLog register (the first precision bits) and the position of the first
+    1-bit in the rest of the bits.
+    """
+    registers = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    remaining_bits = hashes << np.uint64(precision)
+
+    ranks = np.full(len(hashes), 64 - precision + 1, dtype=np.int64)
+    non_zero = remaining_bits != 0
+
+    # index of the highest 1-bit; log2 can be rounded up for values close to a power of two
+    highest_bits = np.floor(np.log2(remaining_bits[non_zero].astype(np.float64))).astype(np.int64)
+    highest_bits -= (np.left_shift(np.uint64(1), highest_bits.astype(np.uint64)) > remaining_bits[non_zero])
+
+    ranks[non_zero] = 64 - highest_bits
+
+    return registers, ranks
+
+
+class ColumnStats(object):
+    """
+    Statistics of a column computed from its chunks of values, with bounded memory: number of rows and missing
+    values, minimum and maximum, an estimate of the number of distinct values (HyperLogLog) and a small histogram.
+    Histograms of numerical columns have equal-width bins, and are estimated from a random sample of values (the ones
+    with the smallest random keys). Histograms of other columns have the count of each value, if there are not too
+    many of them.
+    """
+    def __init__(self, numeric=False, hyperloglog_precision=12, sample_size=1024, n_bins=10,
+                 max_histogram_values=50, seed=0):
+        """
+        :param numeric: if True, values are converted to floats.
+        :param hyperloglog_precision: number of bits used to choose a HyperLogLog register (the relative error of the
+        distinct count is around 1.04 / sqrt(2^precision)).
+        :param sample_size: number of values kept to estimate histograms of numeric columns.
+        :param n_bins: number of bins of histograms of numeric columns.
+        :param max_histogram_values: maximum number of distinct values counted for non-numeric columns.
+        :param seed: random seed used for sampling.
+        """
+        self.numeric = numeric
+        self.hyperloglog_precision = hyperloglog_precision
+        self.sample_size = sample_size
+        self.n_bins = n_bins
+        self.max_histogram_values = max_histogram_values
+
+        self.n_rows = 0
+        self.n_nulls = 0
+        self.min_value = None
+        self.max_value = None
+
+        self._registers = np.zeros(2 ** hyperloglog_precision, dtype=np.int64)
+
+        self._random_state = np.random.RandomState(seed)
+        self._sample_keys = np.empty(0, dtype=np.float64)
+        self._sample_values = np.empty(0, dtype=np.float64)
+
+        self._values_counts = pd.Series([], dtype=np.int64)
+
+    def update(self, values):
+        """
+        Adds a chunk of values.
+        :param values: a pandas Series or NumPy array of strings, with NaN as missing values.
+        """
+        values = np.asarray(values, dtype=object)
+        missing = pd.isnull(values)
+
+        self.n_rows += len(values)
+        self.n_nulls += int(missing.sum())
+
+        values = values[~missing]
+        if len(values) == 0:
+            return
+
+        if self.numeric:
+            values = values.astype(np.float64)
+
+        chunk_min, chunk_max = values.min(), values.max()
+        self.min_value = chunk_min if self.min_value is None else min(self.min_value, chunk_min)
+        self.max_value = chunk_max if self.max_value is None else max(self.max_value, chunk_max)
+
+        registers, ranks = _get_hyperloglog_ranks(pd.util.hash_array(values), self.hyperloglog_precision)
+        np.maximum.at(self._registers, registers, ranks)
+
+        if self.numeric:
+            self._update_sample(values)
+        elif self._values_counts is not None:
+            self._values_counts = self._values_counts.add(pd.Series(values).value_counts(), fill_value=0)
+
+            if len(self._values_counts) > self.max_histogram_values:
+                self._values_counts = None
+
+    def _update_sample(self, values):
+        self._sample_keys = np.concatenate((self._sample_keys, self._random_state.random_sample(len(values))))
+        self._sample_values = np.concatenate((self._sample_values, values))
+
+        if len(self._sample_keys) > self.sample_size:
+            kept = np.argpartition(self._sample_keys, self.sample_size)[:self.sample_size]
+            self._sample_keys = self._sample_keys[kept]
+            self._sample_values = self._sample_values[kept]
+
+    def get_n_distinct(self):
+        """
+        Returns the HyperLogLog estimate of the number of distinct values, with linear counting for small ones.
+        """
+        n_registers = len(self._registers)
+        n_empty_registers = int((self._registers == 0).sum())
+
+        if n_empty_registers == n_registers:
+            return 0
+
+        alpha = 0.7213 / (1 + 1.079 / n_registers)
+        estimate = alpha * n_registers ** 2 / np.power(2.0, -self._registers).sum()
+
+        if estimate <= 2.5 * n_registers and n_empty_registers > 0:
+            estimate = n_registers * np.log(n_registers / n_empty_registers)
+
+        return int(round(estimate))
+
+    def get_histogram(self):
+        """
+        Returns the histogram as a dictionary: with keys 'bins' (the edges of the bins) and 'counts' for numeric
+        columns, or 'values' and 'counts' for the rest. Counts of numeric columns are estimated from a sample. It is
+        None if there are no values, or too many distinct values in a non-numeric column.
+        """
+        if self.n_rows == self.n_nulls:
+            return None
+
+        if self.numeric:
+            counts, bins = np.histogram(self._sample_values, bins=self.n_bins, range=(self.min_value, self.max_value))
+            counts = np.round(counts * (self.n_rows - self.n_nulls) / len(self._sample_values)).astype(np.int64)
+
+            return {
+                'bins': [float(x) for x in bins],
+                'counts': [int(x) for x in counts],
+            }
+
+        if self._values_counts is None:
+            return None
+
+        values_counts = self._values_counts.sort_index()
+
+        return {
+            'values': values_counts.index.tolist(),
+            'counts': [int(x) for x in values_counts],
+        }
+
+    def _format_value(self, value):
+        if value is None:
+            return None
+
+        if self.numeric:
+            # shortest representation, without decimals for integral values
+            value_repr = repr(float(value))
+            return value_repr[:-2] if value_repr.endswith('.0') else value_repr
+
+        return value
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the statistics: n_rows, n_nulls, n_distinct, min_value and max_value (as strings) and
+        histogram (as JSON).
+        """
+        histogram = self.get_histogram()
+
+        return {
+            'n_rows': self.n_rows,
+            'n_nulls': self.n_nulls,
+            'n_distinct': self.get_n_distinct(),
+            'min_value': self._format_value(self.min_value),
+            'max_value': self._format_value(self.max_value),
+            'histogram': json.dumps(histogram) if histogram is not None else None,
+        }
@@ -0,0 +1,107 @@
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from ukbrest.common.utils.constants import CATEGORICAL_CODES_TABLE
+
+
+class FieldsCatalog(object):
+    """
+    In-memory copy of the fields table, so queries are planned without reading it from the database: the table, type,
+    data-coding, instance and array of each column, and how it is stored (in array columns or as codes of its
+    data-coding, see Pheno2SQL.loading_array_columns and Pheno2SQL.loading_categorical_codes).
+    """
+    FIELDS_COLUMNS = ['column_name', 'table_name', 'field_id', 'inst', 'arr', 'coding', 'type']
+
+    # maximum number of regular expressions whose matched columns are cached (the least recently used are discarded)
+    REG_EXP_CACHE_SIZE = 1000
+
+    def __init__(self, fields, data_version=None):
+        """
+        :param fields: a data frame with the rows of the fields table.
+        :param data_version: version of the data the catalog was read from (see DBAccess._get_data_version).
+        """
+        self.data_version = data_version
+
+        # columns of the fields table, adding the expected ones that are missing
+        fields_columns = list(dict.fromkeys(list(fields.columns) + self.FIELDS_COLUMNS))
+
+        self.fields = fields.reindex(columns=fields_columns) \
+            .drop_duplicates('column_name').set_index('column_name', drop=False)
+
+        self.columns_tables = self.fields['table_name'].to_dict()
+        self.columns_types = self.fields['type'].to_dict()
+
+        # columns matched by the last regular expressions used (see get_columns_from_reg_exp). Like columns_tables,
+        # it is discarded with the catalog when the data version changes
+        self._reg_exp_columns = OrderedDict()
+        self._reg_exp_columns_lock = threading.Lock()
+
+        # SQL expressions of columns not stored as is, and codes of encoded categorical columns
+        self.columns_sql = {}
+        self.encoded_columns = {}
+
+        for row in self.fields.itertuples(index=False):
+            column_sql = row.column_name
+
+            if not pd.isnull(getattr(row, 'array_column', np.nan)):
+                column_sql = '{}[{}]'.format(row.array_column, int(row.arr) + 1)
+
+            if not pd.isnull(getattr(row, 'encoded', np.nan)) and row.encoded:
+                self.encoded_columns[row.column_name] = (column_sql, int(row.coding))
+                column_sql = '(select codings from {} where data_coding = {})[{} + 1]'.format(
+                    CATEGORICAL_CODES_TABLE, int(row.coding), column_sql)
+
+            if column_sql != row.column_name:
+                self.columns_sql[row.column_name] = column_sql
+
+    def get_tables(self, columns):
+        """Returns the sorted list of tables where the given columns are stored. Unknown columns are ignored."""
+        return sorted({self.columns_tables[x] for x in columns if x in self.columns_tables})
+
+    def get_columns_from_reg_exp(self, ecolumns):
+        """
+        Returns the sorted list of columns that match any of the regular expressions in ecolumns (searched anywhere in
+        the column name, like PostgreSQL's ~ operator). The columns matched by the last REG_EXP_CACHE_SIZE regular
+        expressions used are cached.
+        :raise re.error: if a regular expression is not valid.
+        """
+        columns = set()
+
+        for ecol in ecolumns:
+            with self._reg_exp_columns_lock:
+                ecol_columns = self._reg_exp_columns.get(ecol)
+
+                if ecol_columns is not None:
+                    self._reg_exp_columns.move_to_end(ecol)
+
+            if ecol_columns is None:
+                reg_exp = re.compile(ecol)
+                ecol_columns = frozenset(x for x in self.columns_tables if reg_exp.search(x))
+
+                with self._reg_exp_columns_lock:
+                    self._reg_exp_columns[ecol] = ecol_columns
+
+                    while len(self._reg_exp_columns) > self.REG_EXP_CACHE_SIZE:
+                        self._reg_exp_columns.popitem(last=False)
+
+            columns.update(ecol_columns)
+
+        return sorted(columns)
+
+    def get_type(self, column):
+        """Returns the type of a column (like Integer or Categorical (single)), or None if it is not known."""
+        return self.columns_types.get(column)
+
+    def get_field(self, column):
+        """
+        Returns a dictionary with the information of a column (table_name, field_id, inst, arr, coding, type, etc), or
+        None if it is not known.
+        """
+        if column not in self.columns_tables:
+            return None
+
+        return self.fields.loc[column].to_dict()
@@ -0,0 +1,148 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from glob import glob
+
+from ukbrest.config import logger
+
+
+def get_peak_rss_mb():
+    """Returns the peak resident set size of the current process, in megabytes."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LoadMetrics(object):
+    """
+    Records metrics of the stages of a load (wall time, rows, bytes read and written and peak memory) as JSON lines in
+    a directory, with one file per process, so stages run in worker processes are recorded too. Only the directory is
+    kept, so it can be pickled to workers.
+    """
+    def __init__(self, metrics_dir):
+        self.metrics_dir = metrics_dir
+
+    @contextmanager
+    def measure(self, stage, **info):
+        """
+        Measures a stage of the load. The yielded dictionary can be updated with the number of rows processed (rows)
+        and the number of bytes read (bytes_read) and written (bytes_written).
+        :param stage: name of the stage (like split or copy).
+        :param info: other information saved with the metrics (like csv_file or table_name).
+        """
+        record = dict(stage=stage, rows=None, bytes_read=None, bytes_written=None, **info)
+
+        start_time = time.time()
+        start_counter = time.perf_counter()
+
+        try:
+            yield record
+        except BaseException:
+            record['failed'] = True
+            raise
+        finally:
+            record['start'] = start_time
+            record['seconds'] = time.perf_counter() - start_counter
+            record['pid'] = os.getpid()
+            record['peak_rss_mb'] = get_peak_rss_mb()
+
+            record['rows_per_second'] = None
+            if record['rows'] is not None and record['seconds'] > 0:
+                record['rows_per_second'] = record['rows'] / record['seconds']
+
+            with open(os.path.join(self.metrics_dir, '{}.jsonl'.format(os.getpid())), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+            self._log_progress(record)
+
+    def _log_progress(self, record):
+        details = [
+            '{:.2f} s'.format(record['seconds']),
+        ]
+
+        if record['rows'] is not None:
+            details.append('{} rows'.format(record['rows']))
+
+        if record['rows_per_second'] is not None:
+            details.append('{:.0f} rows/s'.format(record['rows_per_second']))
+
+        if record['bytes_written'] is not None:
+            details.append('{:.1f} MB written'.format(record['bytes_written'] / 1024 ** 2))
+
+        details.append('peak RSS {:.0f} MB'.format(record['peak_rss_mb']))
+
+        stage_name = record['stage']
+        if record.get('table_name') is not None:
+            stage_name = '{} {}'.format(stage_name, record['table_name'])
+
+        logger.info('Stage {} {}: {}'.format(stage_name, 'failed' if record.get('failed') else 'finished',
+                                             ', '.join(details)))
+
+    def get_records(self):
+        """Returns all the records of the load, sorted by start time."""
+        records = []
+
+        for metrics_file in glob(os.path.join(self.metrics_dir, '*.jsonl')):
+            with open(metrics_file, 'r') as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+
+        return sorted(records, key=lambda x: x['start'])
+
+    def get_report(self, **run_info):
+        """
+        Returns the report of the load: run_info, a summary of each stage and of each worker process, and all the
+        records. Stages running concurrently add up their seconds, so wall_seconds (from the start of the first one to
+        the end of the last one) is also given.
+        """
+        records = self.get_records()
+
+        stages = {}
+        for record in records:
+            stage = stages.setdefault(record['stage'], {
+                'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes_read': 0, 'bytes_written': 0,
+                'start': record['start'], 'end': record['start'],
+            })
+
+            stage['count'] += 1
+            stage['seconds'] += record['seconds']
+            stage['start'] = min(stage['start'], record['start'])
+            stage['end'] = max(stage['end'], record['start'] + record['seconds'])
+
+            for key in ('rows', 'bytes_read', 'bytes_written'):
+                stage[key] += record[key] or 0
+
+        for stage in stages.values():
+            stage['wall_seconds'] = stage.pop('end') - stage.pop('start')
+            stage['rows_per_second'] = stage['rows'] / stage['wall_seconds'] if stage['wall_seconds'] > 0 else None
+
+        workers = {}
+        for record in records:
+            worker = workers.setdefault(str(record['pid']), {'stages': 0, 'seconds': 0.0, 'peak_rss_mb': 0.0})
+            worker['stages'] += 1
+            worker['seconds'] += record['seconds']
+            worker['peak_rss_mb'] = max(worker['peak_rss_mb'], record['peak_rss_mb'])
+
+        return dict(run_info, stages=stages, workers=workers, records=records)
+
+    def write_report(self, report_file, **run_info):
+        """Writes the report of the load (see get_report) as a JSON file."""
+        report = self.get_report(**run_info)
+
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        logger.info('Load report written to {}'.format(report_file))
+
+        return report
+
+
+@contextmanager
+def no_measure():
+    """Context manager used instead of LoadMetrics.measure when metrics are not recorded."""
+    yield {}
+
+
+def get_timestamp(seconds):
+    return datetime.fromtimestamp(seconds).isoformat()
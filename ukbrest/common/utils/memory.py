@@ -0,0 +1,134 @@
+import os
+import re
+import resource
+
+# memory units are powers of 1024, as in PostgreSQL settings
+MEMORY_UNITS = {
+    '': 1,
+    'B': 1,
+    'K': 1024,
+    'KB': 1024,
+    'M': 1024 ** 2,
+    'MB': 1024 ** 2,
+    'G': 1024 ** 3,
+    'GB': 1024 ** 3,
+    'T': 1024 ** 4,
+    'TB': 1024 ** 4,
+}
+
+RE_MEMORY_SIZE = re.compile(r'^\s*(?P<value>\d+(\.\d+)?)\s*(?P<unit>[a-zA-Z]*)\s*$')
+
+
+def parse_memory_size(size):
+    """
+    Returns the number of bytes of a memory size.
+    :param size: a number of bytes, or a string with a number and an optional unit, like '512MB' or '8GB'.
+    :return: an int, or None if size is None.
+    """
+    if size is None:
+        return None
+
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    match = re.match(RE_MEMORY_SIZE, size)
+    if match is None or match.group('unit').upper() not in MEMORY_UNITS:
+        raise ValueError('Invalid memory size: {}'.format(size))
+
+    return int(float(match.group('value')) * MEMORY_UNITS[match.group('unit').upper()])
+
+
+def get_rss():
+    """
+    Returns the current resident set size of the process, in bytes. If it is not available (/proc is only present in
+    Linux), the peak resident set size is returned.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_available_memory():
+    """
+    Returns the memory available for new processes, in bytes (MemAvailable in /proc/meminfo, or the free physical
+    memory if it is not present), or None if it is not known.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return parse_memory_size(line.split(':')[1].strip().replace(' ', ''))
+    except (OSError, ValueError):
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_bytes_per_row(data_frame, n_rows=100):
+    """
+    Returns the memory used by each row of data_frame, including its index and the strings it references, measured on
+    its first n_rows rows.
+    """
+    sample = data_frame.iloc[:n_rows]
+
+    if len(sample) == 0:
+        return 0.0
+
+    return float(sample.memory_usage(deep=True, index=True).sum()) / len(sample)
+
+
+def get_columns_bytes_per_row(data_frame):
+    """
+    Returns a pandas Series with the memory used by each row of each column of data_frame (see get_bytes_per_row).
+    """
+    if len(data_frame) == 0:
+        return data_frame.memory_usage(deep=True, index=False) * 0.0
+
+    return data_frame.memory_usage(deep=True, index=False) / len(data_frame)
+
+
+class ChunkSizer(object):
+    """
+    Chooses the number of rows of each chunk read from a file, so that the memory needed to process it fits in a
+    budget. The memory of a row is measured on the chunks already read (the largest measure is kept), and multiplied by
+    overhead to account for the copies made while processing a chunk (renamed and converted data frames, output
+    buffers, etc).
+    """
+    def __init__(self, memory_limit, first_chunksize, min_chunksize=100, max_chunksize=100000, overhead=4):
+        """
+        :param memory_limit: memory available to process a chunk, in bytes.
+        :param first_chunksize: number of rows of the first chunk, before any row is measured.
+        :param min_chunksize: minimum number of rows of a chunk, even if it does not fit in memory_limit.
+        :param max_chunksize: maximum number of rows of a chunk.
+        :param overhead: memory needed to process a chunk, relative to the memory of the chunk itself.
+        """
+        self.memory_limit = max(memory_limit, 0)
+        self.min_chunksize = min_chunksize
+        self.max_chunksize = max(max_chunksize, min_chunksize)
+        self.first_chunksize = self._clip(first_chunksize)
+        self.overhead = overhead
+
+        self.bytes_per_row = None
+
+    def _clip(self, chunksize):
+        return int(min(max(chunksize, self.min_chunksize), self.max_chunksize))
+
+    def update(self, chunk):
+        """Measures the memory of the rows of a chunk just read."""
+        bytes_per_row = get_bytes_per_row(chunk)
+
+        if self.bytes_per_row is None or bytes_per_row > self.bytes_per_row:
+            self.bytes_per_row = bytes_per_row
+
+    def get_chunksize(self):
+        """Returns the number of rows of the next chunk."""
+        if not self.bytes_per_row:
+            return self.first_chunksize
+
+        return self._clip(self.memory_limit / (self.bytes_per_row * self.overhead))
@@ -21,3 +21,19 @@ def update_parameters_from_args(params, args):
 
 def parameter_empty(parameters, parameter_name):
     return (parameter_name not in parameters or parameters[parameter_name] is None)
+
+
+def get_n_jobs(n_jobs):
+    """
+    Returns the number of workers used by joblib for n_jobs: negative values count from the number of cores (-1 means
+    all of them, -2 all but one, etc). None means one worker.
+    """
+    from multiprocessing import cpu_count
+
+    if n_jobs is None:
+        return 1
+
+    if n_jobs < 0:
+        return max(cpu_count() + 1 + n_jobs, 1)
+
+    return max(n_jobs, 1)
@@ -0,0 +1,130 @@
+import os
+import re
+from collections import Counter
+
+from ruamel.yaml import YAML
+
+
+def _get_yaml_strings(yaml_data):
+    """Returns all keys and values (as strings) of a parsed YAML document."""
+    if isinstance(yaml_data, dict):
+        return [str(x) for k, v in yaml_data.items() for x in [k] + _get_yaml_strings(v)]
+
+    if isinstance(yaml_data, (list, tuple)):
+        return [x for v in yaml_data for x in _get_yaml_strings(v)]
+
+    if yaml_data is None:
+        return []
+
+    return [str(yaml_data)]
+
+
+def read_co_access_sets(query_files, column_name_pattern):
+    """
+    Reads the sets of columns that are queried together from a query log or YAML query files.
+    YAML files (.yaml or .yml) have the same format as those used by the query API: each section is one query, together
+    with samples_filters. Any other file is a query log with one query per line (like SQL statements or request
+    URLs).
+    :param query_files: list of files.
+    :param column_name_pattern: compiled regular expression that matches column names (like c21_0_0).
+    :return: a Counter with sets of column names (frozensets) as keys and the number of queries as values.
+    """
+    co_access_sets = Counter()
+
+    def _add_query(query_strings):
+        columns = frozenset(x.lower() for query_str in query_strings for x in re.findall(column_name_pattern, query_str))
+
+        if len(columns) > 0:
+            co_access_sets[columns] += 1
+
+    for query_file in query_files:
+        if os.path.splitext(query_file)[1].lower() in ('.yaml', '.yml'):
+            with open(query_file, 'r') as f:
+                yaml_data = YAML(typ='safe').load(f)
+
+            if not isinstance(yaml_data, dict):
+                continue
+
+            filters_strings = _get_yaml_strings(yaml_data.get('samples_filters'))
+
+            for section, section_data in yaml_data.items():
+                if section == 'samples_filters':
+                    continue
+
+                _add_query(_get_yaml_strings(section_data) + filters_strings)
+        else:
+            with open(query_file, 'r') as f:
+                for line in f:
+                    _add_query([line])
+
+    return co_access_sets
+
+
+def partition_columns(storage_columns, co_access_sets, max_columns):
+    """
+    Assigns columns to tables so that columns queried together are in the same table, if possible.
+    Queries are considered from the most to the least frequent: the groups of columns of a query are merged if they
+    fit in a table. Groups are then assigned to tables (largest first, to the first table where they fit), and columns
+    that are never queried fill the remaining space, in their original order.
+    :param storage_columns: list of tuples (storage_column_name, column_names), in their original order; column_names
+    are those used in queries, which are stored in the storage column (see Pheno2SQL._get_storage_columns).
+    :param co_access_sets: a Counter with sets of column names queried together (see read_co_access_sets).
+    :param max_columns: maximum number of storage columns in a table.
+    :return: a list of lists of storage_columns items, one per table.
+    """
+    storage_columns_idxs = {
+        col_name: idx for idx, (storage_name, col_names) in enumerate(storage_columns) for col_name in col_names
+    }
+
+    # each storage column starts in its own group
+    groups = {idx: [idx] for idx in range(len(storage_columns))}
+    storage_columns_groups = list(range(len(storage_columns)))
+    queried = set()
+
+    for columns, n_queries in sorted(co_access_sets.items(), key=lambda x: (-x[1], len(x[0]), sorted(x[0]))):
+        columns_idxs = {storage_columns_idxs[x] for x in columns if x in storage_columns_idxs}
+        queried.update(columns_idxs)
+
+        query_groups = sorted({storage_columns_groups[idx] for idx in columns_idxs})
+
+        if len(query_groups) < 2 or sum(len(groups[g]) for g in query_groups) > max_columns:
+            continue
+
+        target_group = query_groups[0]
+
+        for group in query_groups[1:]:
+            for idx in groups[group]:
+                storage_columns_groups[idx] = target_group
+
+            groups[target_group].extend(groups.pop(group))
+
+    queried_groups = [sorted(g) for g in groups.values() if any(idx in queried for idx in g)]
+    queried_groups = sorted(queried_groups, key=lambda g: (-len(g), g[0]))
+
+    tables = []
+
+    for group in queried_groups:
+        table = next((t for t in tables if len(t) + len(group) <= max_columns), None)
+
+        if table is None:
+            table = []
+            tables.append(table)
+
+        table.extend(group)
+
+    # storage columns never queried
+    for idx in range(len(storage_columns)):
+        if idx in queried:
+            continue
+
+        table = next((t for t in tables if len(t) < max_columns), None)
+
+        if table is None:
+            table = []
+            tables.append(table)
+
+        table.append(idx)
+
+    tables = sorted((sorted(t) for t in tables), key=lambda t: t[0])
+
+    return [[storage_columns[idx] for idx in table] for table in tables]
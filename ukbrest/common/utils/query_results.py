@@ -0,0 +1,37 @@
+class QueryResults(object):
+    """
+    Results of a phenotype query: an iterator of data frames (chunks of rows indexed by eid). Results can also be
+    written as CSV by the database itself (see copy_csv), without reading them as data frames.
+    """
+    def __init__(self, get_chunks, copy_csv=None):
+        """
+        :param get_chunks: function that returns a generator of the chunks of the results.
+        :param copy_csv: function that returns a generator of the bytes of the results as CSV, or None if it is not
+        supported (see Pheno2SQL._copy_query).
+        """
+        self._get_chunks = get_chunks
+        self._copy_csv = copy_csv
+
+        self._chunks = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._chunks is None:
+            self._chunks = self._get_chunks()
+
+        return next(self._chunks)
+
+    def copy_csv(self, sep=',', na_rep='', index_labels=('eid',)):
+        """
+        Returns a generator of the bytes of the results as CSV with a header, written by the database, or None if it is
+        not supported (then chunks have to be read and written by the caller).
+        :param sep: field separator.
+        :param na_rep: string written for missing values.
+        :param index_labels: names of the columns where the eid is written (none, one or more), before all others.
+        """
+        if self._copy_csv is None or self._chunks is not None:
+            return None
+
+        return self._copy_csv(sep=sep, na_rep=na_rep, index_labels=index_labels)
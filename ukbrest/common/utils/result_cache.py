@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from ukbrest.config import logger
+
+
+class ResultCache(object):
+    """
+    Cache of serialized query results in a local directory. Each result is a file named after the hash of its key
+    (the normalized query, output format and data version, see get_key), so different processes can share the same
+    directory. When the size of all files is larger than max_size, the least recently used ones are removed.
+    """
+    def __init__(self, cache_dir, max_size, block_size=64 * 1024):
+        """
+        :param cache_dir: directory where results are written (created if it does not exist).
+        :param max_size: maximum size of all cached results, in bytes. Results larger than this are not cached.
+        :param block_size: size of the blocks read from cached results.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.block_size = block_size
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, **query):
+        """
+        Returns the key of a result: the SHA-256 hash of its query, given as keyword arguments with JSON-serializable
+        values.
+        """
+        query_json = json.dumps(query, sort_keys=True, default=str)
+
+        return hashlib.sha256(query_json.encode('utf-8')).hexdigest()
+
+    def _get_result_file(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns a generator of the bytes of a cached result, or None if it is not cached. The file is opened before
+        returning, so it can be removed while it is read.
+        """
+        result_file = self._get_result_file(key)
+
+        try:
+            f = open(result_file, 'rb')
+        except FileNotFoundError:
+            return None
+
+        # the modification time is the last use
+        try:
+            os.utime(result_file)
+        except FileNotFoundError:
+            pass
+
+        def _read_result():
+            with f:
+                for block in iter(lambda: f.read(self.block_size), b''):
+                    yield block
+
+        return _read_result()
+
+    def put(self, key, chunks):
+        """
+        Returns a generator of the chunks (strings or bytes) of a result, which are also written to the cache. The
+        result is only cached once all chunks were read, and if it is not larger than max_size.
+        """
+        result_file = self._get_result_file(key)
+        os.makedirs(os.path.dirname(result_file), exist_ok=True)
+
+        tmp_fd, tmp_file = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(result_file))
+        result_size = 0
+        completed = False
+
+        try:
+            with os.fdopen(tmp_fd, 'wb') as f:
+                for chunk in chunks:
+                    chunk_bytes = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                    result_size += len(chunk_bytes)
+
+                    if result_size <= self.max_size:
+                        f.write(chunk_bytes)
+
+                    yield chunk
+
+            completed = True
+        finally:
+            if completed and result_size <= self.max_size:
+                os.replace(tmp_file, result_file)
+                self._evict()
+            else:
+                os.remove(tmp_file)
+
+    def _evict(self):
+        """Removes the least recently used results until all of them fit in max_size."""
+        results = []
+
+        for dir_entry in os.scandir(self.cache_dir):
+            if not dir_entry.is_dir():
+                continue
+
+            for file_entry in os.scandir(dir_entry.path):
+                if file_entry.name.startswith('.tmp_'):
+                    continue
+
+                try:
+                    file_stat = file_entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                results.append((file_stat.st_mtime, file_stat.st_size, file_entry.path))
+
+        total_size = sum(x[1] for x in results)
+
+        for mtime, size, path in sorted(results):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+                logger.debug('Cached result removed: {}'.format(path))
+            except FileNotFoundError:
+                pass
+
+            total_size -= size
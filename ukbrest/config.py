@@ -25,8 +25,28 @@ TMP_DIR_ENV='UKBREST_TEMP_DIR'
 DEBUG_ENV='UKBREST_DEBUG'
 SQL_CHUNKSIZE_ENV='UKBREST_SQL_CHUNKSIZE'
 LOADING_N_JOBS_ENV= 'UKBREST_LOADING_N_JOBS'
+LOADING_SINGLE_PASS_ENV = 'UKBREST_LOADING_SINGLE_PASS'
+LOADING_STREAM_COPY_ENV = 'UKBREST_LOADING_STREAM_COPY'
+LOADING_BINARY_COPY_ENV = 'UKBREST_LOADING_BINARY_COPY'
+LOADING_INDEX_N_JOBS_ENV = 'UKBREST_LOADING_INDEX_N_JOBS'
+LOADING_INDEX_MEMORY_ENV = 'UKBREST_LOADING_INDEX_MEMORY'
+LOADING_STAGING_SCHEMA_ENV = 'UKBREST_LOADING_STAGING_SCHEMA'
+LOADING_KEEP_UNLOGGED_ENV = 'UKBREST_LOADING_KEEP_UNLOGGED'
+LOADING_ARRAY_COLUMNS_ENV = 'UKBREST_LOADING_ARRAY_COLUMNS'
+LOADING_CATEGORICAL_CODES_ENV = 'UKBREST_LOADING_CATEGORICAL_CODES'
+LOADING_FIELD_STATS_ENV = 'UKBREST_LOADING_FIELD_STATS'
+LOADING_QUERY_FILES_ENV = 'UKBREST_LOADING_QUERY_FILES'
+LOADING_REPORT_FILE_ENV = 'UKBREST_LOADING_REPORT_FILE'
+LOADING_MEMORY_LIMIT_ENV = 'UKBREST_LOADING_MEMORY_LIMIT'
+LOADING_WORKER_MEMORY_LIMIT_ENV = 'UKBREST_LOADING_WORKER_MEMORY_LIMIT'
+FIELDS_CATALOG_CHECK_INTERVAL_ENV = 'UKBREST_FIELDS_CATALOG_CHECK_INTERVAL'
+RESULT_CACHE_DIR_ENV = 'UKBREST_RESULT_CACHE_DIR'
+RESULT_CACHE_SIZE_ENV = 'UKBREST_RESULT_CACHE_SIZE'
+SQL_PANDAS_OUTPUT_ENV = 'UKBREST_SQL_PANDAS_OUTPUT'
 
 LOAD_DATA_VACUUM = 'UKBREST_VACUUM'
+LOAD_DATA_RESUME = 'UKBREST_RESUME'
+LOAD_DATA_INCREMENTAL = 'UKBREST_INCREMENTAL'
 
 HTTP_AUTH_USERS_FILE = 'UKBREST_HTTP_USERS_FILE_PATH'
 
@@ -66,12 +86,70 @@ debug = bool(environ.get(DEBUG_ENV, False))
 # SQL queries will be read by chunks with this size (number of rows)
 sql_chunksize = environ.get(SQL_CHUNKSIZE_ENV, None)
 
+# if True, CSV results are written by pandas instead of PostgreSQL (COPY ... TO STDOUT)
+sql_copy_output = not bool(environ.get(SQL_PANDAS_OUTPUT_ENV, False))
+
 loading_chunksize = environ.get(LOADING_CHUNKSIZE, 5000)
 
 loading_n_jobs = environ.get(LOADING_N_JOBS_ENV, -1)
 
+# if True, each CSV file is read only once when splitting it into tables
+loading_single_pass = bool(environ.get(LOADING_SINGLE_PASS_ENV, False))
+
+# if True, data is streamed into PostgreSQL with COPY ... FROM STDIN, without temporary CSV files
+loading_stream_copy = bool(environ.get(LOADING_STREAM_COPY_ENV, False))
+
+# if True, data is converted to its column types and streamed into PostgreSQL in binary COPY format
+loading_binary_copy = bool(environ.get(LOADING_BINARY_COPY_ENV, False))
+
+# primary keys and indexes are built after loading with this number of jobs (by default, the same as loading_n_jobs)
+loading_index_n_jobs = environ.get(LOADING_INDEX_N_JOBS_ENV, None)
+
+# memory used by each index build (PostgreSQL's maintenance_work_mem), like '1GB'
+loading_index_memory = environ.get(LOADING_INDEX_MEMORY_ENV, None)
+
+# if set, data is loaded into unlogged tables of this schema, which replace the live tables once the load finishes
+loading_staging_schema = environ.get(LOADING_STAGING_SCHEMA_ENV, None)
+
+# if True, tables loaded through the staging schema are kept unlogged (they are emptied after a database crash)
+loading_keep_unlogged = bool(environ.get(LOADING_KEEP_UNLOGGED_ENV, False))
+
+# if True, the arrays of each field instance are stored in a single PostgreSQL array column
+loading_array_columns = bool(environ.get(LOADING_ARRAY_COLUMNS_ENV, False))
+
+# if True, categorical (single) columns are stored as codes of the values in the codings table
+loading_categorical_codes = bool(environ.get(LOADING_CATEGORICAL_CODES_ENV, False))
+
+# if True, statistics of each column are computed while loading and written to the field_stats table
+loading_field_stats = bool(environ.get(LOADING_FIELD_STATS_ENV, False))
+
+# YAML query files or query logs (separated by ;) used to store columns queried together in the same table
+loading_query_files = environ.get(LOADING_QUERY_FILES_ENV, None)
+if loading_query_files is not None:
+    loading_query_files = loading_query_files.split(';')
+
+# JSON file where metrics of each stage of the load are written
+loading_report_file = environ.get(LOADING_REPORT_FILE_ENV, None)
+
+# memory budget of all loading workers and of each one (like 8GB)
+loading_memory_limit = environ.get(LOADING_MEMORY_LIMIT_ENV, None)
+loading_worker_memory_limit = environ.get(LOADING_WORKER_MEMORY_LIMIT_ENV, None)
+
+# seconds between checks of the data version, to refresh the in-memory copy of the fields table used by queries
+fields_catalog_check_interval = environ.get(FIELDS_CATALOG_CHECK_INTERVAL_ENV, 5)
+
+# if set, serialized results of phenotype queries are cached in this directory, up to the given size
+result_cache_dir = environ.get(RESULT_CACHE_DIR_ENV, None)
+result_cache_size = environ.get(RESULT_CACHE_SIZE_ENV, '1GB')
+
 load_data_vacuum = environ.get(LOAD_DATA_VACUUM, True)
 
+# if True, a previous (failed) load is resumed using its load manifest
+load_data_resume = bool(environ.get(LOAD_DATA_RESUME, False))
+
+# if True, CSV files are new versions of files already loaded and only differences are written
+load_data_incremental = bool(environ.get(LOAD_DATA_INCREMENTAL, False))
+
 http_auth_users_file = environ.get(HTTP_AUTH_USERS_FILE, None)
 
 
@@ -130,13 +208,38 @@ def get_pheno2sql_parameters():
         'loading_n_jobs': int(loading_n_jobs),
         'tmpdir': tmpdir,
         'loading_chunksize': int(loading_chunksize),
+        'loading_single_pass': loading_single_pass,
+        'loading_stream_copy': loading_stream_copy,
+        'loading_binary_copy': loading_binary_copy,
+        'loading_index_n_jobs': int(loading_index_n_jobs) if loading_index_n_jobs is not None else None,
+        'loading_index_memory': loading_index_memory,
+        'loading_staging_schema': loading_staging_schema,
+        'loading_keep_unlogged': loading_keep_unlogged,
+        'loading_array_columns': loading_array_columns,
+        'loading_categorical_codes': loading_categorical_codes,
+        'loading_field_stats': loading_field_stats,
+        'loading_query_files': loading_query_files,
+        'loading_report_file': loading_report_file,
+        'loading_memory_limit': loading_memory_limit,
+        'loading_worker_memory_limit': loading_worker_memory_limit,
+        'fields_catalog_check_interval': float(fields_catalog_check_interval),
         'sql_chunksize': int(sql_chunksize) if sql_chunksize is not None else None,
+        'sql_copy_output': sql_copy_output,
+    }
+
+
+def get_result_cache_parameters():
+    return {
+        'result_cache_dir': result_cache_dir,
+        'result_cache_size': result_cache_size,
     }
 
 
 def get_pheno2sql_load_parameters():
     return {
-        'vacuum': load_data_vacuum
+        'vacuum': load_data_vacuum,
+        'resume': load_data_resume,
+        'incremental': load_data_incremental,
     }
 
 
@@ -156,7 +259,25 @@ def get_argparse_arguments(parser=None):
     parser.add_argument('--loading-n-jobs', type=int, help='The loading step will be parallelized with n number of jobs. By default it is the number of cores')
     parser.add_argument('--tmpdir', type=str, help='Temporal directory. Temporary CSV files are written here.')
     parser.add_argument('--loading-chunksize', type=int, help='For the loading step, this will specify the number of rows read each time from CSV files. It is set to 5000 by default.')
+    parser.add_argument('--loading-single-pass', action='store_true', default=None, help='For the loading step, read each CSV file only once and write all tables at the same time, instead of reading it once per group of columns.')
+    parser.add_argument('--loading-stream-copy', action='store_true', default=None, help='For the loading step, stream data directly into PostgreSQL (COPY ... FROM STDIN) instead of writing temporary CSV files.')
+    parser.add_argument('--loading-binary-copy', action='store_true', default=None, help='For the loading step, convert values to their column types and stream them into PostgreSQL in binary COPY format (implies --loading-stream-copy).')
+    parser.add_argument('--loading-index-n-jobs', type=int, help='Number of primary keys and indexes built at the same time after loading. By default it is the same as --loading-n-jobs.')
+    parser.add_argument('--loading-index-memory', type=str, help='Memory used by each primary key or index build (PostgreSQL maintenance_work_mem), like 1GB. By default the server setting is used.')
+    parser.add_argument('--loading-staging-schema', type=str, help='Load data into unlogged tables of this PostgreSQL schema, and replace the live tables with them in a single transaction once loading finishes.')
+    parser.add_argument('--loading-keep-unlogged', action='store_true', default=None, help='Keep tables loaded through --loading-staging-schema unlogged (faster, but PostgreSQL empties them after a crash). Otherwise they are made logged before replacing the live ones, which writes all their data to the WAL.')
+    parser.add_argument('--loading-array-columns', action='store_true', default=None, help='Store the arrays of each field instance (like c41202_0_0, c41202_0_1, etc) in a single PostgreSQL array column. Queries still use the original column names.')
+    parser.add_argument('--loading-categorical-codes', action='store_true', default=None, help='Store categorical (single) columns as smallint/int codes of the values in the codings table, which has to be loaded first. Queries still compare and return the original values.')
+    parser.add_argument('--loading-field-stats', action='store_true', default=None, help='Compute statistics of each column while loading (missing values, minimum and maximum, number of distinct values and a histogram), available through the phenotype/fields/stats endpoint.')
+    parser.add_argument('--loading-query-files', type=str, nargs='+', help='YAML query files or query logs (one query per line) representative of the workload. Columns queried together are stored in the same table, so queries need fewer joins.')
+    parser.add_argument('--loading-report-file', type=str, help='JSON file where a report of the load is written: wall time, rows per second, bytes read and written and peak memory of each stage and worker.')
+    parser.add_argument('--loading-memory-limit', type=str, help='Memory used by all workers when loading CSV files, like 8GB. Read chunks are sized and concurrent workers limited to fit in it.')
+    parser.add_argument('--loading-worker-memory-limit', type=str, help='Memory used by each worker when loading CSV files, like 1GB.')
+    parser.add_argument('--fields-catalog-check-interval', type=float, help='Queries use an in-memory copy of the fields table, refreshed when data is loaded again. This is the number of seconds between checks (5 by default).')
+    parser.add_argument('--result-cache-dir', type=str, help='Directory where results of phenotype queries are cached. Cached results are used until data is loaded again.')
+    parser.add_argument('--result-cache-size', type=str, help='Maximum size of the result cache, like 10GB (1GB by default). The least recently used results are removed first.')
     parser.add_argument('--sql-chunksize', type=int, help='When performing any SQL query, this will be the the number of rows processed at each time. 5000 rows by default.')
+    parser.add_argument('--sql-pandas-output', dest='sql_copy_output', action='store_false', default=None, help='Write CSV, plink2 and BGENIE results with pandas, instead of formatting them in PostgreSQL and streaming the output of COPY ... TO STDOUT.')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--host', type=str, help='Host', default='127.0.0.1')
     parser.add_argument('--port', type=int, help='Port where to listen to')
@@ -5,6 +5,7 @@ from ukbrest.common.pheno2sql import Pheno2SQL
 from ukbrest.common.postloader import Postloader
 from ukbrest import config
 from ukbrest.common.utils.misc import update_parameters_from_args, parameter_empty
+from ukbrest.common.utils.compression import is_csv_file
 
 from ukbrest.resources.error_handling import handle_errors
 
@@ -15,6 +16,8 @@ parser.add_argument('--load-codings', action='store_true')
 parser.add_argument('--load-samples-data', action='store_true')
 parser.add_argument('--identifier-columns', type=str, nargs='+', help='Format file1.txt:column1 file2.txt:column2 ...')
 parser.add_argument('--skip-columns', type=str, nargs='+', help='Format file1.txt:column1 file2.txt:column2 ...')
+parser.add_argument('--resume', action='store_true', help='Resumes a previous load, skipping tables already loaded')
+parser.add_argument('--incremental', action='store_true', help='Refreshes data already loaded with new versions of the same files, writing only differences')
 parser.add_argument('--separators', type=str, nargs='+', help='Format file1.txt:column1 file2.txt:column2 ...')
 
 
@@ -63,7 +66,7 @@ def load_data(args):
         pheno2sql_parameters['ukb_csvs'] = sorted([
             os.path.join(args.pheno_dir, f)
             for f in os.listdir(args.pheno_dir)
-            if f.lower().endswith('.csv')
+            if is_csv_file(f)
         ])
 
     if parameter_empty(pheno2sql_parameters, 'db_uri'):
@@ -73,6 +76,12 @@ def load_data(args):
 
     load_parameters = config.get_pheno2sql_load_parameters()
 
+    if args.resume:
+        load_parameters['resume'] = True
+
+    if args.incremental:
+        load_parameters['incremental'] = True
+
     p2sql.load_data(**load_parameters)
 
 
@@ -1,8 +1,9 @@
 import json
 
-from flask import Response
+from flask import Response, current_app
 
 from ukbrest.common.utils.constants import BGEN_SAMPLES_TABLE
+from ukbrest.common.utils.query_results import QueryResults
 from ukbrest.resources.error_handling import handle_http_errors
 
 
@@ -45,30 +46,65 @@ class GenericSerializer():
     def serialize(self, data_frame, out_buffer, **kwargs):
         raise Exception('Not implemented')
 
+    def copy_data(self, data, na_rep):
+        """
+        Returns a generator of the serialized results written by the database (see QueryResults.copy_csv), or None if
+        results have to be serialized with serialize.
+        """
+        return None
+
     def get_order_by_table(self):
         return None
 
+    def _get_cache_key(self, data, missing_code):
+        """
+        Returns the key of the result in the result cache (see ResultCache), or None if results are not cached. The
+        resource gives the normalized query in data['cache_query'].
+        """
+        result_cache = current_app.config.get('result_cache')
+
+        if result_cache is None or 'cache_query' not in data:
+            return None
+
+        return result_cache.get_key(query=data['cache_query'], serializer=type(self).__name__,
+                                    missing_code=missing_code)
+
     @handle_http_errors
     def __call__(self, *args, **kwargs):
         data, code = self._get_args(*args)
         missing_code = self._get_value_from_dict('missing_code', data, default_value='NA')
 
         headers = self._get_value_from_dict('headers', kwargs, {})
+        headers = dict(headers or {})
 
-        data_response = DataIterator(
-            self.data_generator(
-                data['data'],
-                self.serialize,
-                na_rep=missing_code
-            )
-        )
+        cache_key = self._get_cache_key(data, missing_code)
+        data_response = None
+
+        if cache_key is not None:
+            data_response = current_app.config['result_cache'].get(cache_key)
+            headers['X-Ukbrest-Cache'] = 'HIT' if data_response is not None else 'MISS'
+
+        if data_response is None:
+            data_response = self.copy_data(data['data'], na_rep=missing_code)
+
+            if data_response is None:
+                data_response = self.data_generator(
+                    data['data'],
+                    self.serialize,
+                    na_rep=missing_code
+                )
+
+            data_response = DataIterator(data_response)
+
+            if cache_key is not None:
+                data_response = current_app.config['result_cache'].put(cache_key, data_response)
 
         resp = Response(
             data_response,
             code
         )
 
-        resp.headers.extend(headers or {})
+        resp.headers.extend(headers)
         return resp
 
 
@@ -76,6 +112,12 @@ class CSVSerializer(GenericSerializer):
     def serialize(self, data_frame, out_buffer, **kwargs):
         data_frame.to_csv(out_buffer, **kwargs)
 
+    def copy_data(self, data, na_rep):
+        if not isinstance(data, QueryResults):
+            return None
+
+        return data.copy_csv(sep=',', na_rep=na_rep, index_labels=['eid'])
+
 
 class BgenieSerializer(GenericSerializer):
     def get_order_by_table(self):
@@ -84,6 +126,12 @@ class BgenieSerializer(GenericSerializer):
     def serialize(self, data_frame, out_buffer, **kwargs):
         data_frame.to_csv(out_buffer, sep=' ', index=False, **kwargs)
 
+    def copy_data(self, data, na_rep):
+        if not isinstance(data, QueryResults):
+            return None
+
+        return data.copy_csv(sep=' ', na_rep=na_rep, index_labels=[])
+
 
 class Plink2Serializer(GenericSerializer):
     def serialize(self, data_frame, out_buffer, **kwargs):
@@ -98,6 +146,12 @@ class Plink2Serializer(GenericSerializer):
 
         data.to_csv(out_buffer, sep='\t', **kwargs)
 
+    def copy_data(self, data, na_rep):
+        if not isinstance(data, QueryResults):
+            return None
+
+        return data.copy_csv(sep='\t', na_rep='NA', index_labels=['FID', 'IID'])
+
 
 class JsonSerializer(GenericSerializer):
     def __call__(self, *args, **kwargs):
@@ -1,3 +1,5 @@
+import json
+
 from ruamel.yaml import YAML
 from werkzeug.datastructures import FileStorage
 from flask_restful import current_app as app, Api
@@ -14,6 +16,14 @@ PHENOTYPE_FORMATS = {
 }
 
 
+def _get_query_data_version(pheno2sql):
+    """
+    Returns the data version of a query, read before it is planned. With a result cache, it is read from the database
+    on every query, so results of a new load are never served from the cache of the previous one.
+    """
+    return pheno2sql.get_data_version(check=app.config.get('result_cache') is not None)
+
+
 class PhenotypeAPI(UkbRestAPI):
     def __init__(self, **kwargs):
         super(PhenotypeAPI, self).__init__()
@@ -32,10 +42,19 @@ class PhenotypeAPI(UkbRestAPI):
         if args.columns is None and args.ecolumns is None:
             raise UkbRestValidationError('You have to specify either columns or ecolumns')
 
+        data_version = _get_query_data_version(self.pheno2sql)
         data_results = self.pheno2sql.query(args.columns, args.ecolumns, args.filters)
 
         return {
             'data': data_results,
+            # columns keep their order, which is the order of the output
+            'cache_query': {
+                'endpoint': 'phenotype',
+                'columns': [x.strip() for x in args.columns] if args.columns is not None else None,
+                'ecolumns': sorted({x.strip() for x in args.ecolumns}) if args.ecolumns is not None else None,
+                'filters': sorted({x.strip() for x in args.filters}) if args.filters is not None else None,
+                'data_version': data_version,
+            },
         }
 
 
@@ -55,6 +74,28 @@ class PhenotypeFieldsAPI(UkbRestAPI):
         }
 
 
+class PhenotypeFieldsStatsAPI(UkbRestAPI):
+    def __init__(self, **kwargs):
+        super(PhenotypeFieldsStatsAPI, self).__init__()
+
+        self.parser.add_argument('columns', type=str, action='append', required=False, help='Columns to include')
+        self.parser.add_argument('ecolumns', type=str, action='append', required=False, help='Columns to include (with regular expressions)')
+
+        self.pheno2sql = app.config['pheno2sql']
+
+    def get(self):
+        args = self.parser.parse_args()
+
+        field_stats = self.pheno2sql.get_field_stats(args.columns, args.ecolumns)
+
+        # to_json converts NumPy types and missing values
+        data_results = json.loads(field_stats.to_json(orient='index'))
+
+        return {
+            'data': data_results,
+        }
+
+
 class QueryAPI(UkbRestAPI):
     def __init__(self, **kwargs):
         super(QueryAPI, self).__init__()
@@ -71,20 +112,31 @@ class QueryAPI(UkbRestAPI):
         args = self.parser.parse_args()
 
         yaml = YAML(typ='safe')
+        yaml_data = yaml.load(args.file)
 
         order_by_table = None
         if args.Accept in PHENOTYPE_FORMATS:
             serializer = PHENOTYPE_FORMATS[args.Accept]
             order_by_table = serializer.get_order_by_table()
 
+        data_version = _get_query_data_version(self.pheno2sql)
         data_results = self.pheno2sql.query_yaml(
-            yaml.load(args.file),
+            yaml_data,
             args.section,
             order_by_table=order_by_table
         )
 
         final_results = {
             'data': data_results,
+            # only the section queried and filters are used; the order of the section is the order of the output
+            'cache_query': {
+                'endpoint': 'query',
+                'section': args.section,
+                'section_data': yaml_data[args.section],
+                'samples_filters': yaml_data.get('samples_filters'),
+                'order_by_table': order_by_table,
+                'data_version': data_version,
+            },
         }
 
         if args.missing_code is not None:
@@ -3,6 +3,8 @@ from ukbrest.app import app
 from ukbrest.common.genoquery import GenoQuery
 from ukbrest.common.pheno2sql import Pheno2SQL
 from ukbrest.common.utils.auth import PasswordHasher
+from ukbrest.common.utils.memory import parse_memory_size
+from ukbrest.common.utils.result_cache import ResultCache
 
 
 def setup_app(app, ph):
@@ -14,6 +16,13 @@ def setup_app(app, ph):
     p2sql = Pheno2SQL(**config.get_pheno2sql_parameters())
     app.config.update({'pheno2sql': p2sql})
 
+    # Add result cache, if enabled
+    result_cache_parameters = config.get_result_cache_parameters()
+    if result_cache_parameters['result_cache_dir'] is not None:
+        result_cache = ResultCache(result_cache_parameters['result_cache_dir'],
+                                   parse_memory_size(result_cache_parameters['result_cache_size']))
+        app.config.update({'result_cache': result_cache})
+
     # Add auth object
     auth = ph.setup_http_basic_auth()
     app.config.update({'auth': auth})